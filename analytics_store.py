@@ -0,0 +1,170 @@
+"""Month-partitioned Parquet snapshots of LichSuBan for report queries.
+
+Layout: ``<root>/year=YYYY/month=MM/part.parquet``; rows without a valid NgayBan
+go to ``year=0000/month=00`` so all-time queries still include them.
+"""
+import importlib.util
+import json
+import os
+import re
+import shutil
+from datetime import date, timedelta
+
+import pandas as pd
+
+UNDATED_PARTITION = (0, 0)
+_MANIFEST = 'manifest.json'
+
+
+def parquet_available():
+    return importlib.util.find_spec('pyarrow') is not None
+
+
+def partition_dir(root, year, month):
+    return os.path.join(root, f"year={year:04d}", f"month={month:02d}")
+
+
+def list_partitions(root):
+    partitions = []
+    if not os.path.isdir(root):
+        return partitions
+    for year_dir in os.listdir(root):
+        m_year = re.match(r'^year=(\d{4})$', year_dir)
+        if not m_year:
+            continue
+        for month_dir in os.listdir(os.path.join(root, year_dir)):
+            m_month = re.match(r'^month=(\d{2})$', month_dir)
+            if m_month:
+                partitions.append((int(m_year.group(1)), int(m_month.group(1))))
+    return sorted(partitions)
+
+
+def prune_partitions(partitions, start=None, end=None):
+    """Keep the (year, month) partitions that can hold rows dated within [start, end].
+
+    With no bounds every partition is kept, including the undated one.
+    """
+    if start is None and end is None:
+        return list(partitions)
+    lo = (start.year, start.month) if start is not None else (1, 1)
+    hi = (end.year, end.month) if end is not None else (9999, 12)
+    return [p for p in partitions if p != UNDATED_PARTITION and lo <= p <= hi]
+
+
+def _month_keys(df):
+    dates = pd.to_datetime(df['NgayBan'], errors='coerce')
+    years = dates.dt.year.fillna(0).astype(int)
+    months = dates.dt.month.fillna(0).astype(int)
+    return years, months
+
+
+def _fingerprint(df_part):
+    # Every cell counts, so an edit to any column (LoiNhuan, HinhThucTT...) rewrites the month.
+    return [
+        int(len(df_part)),
+        [str(c) for c in df_part.columns],
+        int(pd.util.hash_pandas_object(df_part, index=False).sum()),
+    ]
+
+
+def _read_manifest(root):
+    try:
+        with open(os.path.join(root, _MANIFEST), encoding='utf-8') as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+
+def _write_manifest(root, manifest):
+    tmp_path = os.path.join(root, _MANIFEST + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, os.path.join(root, _MANIFEST))
+
+
+def write_sales_snapshot(df, root, months=None):
+    """Rewrite the partitions whose contents changed; returns the (year, month) keys written.
+
+    ``months`` limits the work to the given (year, month) keys (e.g. the months that
+    received new rows); ``None`` checks every month and drops partitions that no
+    longer have rows.
+    """
+    os.makedirs(root, exist_ok=True)
+    manifest = _read_manifest(root)
+    years, month_nums = _month_keys(df)
+    keys = pd.Series(list(zip(years, month_nums)), index=df.index)
+    targets = sorted(set(keys)) if months is None else sorted(set(months))
+
+    written = []
+    for year, month in targets:
+        label = f"{year:04d}-{month:02d}"
+        df_part = df[keys == (year, month)]
+        path = partition_dir(root, year, month)
+        if df_part.empty:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            manifest.pop(label, None)
+            continue
+        fingerprint = _fingerprint(df_part)
+        if manifest.get(label) == fingerprint and os.path.isdir(path):
+            continue
+        df_part = df_part.copy()
+        for col in df_part.columns:
+            if df_part[col].dtype == object:
+                df_part[col] = df_part[col].astype(str)
+        os.makedirs(path, exist_ok=True)
+        tmp_file = os.path.join(path, 'part.parquet.tmp')
+        df_part.to_parquet(tmp_file, index=False)
+        os.replace(tmp_file, os.path.join(path, 'part.parquet'))
+        manifest[label] = fingerprint
+        written.append((year, month))
+
+    if months is None:
+        present = set(targets)
+        for year, month in list_partitions(root):
+            if (year, month) not in present:
+                shutil.rmtree(partition_dir(root, year, month))
+                manifest.pop(f"{year:04d}-{month:02d}", None)
+    _write_manifest(root, manifest)
+    return written
+
+
+def read_sales(root, start=None, end=None, columns=None):
+    """Read only the partitions overlapping [start, end] and only the requested columns."""
+    read_cols = None
+    if columns is not None:
+        read_cols = list(columns)
+        if (start is not None or end is not None) and 'NgayBan' not in read_cols:
+            read_cols.append('NgayBan')
+
+    frames = []
+    for year, month in prune_partitions(list_partitions(root), start, end):
+        path = os.path.join(partition_dir(root, year, month), 'part.parquet')
+        if os.path.exists(path):
+            frames.append(pd.read_parquet(path, columns=read_cols))
+    if not frames:
+        return pd.DataFrame(columns=columns if columns is not None else [])
+
+    df = pd.concat(frames, ignore_index=True)
+    df = filter_by_date(df, start, end)
+    if columns is not None:
+        df = df[list(columns)]
+    return df.reset_index(drop=True)
+
+
+def filter_by_date(df, start=None, end=None):
+    if start is None and end is None:
+        return df
+    dates = pd.to_datetime(df['NgayBan'], errors='coerce')
+    mask = dates.notna()
+    if start is not None:
+        mask &= dates >= pd.Timestamp(start)
+    if end is not None:
+        mask &= dates < pd.Timestamp(end + timedelta(days=1))
+    return df[mask]
+
+
+def month_bounds(year, month):
+    start = date(year, month, 1)
+    next_month = date(year + (month == 12), month % 12 + 1, 1)
+    return start, next_month - timedelta(days=1)
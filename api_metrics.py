@@ -0,0 +1,114 @@
+"""Call counts, latency histograms and payload sizes of Sheets API calls, grouped by caller."""
+import json
+import os
+import threading
+import time
+
+LATENCY_BUCKETS_MS = (25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+def payload_cells(value):
+    """Number of cells in a values payload (rows of cells, batch_update items, ValueRanges)."""
+    if isinstance(value, dict):
+        return payload_cells(value.get('values', []))
+    if isinstance(value, (list, tuple)):
+        return sum(payload_cells(v) for v in value)
+    if value is None or isinstance(value, (str, int, float)):
+        return 1
+    return 0
+
+
+def caller_scopes(frame, data_file, ui_file='main.py', skip=('wrapper',)):
+    """(UI function, data function) for the outermost frames of ``ui_file`` and ``data_file``.
+
+    ``ui_file`` is looked up next to ``data_file``, so a library module of the same name
+    further out on the stack (``_pytest/main.py``...) is not taken for the UI.
+    The UI entry point ``main`` only counts when no render function is on the stack.
+    Decorator wrappers and lambdas are skipped so the names are the functions people call.
+    """
+    ui_path = os.path.abspath(os.path.join(os.path.dirname(data_file), ui_file))
+    screen = function = entry = None
+    while frame is not None:
+        code = frame.f_code
+        name = code.co_name
+        if name not in skip and not name.startswith('<'):
+            if code.co_filename == data_file:
+                function = name
+            elif os.path.abspath(code.co_filename) == ui_path:
+                if name == 'main':
+                    entry = name
+                else:
+                    screen = name
+        frame = frame.f_back
+    return screen or entry or '-', function or '-'
+
+
+class ApiMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+        self.started_at = time.time()
+
+    def record(self, screen, function, method, seconds, wait_seconds=0.0, cells=0, error=False):
+        ms = seconds * 1000
+        with self._lock:
+            stat = self._stats.get((screen, function, method))
+            if stat is None:
+                stat = self._stats[(screen, function, method)] = {
+                    'calls': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'wait_ms': 0.0,
+                    'cells': 0, 'histogram': [0] * (len(LATENCY_BUCKETS_MS) + 1),
+                }
+            stat['calls'] += 1
+            stat['errors'] += int(bool(error))
+            stat['total_ms'] += ms
+            stat['max_ms'] = max(stat['max_ms'], ms)
+            stat['wait_ms'] += wait_seconds * 1000
+            stat['cells'] += cells
+            bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS_MS) if ms <= bound), len(LATENCY_BUCKETS_MS))
+            stat['histogram'][bucket] += 1
+
+    @staticmethod
+    def _percentile(stat, q):
+        # Cận trên của bucket chứa phân vị q; bucket cuối (quá 10 s) dùng giá trị lớn nhất.
+        target = q * stat['calls']
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS_MS, stat['histogram']):
+            seen += count
+            if seen >= target:
+                return min(bound, stat['max_ms'])
+        return stat['max_ms']
+
+    def snapshot(self):
+        """One dict per (screen, function, method), most total time first."""
+        with self._lock:
+            items = [(key, dict(stat, histogram=list(stat['histogram']))) for key, stat in self._stats.items()]
+        rows = []
+        for (screen, function, method), stat in items:
+            rows.append({
+                'screen': screen,
+                'function': function,
+                'method': method,
+                'calls': stat['calls'],
+                'errors': stat['errors'],
+                'total_ms': round(stat['total_ms'], 1),
+                'avg_ms': round(stat['total_ms'] / stat['calls'], 1),
+                'p50_ms': round(self._percentile(stat, 0.5), 1),
+                'p95_ms': round(self._percentile(stat, 0.95), 1),
+                'max_ms': round(stat['max_ms'], 1),
+                'wait_ms': round(stat['wait_ms'], 1),
+                'cells': stat['cells'],
+                'histogram': dict(zip([f'<={b}ms' for b in LATENCY_BUCKETS_MS] + ['>10000ms'], stat['histogram'])),
+            })
+        rows.sort(key=lambda r: r['total_ms'], reverse=True)
+        return rows
+
+    def to_json(self):
+        return json.dumps(
+            {'since': self.started_at, 'exported_at': time.time(), 'calls': self.snapshot()},
+            ensure_ascii=False, indent=2,
+        )
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+            self.started_at = time.time()
@@ -0,0 +1,290 @@
+"""Benchmark data_manager loaders and mutators against a latency-simulating fake spreadsheet.
+
+    python bench_data_manager.py --latency-ms 150 --output bench_report.json
+    python bench_data_manager.py --baseline bench_report.json   # exit 1 on regression
+
+Defaults are shop-scale data (5k SKUs, 200k sales rows, 10k debt rows). The JSON report
+lists, per operation, wall-clock timings and the Sheets API requests it made (including
+background cache revalidation it triggered). Against a baseline an operation regresses
+when its median time grows beyond ``--tolerance`` or it makes more API requests.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_sheets import FakeSpreadsheet, QuotaTracker  # noqa: E402
+
+INVENTORY_HEADERS = ['MaSanPham', 'TenSanPham', 'DonVi', 'SoLuong', 'GiaNhap', 'GiaBan', 'NhaCungCap']
+DEBT_HEADERS = ['TenKH', 'Ngay', 'TenSanPham', 'SoLuong', 'ThanhTien', 'MaPhieuNo', 'TrangThai', 'TienDaTra', 'TienConLai']
+IMPORT_HEADERS = ['Ngay', 'MaSanPham', 'TenSanPham', 'NhaCungCap', 'DonVi', 'SoLuong', 'GiaNhap', 'ThanhTien']
+UNITS = ['Hộp', 'Vỉ', 'Chai', 'Tuýp', 'Gói']
+PAYMENT_METHODS = ['Tiền mặt', 'Chuyển khoản']
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--skus', type=int, default=5000)
+    parser.add_argument('--sales', type=int, default=200000)
+    parser.add_argument('--debts', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5, help='runs per operation')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='simulated latency per API request')
+    parser.add_argument('--per-kcell-ms', type=float, default=0.0, help='extra latency per 1000 cells transferred')
+    parser.add_argument('--quota-per-minute', type=int, default=0,
+                        help='apply the rate limiter with this read/write quota (0: no throttling)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default='bench_report.json')
+    parser.add_argument('--baseline', help='earlier report to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative slowdown vs baseline')
+    return parser.parse_args(argv)
+
+
+def make_workdir(args):
+    # data_manager đọc cấu hình từ st.secrets: chạy trong thư mục tạm có secrets riêng,
+    # file Parquet/nhật ký cũng nằm ở đó thay vì trong repo.
+    workdir = tempfile.mkdtemp(prefix='qtmc_bench_')
+    os.makedirs(os.path.join(workdir, '.streamlit'))
+    quota = args.quota_per_minute or 10 ** 9
+    with open(os.path.join(workdir, '.streamlit', 'secrets.toml'), 'w', encoding='utf-8') as f:
+        f.write(
+            'sheet_url = "bench://fake"\n'
+            'checkout_mode = "sync"\n'
+            f'analytics_dir = "{os.path.join(workdir, "analytics").replace(os.sep, "/")}"\n'
+            f'sheets_read_per_minute = {quota}\n'
+            f'sheets_write_per_minute = {quota}\n'
+        )
+    return workdir
+
+
+def build_spreadsheet(args, sales_columns):
+    rng = random.Random(args.seed)
+    quota = QuotaTracker(args.quota_per_minute or 60, args.quota_per_minute or 60)
+    sh = FakeSpreadsheet(latency_ms=args.latency_ms, per_kcell_ms=args.per_kcell_ms, quota=quota)
+
+    products = []
+    for i in range(1, args.skus + 1):
+        cost = rng.randrange(1000, 200000, 500)
+        products.append([f"SP{i:06d}", f"Thuốc mẫu {i}", rng.choice(UNITS), rng.randint(50, 500),
+                         cost, int(cost * 1.3), f"NCC {i % 40}"])
+    sh.add_sheet('TonKho', [INVENTORY_HEADERS] + products, rows=args.skus + 1000, cols=len(INVENTORY_HEADERS))
+
+    idx = {name: i for i, name in enumerate(sales_columns)}
+    start = datetime(2025, 1, 1, 7, 0, 0)
+    sales = [list(sales_columns)]
+    order = 0
+    while len(sales) <= args.sales:
+        order += 1
+        sold_at = start + timedelta(minutes=5 * order)
+        payment = rng.choice(PAYMENT_METHODS)
+        for _ in range(rng.randint(1, 3)):
+            product = rng.choice(products)
+            qty = rng.randint(1, 4)
+            row = [''] * len(sales_columns)
+            row[idx['NgayBan']] = sold_at.strftime('%Y-%m-%d %H:%M:%S')
+            row[idx['MaHoaDon']] = int(sold_at.strftime('%Y%m%d%H%M%S'))
+            row[idx['MaSanPham']] = product[0]
+            row[idx['TenSanPham']] = product[1]
+            row[idx['DonVi']] = product[2]
+            row[idx['SoLuong']] = qty
+            row[idx['GiaBan']] = product[5]
+            row[idx['ThanhTien']] = product[5] * qty
+            row[idx['GiaVonLucBan']] = product[4]
+            row[idx['LoiNhuan']] = (product[5] - product[4]) * qty
+            row[idx['HinhThucTT']] = payment
+            sales.append(row)
+    del sales[args.sales + 1:]
+    sh.add_sheet('LichSuBan', sales, rows=len(sales) + 1000, cols=len(sales_columns))
+
+    debts = [DEBT_HEADERS]
+    for i in range(args.debts):
+        product = rng.choice(products)
+        qty = rng.randint(1, 5)
+        total = product[5] * qty
+        debt_at = start + timedelta(hours=2 * i)
+        debts.append([f"Khách {i % 700}", debt_at.strftime('%Y-%m-%d %H:%M:%S'), product[1], qty, total,
+                      f"CN{debt_at.strftime('%Y%m%d%H%M%S')}{i % 1000:03d}", 'ChuaTra', 0, total])
+    sh.add_sheet('CongNo', debts, rows=len(debts) + 1000, cols=len(DEBT_HEADERS))
+    sh.add_sheet('LichSuNhap', [IMPORT_HEADERS], cols=len(IMPORT_HEADERS))
+    return sh, products, debts
+
+
+def attach(dm, sh):
+    import streamlit as st
+    dm.reset_connection()
+    with dm._CONN_LOCK:
+        dm._CONN_STATE['sheet'] = sh
+        dm._CONN_STATE['sheet_url'] = st.secrets.get("sheet_url")
+
+
+def wait_for_background(dm, timeout=120):
+    # Chờ các lượt tải lại cache ở nền (sau patch) để lệnh gọi API của chúng tính cho thao tác vừa chạy.
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if not any(state['revalidating'] for state in dm._SHEET_CACHE.values()):
+            return
+        time.sleep(0.01)
+
+
+def measure(dm, sh, name, run, prepare=None, repeat=5):
+    timings, api, ok = [], [], True
+    for i in range(repeat):
+        if prepare:
+            prepare(i)
+        wait_for_background(dm)
+        sh.quota.reset()
+        started = time.perf_counter()
+        result = run(i)
+        timings.append((time.perf_counter() - started) * 1000)
+        wait_for_background(dm)
+        api.append(sh.quota.summary())
+        ok = ok and result is not False and not (isinstance(result, dict) and not result.get('ok'))
+    return {
+        'operation': name,
+        'runs': repeat,
+        'ok': ok,
+        'min_ms': round(min(timings), 2),
+        'median_ms': round(statistics.median(timings), 2),
+        'mean_ms': round(statistics.fmean(timings), 2),
+        'max_ms': round(max(timings), 2),
+        'api_reads': round(statistics.fmean(a['reads'] for a in api), 2),
+        'api_writes': round(statistics.fmean(a['writes'] for a in api), 2),
+        'api_cells': round(statistics.fmean(a['cells'] for a in api)),
+        'api_by_method': api[-1]['by_method'],
+        'quota_exceeded': sum(a['quota_exceeded'] for a in api),
+    }
+
+
+def run_benchmarks(args, dm, sh, products, debts):
+    rng = random.Random(args.seed + 1)
+    repeat = args.repeat
+    results = []
+
+    def cart_item(product, qty):
+        return {'MaSanPham': product[0], 'TenSanPham': product[1], 'DonVi': product[2],
+                'SoLuongBan': qty, 'GiaBan': product[5]}
+
+    results.append(measure(dm, sh, 'load_inventory (cold)', lambda i: dm.load_inventory(),
+                           prepare=lambda i: dm._bump_sheet_versions('TonKho'), repeat=repeat))
+    results.append(measure(dm, sh, 'load_inventory (cached)', lambda i: dm.load_inventory(), repeat=repeat))
+    results.append(measure(dm, sh, 'load_sales_history (cold)', lambda i: dm.load_sales_history(),
+                           prepare=lambda i: dm._invalidate_sales_cache(), repeat=repeat))
+    results.append(measure(dm, sh, 'load_sales_history (tail check)', lambda i: dm.load_sales_history(),
+                           prepare=lambda i: dm._mark_sales_cache_stale(), repeat=repeat))
+    results.append(measure(dm, sh, 'load_debt_records (cold)', lambda i: dm.load_debt_records(),
+                           prepare=lambda i: dm._bump_sheet_versions('CongNo'), repeat=repeat))
+    results.append(measure(dm, sh, 'load_debt_records (cached)', lambda i: dm.load_debt_records(), repeat=repeat))
+    results.append(measure(dm, sh, 'load_debt_customers', lambda i: dm.load_debt_customers(), repeat=repeat))
+
+    sold = []
+
+    def checkout(i):
+        cart = [cart_item(p, rng.randint(1, 3)) for p in rng.sample(products, 3)]
+        sold.append(cart[0])
+        return dm.process_checkout(cart, rng.choice(PAYMENT_METHODS))
+    results.append(measure(dm, sh, 'process_checkout (3 items)', checkout, repeat=repeat))
+
+    def import_goods(i):
+        items = [{'MaSanPham': p[0], 'TenSanPham': p[1], 'DonVi': p[2], 'SoLuong': 10, 'GiaNhap': p[4],
+                  'GiaBan': p[5], 'NhaCungCap': p[6]} for p in rng.sample(products, 3)]
+        items.append({'MaSanPham': f"BENCH{i:04d}", 'TenSanPham': f"Hàng mới {i}", 'DonVi': 'Hộp', 'SoLuong': 5,
+                      'GiaNhap': 10000, 'GiaBan': 15000, 'NhaCungCap': ''})
+        return dm.process_import(items)
+    results.append(measure(dm, sh, 'process_import (3 existing + 1 new)', import_goods, repeat=repeat))
+
+    # Hoàn trả các đơn vừa bán trong benchmark (dòng nằm cuối LichSuBan).
+    ws_sales = sh._sheets['LichSuBan']
+    sales_header = ws_sales.data[0]
+    returns = []
+    for item in sold:
+        for row in reversed(ws_sales.data):
+            if row[sales_header.index('MaSanPham')] == item['MaSanPham']:
+                returns.append((row[sales_header.index('MaHoaDon')], item['MaSanPham'], item['SoLuongBan']))
+                break
+    results.append(measure(dm, sh, 'process_return', lambda i: dm.process_return(*returns[i % len(returns)]),
+                           repeat=min(repeat, len(returns))))
+
+    # Trả cả đơn: các đơn nhiều dòng có sẵn trong lịch sử được sinh ra.
+    order_col = sales_header.index('MaHoaDon')
+    lines_per_order = {}
+    for row in ws_sales.data[1:args.sales + 1]:
+        lines_per_order[row[order_col]] = lines_per_order.get(row[order_col], 0) + 1
+    whole_orders = [order for order, count in lines_per_order.items() if count >= 3][-repeat:]
+    results.append(measure(dm, sh, 'process_return_lines (whole order)',
+                           lambda i: dm.process_return_lines(whole_orders[i]), repeat=min(repeat, len(whole_orders))))
+
+    open_debts = [row[5] for row in debts[1:]]
+    results.append(measure(dm, sh, 'settle_debt (partial)', lambda i: dm.settle_debt(open_debts[-1 - i], 1000),
+                           repeat=repeat))
+    return results
+
+
+def compare(report, baseline, tolerance):
+    previous = {r['operation']: r for r in baseline.get('results', [])}
+    regressions = []
+    for result in report['results']:
+        before = previous.get(result['operation'])
+        if before is None:
+            continue
+        slower = result['median_ms'] > before['median_ms'] * (1 + tolerance) + 1.0
+        more_calls = result['api_reads'] + result['api_writes'] > before['api_reads'] + before['api_writes']
+        if slower or more_calls:
+            regressions.append({
+                'operation': result['operation'],
+                'median_ms': [before['median_ms'], result['median_ms']],
+                'api_calls': [before['api_reads'] + before['api_writes'], result['api_reads'] + result['api_writes']],
+            })
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    output = os.path.abspath(args.output)
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    os.chdir(make_workdir(args))
+    logging.disable(logging.WARNING)
+
+    import pandas as pd
+    import data_manager as dm
+
+    sh, products, debts = build_spreadsheet(args, dm.SALES_COLUMNS)
+    attach(dm, sh)
+    results = run_benchmarks(args, dm, sh, products, debts)
+    report = {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'scale': {'skus': args.skus, 'sales_rows': args.sales, 'debt_rows': args.debts},
+        'simulation': {'latency_ms': args.latency_ms, 'per_kcell_ms': args.per_kcell_ms,
+                       'quota_per_minute': args.quota_per_minute},
+        'environment': {'python': platform.python_version(), 'pandas': pd.__version__, 'machine': platform.machine()},
+        'results': results,
+    }
+
+    status = 0
+    if baseline_path:
+        with open(baseline_path, encoding='utf-8') as f:
+            report['regressions'] = compare(report, json.load(f), args.tolerance)
+        status = 1 if report['regressions'] else 0
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print(f"{'operation':<40}{'median ms':>12}{'max ms':>12}{'reads':>8}{'writes':>8}{'cells':>10}  ok")
+    for r in results:
+        print(f"{r['operation']:<40}{r['median_ms']:>12.1f}{r['max_ms']:>12.1f}{r['api_reads']:>8}"
+              f"{r['api_writes']:>8}{r['api_cells']:>10}  {'yes' if r['ok'] else 'NO'}")
+    for r in report.get('regressions', []):
+        print(f"REGRESSION {r['operation']}: median {r['median_ms'][0]} -> {r['median_ms'][1]} ms, "
+              f"API calls {r['api_calls'][0]} -> {r['api_calls'][1]}")
+    print(f"report: {output}")
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
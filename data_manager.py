@@ -3,10 +3,27 @@ import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 import pandas as pd
 from datetime import datetime
+import os
 import re  # Để clean symbol robust / extract sheet key
+import sys
 import time
+import threading
+import contextlib
+import functools
+import inspect
+import itertools
 import pytz  # Để set timezone VN
-from sheet_utils import ensure_worksheet_capacity
+from api_metrics import ApiMetrics, caller_scopes, payload_cells
+from debt_index import DebtIndex
+from analytics_store import filter_by_date, parquet_available, read_sales, write_sales_snapshot
+from search_index import ProductSearchIndex
+from sales_returns import allocate_return, net_sales_returns, return_amount
+from sales_rollup import ROLLUP_COLUMNS, apply_delta, diff_rollups, rollup_frame, rollup_from_sales, rollup_to_row, rows_to_rollup
+from rate_limiter import PRIORITY_BACKGROUND, PRIORITY_POS, PRIORITY_READ, PRIORITY_REPORT, RateLimitedWorksheet, RateLimiter, call_with_backoff, classify_sheets_error
+from sqlite_mirror import MirroredWorksheet, SheetStore, SQLiteSpreadsheet
+from storage_backends import copy_sheets, ensure_schema, open_local_backend
+from write_journal import CheckoutJournal, WriteOutbox
+from sheet_utils import appended_first_row, build_row_index, column_letter, cursor_confirmed, cursor_probe_range, ensure_worksheet_capacity, find_next_free_row, read_sheet_tail, rows_fingerprint, rowcol_to_a1
 
 # NOTE: User request: do not use clean_to_float anymore.
 # Keeping function for backward compatibility if referenced elsewhere,
@@ -73,91 +90,737 @@ def _normalize_id_text(value):
     return txt
 
 # --- KET NOI GOOGLE SHEET ---
-def get_connection():
-    scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
+# Client, Spreadsheet và các Worksheet được giữ chung cho cả process (mọi session Streamlit),
+# chỉ xác thực/mở lại sau khi gặp lỗi kết nối (google-auth tự làm mới access token).
+_CONN_LOCK = threading.RLock()
+_CONN_STATE = {
+    'client': None,
+    'sheet': None,
+    'sheet_url': None,
+    'worksheets': {},
+    'row_cursors': {},
+}
+# Khóa ghi nối tiếp theo sheet để hai phiên không ghi trùng một dòng trống.
+_APPEND_LOCKS = {'LichSuBan': threading.Lock(), 'TonKho': threading.Lock()}
+
+# --- GIOI HAN TAN SUAT GOI GOOGLE SHEETS API ---
+# Mọi lệnh gọi API đi qua một token bucket cho đọc và một cho ghi (quota Sheets tính riêng
+# từng loại theo phút). Bán hàng/ghi được ưu tiên hơn đọc thường, đọc thường hơn báo cáo
+# và tác vụ nền. Lỗi 429 tạm dừng cả bucket; lỗi 5xx, mất kết nối, timeout được thử lại với backoff có jitter.
+_API_WRITE_METHODS = frozenset({
+    'update', 'update_cell', 'update_cells', 'update_acell', 'batch_update', 'append_row', 'append_rows',
+    'insert_row', 'insert_rows', 'delete_rows', 'resize', 'clear', 'add_worksheet',
+})
+# Ghi lại sau lỗi 5xx/mất kết nối có thể nhân đôi dữ liệu nếu server đã nhận: chỉ thử lại khi bị 429.
+_API_NON_IDEMPOTENT = frozenset({'append_row', 'append_rows', 'insert_row', 'insert_rows', 'delete_rows', 'add_worksheet'})
+_API_LOCK = threading.Lock()
+_API_LIMITERS = {}
+_API_LOCAL = threading.local()
+# Thống kê mọi lệnh gọi API theo màn hình (hàm render trong main.py) và hàm data_manager gọi nó.
+API_METRICS = ApiMetrics()
+
+def _api_limiter(kind):
+    with _API_LOCK:
+        if kind not in _API_LIMITERS:
+            rate = float(st.secrets.get(f"sheets_{kind}_per_minute", 60))
+            _API_LIMITERS[kind] = RateLimiter(rate)
+        return _API_LIMITERS[kind]
+
+def _api_priority(priority):
+    """Gọi API trong hàm được đánh dấu dùng mức ưu tiên này (giữ mức cao hơn nếu lồng nhau)."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            previous = getattr(_API_LOCAL, 'priority', None)
+            _API_LOCAL.priority = priority if previous is None else min(previous, priority)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _API_LOCAL.priority = previous
+        return wrapper
+    return decorator
+
+def _sheets_call(method, fn, *args, **kwargs):
+    kind = 'write' if method in _API_WRITE_METHODS else 'read'
+    priority = getattr(_API_LOCAL, 'priority', None)
+    screen, caller = caller_scopes(sys._getframe(1), __file__)
+    api_seconds = [0.0]
+
+    def timed_call():
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            api_seconds[0] += time.perf_counter() - started
+
+    started = time.perf_counter()
+    result, failed = None, True
     try:
-        if st.secrets.get("gcp_service_account"):
-            creds_dict = dict(st.secrets["gcp_service_account"])
-            creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
+        result = call_with_backoff(
+            _api_limiter(kind),
+            timed_call,
+            priority=PRIORITY_READ if priority is None else priority,
+            classify=functools.partial(classify_sheets_error, method, non_idempotent=_API_NON_IDEMPOTENT),
+        )
+        failed = False
+        return result
+    finally:
+        elapsed = time.perf_counter() - started
+        if kind == 'write':
+            cells = payload_cells([v for v in (*args, *kwargs.values()) if isinstance(v, (list, tuple))])
+            cells = cells or int(method in ('update_cell', 'update_acell'))
         else:
-            creds = ServiceAccountCredentials.from_json_keyfile_name('google_key.json', scope)
-        
-        client = gspread.authorize(creds)
+            cells = payload_cells(result) if isinstance(result, (list, tuple)) else 0
+        API_METRICS.record(screen, caller, method, elapsed, elapsed - api_seconds[0], cells, failed)
+
+def api_metrics_snapshot():
+    return API_METRICS.snapshot()
+
+def api_metrics_json():
+    return API_METRICS.to_json()
+
+def reset_api_metrics():
+    API_METRICS.reset()
+
+def api_queue_depth():
+    """Số lệnh gọi Google Sheets đang chờ đến lượt (đọc + ghi)."""
+    with _API_LOCK:
+        limiters = list(_API_LIMITERS.values())
+    return sum(limiter.queue_depth() for limiter in limiters)
+
+def _build_credentials():
+    scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
+    if st.secrets.get("gcp_service_account"):
+        creds_dict = dict(st.secrets["gcp_service_account"])
+        return ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
+    return ServiceAccountCredentials.from_json_keyfile_name('google_key.json', scope)
+
+def _open_spreadsheet(client, sheet_url):
+    # Fallback to open_by_key to avoid Drive API 500 errors; 429/5xx/network errors are retried with backoff.
+    sheet_key = _extract_sheet_key(sheet_url)
+
+    def open_once():
+        try:
+            return client.open_by_url(sheet_url)
+        except Exception:
+            if not sheet_key:
+                raise
+            return client.open_by_key(sheet_key)
+
+    return _sheets_call('open', open_once)
+
+def reset_connection():
+    with _CONN_LOCK:
+        _CONN_STATE['client'] = None
+        _CONN_STATE['sheet'] = None
+        _CONN_STATE['sheet_url'] = None
+        _CONN_STATE['worksheets'] = {}
+        _CONN_STATE['row_cursors'] = {}
+
+def _should_reconnect(error):
+    # Chỉ bỏ kết nối cũ khi lỗi đến từ mạng/xác thực/server, không phải lỗi dữ liệu.
+    if isinstance(error, gspread.exceptions.APIError):
+        status = getattr(getattr(error, 'response', None), 'status_code', None) or 0
+        return status in (401, 403) or status >= 500
+    return isinstance(error, OSError)
+
+def _handle_connection_error(error):
+    if _should_reconnect(error):
+        reset_connection()
+
+# --- NGUON DU LIEU (storage_backend = "sheets" | "sqlite" | "memory" | "module:factory") ---
+# Mọi hàm đọc/ghi chỉ dùng worksheet(), get/batch_get/update/append_rows/delete_rows...
+# nên chạy nguyên vẹn trên SQLite cục bộ hoặc bộ nhớ (kiểm thử tải) thay cho Google Sheets.
+_LOCAL_BACKEND = {'key': None, 'sheet': None}
+_IMPORT_COLUMNS = ['Ngay', 'MaSanPham', 'TenSanPham', 'NhaCungCap', 'DonVi', 'SoLuong', 'GiaNhap', 'ThanhTien']
+_INVENTORY_COLUMNS = ['MaSanPham', 'TenSanPham', 'DonVi', 'SoLuong', 'GiaNhap', 'GiaBan', 'NhaCungCap']
+_DEBT_COLUMNS = ['TenKH', 'Ngay', 'TenSanPham', 'SoLuong', 'ThanhTien', 'MaPhieuNo', 'TrangThai', 'TienDaTra', 'TienConLai']
+
+def storage_backend():
+    backend = os.environ.get("QTMC_STORAGE_BACKEND") or st.secrets.get("storage_backend", "sheets")
+    backend = str(backend).strip()
+    return backend.lower() if ':' not in backend else backend
+
+def _open_local_connection(backend):
+    path = st.secrets.get("storage_path")
+    key = (backend, path)
+    with _CONN_LOCK:
+        if _LOCAL_BACKEND['key'] == key:
+            return _LOCAL_BACKEND['sheet']
+        sh = open_local_backend(backend, path)
+        if backend != 'memory' and st.secrets.get("storage_seed_from_sheets") and not sh.worksheet("TonKho").row_values(1):
+            # Lần đầu chạy cục bộ: chép dữ liệu hiện có từ Google Sheets sang.
+            source = _open_connection()
+            if source is not None:
+                copy_sheets(source, sh, _OFFLINE_SHEETS)
+            reset_connection()
+        ensure_schema(sh, {
+            "TonKho": _INVENTORY_COLUMNS,
+            "LichSuBan": SALES_COLUMNS,
+            "LichSuNhap": _IMPORT_COLUMNS,
+            "CongNo": _DEBT_COLUMNS,
+        })
+        _LOCAL_BACKEND['key'] = key
+        _LOCAL_BACKEND['sheet'] = sh
+    _reset_sheet_state()
+    return sh
+
+def _open_connection():
+    with _CONN_LOCK:
         sheet_url = st.secrets.get("sheet_url")
+        sh = _CONN_STATE['sheet']
+        if sh is not None and _CONN_STATE['sheet_url'] == sheet_url:
+            return sh
+
+        creds = _build_credentials()
+        client = gspread.authorize(creds)
         if not sheet_url:
             return None
 
-        # Retry + fallback to open_by_key to avoid Drive API 500 errors
-        last_err = None
-        sheet_key = _extract_sheet_key(sheet_url)
-        for attempt in range(3):
-            try:
-                return client.open_by_url(sheet_url)
-            except Exception as e:
-                last_err = e
-                if sheet_key:
-                    try:
-                        return client.open_by_key(sheet_key)
-                    except Exception as e2:
-                        last_err = e2
-                time.sleep(0.7 * (attempt + 1))
-        raise last_err
+        sh = _open_spreadsheet(client, sheet_url)
+        _CONN_STATE['client'] = client
+        _CONN_STATE['sheet'] = sh
+        _CONN_STATE['sheet_url'] = sheet_url
+        _CONN_STATE['worksheets'] = {}
+        _CONN_STATE['row_cursors'] = {}
+        return sh
+
+def get_connection(allow_offline=True):
+    # Hàm ghi đang chạy (hoặc đang phát lại outbox) giữ nguyên kết nối đã chọn từ đầu.
+    pinned = getattr(_OFFLINE_LOCAL, 'pinned', None)
+    if pinned is not None:
+        return pinned[0]
+    offline_mode = _offline_enabled()
+    if offline_mode:
+        _start_offline_worker()
+        if _is_offline():
+            # Chỉ luồng nền thử kết nối lại; UI dùng ngay bản lưu cục bộ, không chờ timeout.
+            return _offline_spreadsheet() if allow_offline else None
+    try:
+        backend = storage_backend()
+        if backend != 'sheets':
+            return _open_local_connection(backend)
+        return _open_connection()
     except Exception as e:
+        reset_connection()
+        if offline_mode and _mark_offline(e):
+            return _offline_spreadsheet() if allow_offline else None
         st.error(f"Lỗi kết nối Database: {str(e)}")
         return None
 
+def _get_worksheet(sh, name):
+    # Dùng lại handle đã mở thay vì gọi sh.worksheet() (1 request metadata) mỗi lần.
+    with _CONN_LOCK:
+        ws = _CONN_STATE['worksheets'].get(name)
+        if ws is not None and _CONN_STATE['sheet'] is sh:
+            return ws
+    if isinstance(sh, SQLiteSpreadsheet):
+        return sh.worksheet(name)
+    if storage_backend() != 'sheets':
+        ws = sh.worksheet(name)
+    else:
+        ws = RateLimitedWorksheet(_sheets_call('worksheet', sh.worksheet, name), _sheets_call)
+        if _storage_mode() == 'sqlite_mirror':
+            ws = MirroredWorksheet(_get_mirror_store(), ws)
+            _start_mirror_reconciler()
+    with _CONN_LOCK:
+        if _CONN_STATE['sheet'] is sh:
+            _CONN_STATE['worksheets'][name] = ws
+    return ws
+
+def _next_append_row(ws, name):
+    # Dòng trống kế tiếp: tin con trỏ đã lưu nếu probe 2 ô xác nhận, tránh tải cả sheet.
+    with _CONN_LOCK:
+        cached_row = _CONN_STATE['row_cursors'].get(name)
+    return find_next_free_row(ws, cached_row)
+
+def _set_append_row(name, next_row):
+    with _CONN_LOCK:
+        if next_row is None:
+            _CONN_STATE['row_cursors'].pop(name, None)
+        else:
+            _CONN_STATE['row_cursors'][name] = next_row
+
+# --- BAN SAO SQLITE CUC BO (storage_mode = "sqlite_mirror") ---
+# Mọi lệnh đọc được phục vụ từ SQLite, lệnh ghi vào SQLite trước rồi mới ghi lên Google Sheets.
+# Một luồng nền định kỳ kéo lại toàn bộ sheet để nhận các sửa tay trực tiếp trên Google Sheets.
+_MIRROR_LOCK = threading.Lock()
+_MIRROR_STATE = {'store': None, 'thread': None}
+
+def _storage_mode():
+    return str(st.secrets.get("storage_mode", "sheets")).strip().lower()
+
+def _get_mirror_store():
+    with _MIRROR_LOCK:
+        if _MIRROR_STATE['store'] is None:
+            _MIRROR_STATE['store'] = SheetStore(st.secrets.get("sqlite_path", "qtmc_mirror.db"))
+        return _MIRROR_STATE['store']
+
+@_api_priority(PRIORITY_BACKGROUND)
+def reconcile_mirror():
+    # Trả về danh sách sheet có dữ liệu thay đổi so với bản SQLite.
+    with _CONN_LOCK:
+        worksheets = dict(_CONN_STATE['worksheets'])
+    changed = []
+    for name, ws in worksheets.items():
+        if not isinstance(ws, MirroredWorksheet):
+            continue
+        try:
+            if ws.reconcile():
+                changed.append(name)
+        except Exception as e:
+            _handle_connection_error(e)
+    if changed:
+        if "LichSuBan" in changed:
+            _invalidate_sales_cache()
+            _invalidate_order_index()
+        if "TonKho" in changed:
+            _invalidate_product_index()
+        if "CongNo" in changed:
+            _invalidate_debt_index()
+        _bump_sheet_versions(*changed)
+    return changed
+
+def _mirror_reconcile_loop(interval):
+    while True:
+        time.sleep(interval)
+        reconcile_mirror()
+
+def _start_mirror_reconciler():
+    with _MIRROR_LOCK:
+        if _MIRROR_STATE['thread'] is not None:
+            return
+        interval = float(st.secrets.get("mirror_reconcile_seconds", 300))
+        thread = threading.Thread(target=_mirror_reconcile_loop, args=(interval,), daemon=True)
+        _MIRROR_STATE['thread'] = thread
+        thread.start()
+
+# --- CHE DO OFFLINE (offline_mode = true) ---
+# Khi không mở được Google Sheets, mọi lệnh đọc chạy trên bản lưu SQLite của các sheet
+# (bản sao SQLite nếu đang dùng sqlite_mirror). Bán hàng, bán nợ, nhập hàng và thu nợ
+# vẫn chạy như thường trên bản lưu, đồng thời được ghi vào outbox cùng thời điểm thực
+# hiện và tồn kho đã thấy; có mạng lại thì luồng nền phát lại từng thao tác lên sheet
+# và ghi nhận xung đột khi tồn kho trên sheet đã khác.
+_OFFLINE_SHEETS = ("TonKho", "LichSuBan", "LichSuNhap", "CongNo", "TongHopNgay")
+_OFFLINE_LOCK = threading.Lock()
+_OFFLINE_STATE = {
+    'since': None, 'error': '', 'store': None, 'outbox': None,
+    'thread': None, 'wake': threading.Event(), 'snapshot_at': 0.0,
+}
+_OFFLINE_LOCAL = threading.local()
+_OUTBOX_WRITERS = {}
+
+def _offline_enabled():
+    if storage_backend() != 'sheets':
+        return False
+    return str(st.secrets.get("offline_mode", False)).strip().lower() in ('1', 'true', 'yes', 'on')
+
+def _is_offline():
+    return _OFFLINE_STATE['since'] is not None
+
+def _get_offline_store():
+    if _storage_mode() == 'sqlite_mirror':
+        return _get_mirror_store()
+    with _OFFLINE_LOCK:
+        if _OFFLINE_STATE['store'] is None:
+            _OFFLINE_STATE['store'] = SheetStore(st.secrets.get("offline_snapshot_path", "qtmc_offline.db"))
+        return _OFFLINE_STATE['store']
+
+def _get_offline_outbox():
+    with _OFFLINE_LOCK:
+        if _OFFLINE_STATE['outbox'] is None:
+            path = st.secrets.get("offline_outbox_path", "qtmc_offline_outbox.jsonl")
+            _OFFLINE_STATE['outbox'] = WriteOutbox(path)
+        return _OFFLINE_STATE['outbox']
+
+def _offline_spreadsheet():
+    store = _get_offline_store()
+    if not store.has_sheet("TonKho"):
+        return None
+    return SQLiteSpreadsheet(store)
+
+def _reset_sheet_state():
+    # Đổi nguồn dữ liệu (sheet <-> bản lưu): bỏ mọi cache/chỉ mục dựng từ nguồn cũ.
+    _invalidate_product_index()
+    _invalidate_order_index()
+    _invalidate_debt_index()
+    _invalidate_sales_cache()
+    with _ROLLUP_LOCK:
+        _ROLLUP_STATE['data'] = None
+    _bump_sheet_versions(*_OFFLINE_SHEETS)
+
+def _mark_offline(error):
+    # Trả về False khi chưa có bản lưu nào để phục vụ offline.
+    if _offline_spreadsheet() is None:
+        return False
+    with _OFFLINE_LOCK:
+        went_offline = _OFFLINE_STATE['since'] is None
+        if went_offline:
+            _OFFLINE_STATE['since'] = time.time()
+        _OFFLINE_STATE['error'] = str(error)
+    if went_offline:
+        _reset_sheet_state()
+    return True
+
+def _mark_online():
+    with _OFFLINE_LOCK:
+        was_offline = _OFFLINE_STATE['since'] is not None
+        _OFFLINE_STATE['since'] = None
+        _OFFLINE_STATE['error'] = ''
+    if not was_offline:
+        return
+    if _storage_mode() == 'sqlite_mirror':
+        # Bản sao đã nhận các ghi offline: kéo lại từ sheet trước khi đọc/phát lại.
+        store = _get_mirror_store()
+        for name in store.sheet_names():
+            store.mark_dirty(name)
+    _reset_sheet_state()
+
+def _now(tz):
+    pinned = getattr(_OFFLINE_LOCAL, 'now', None)
+    return datetime.now(tz) if pinned is None else pinned.astimezone(tz)
+
+@contextlib.contextmanager
+def _pinned_write(sh, now):
+    previous = (getattr(_OFFLINE_LOCAL, 'pinned', None), getattr(_OFFLINE_LOCAL, 'now', None))
+    _OFFLINE_LOCAL.pinned = (sh,)
+    _OFFLINE_LOCAL.now = now
+    try:
+        yield
+    finally:
+        _OFFLINE_LOCAL.pinned, _OFFLINE_LOCAL.now = previous
+
+def _online_connection():
+    # Cho các thao tác không hỗ trợ offline (sửa giá, hoàn trả).
+    sh = get_connection(allow_offline=False)
+    if sh is None and _is_offline():
+        st.error("Đang mất kết nối Google Sheets: chức năng này tạm dừng cho tới khi có mạng lại.")
+    return sh
+
+def _write_succeeded(result):
+    if isinstance(result, dict):
+        return bool(result.get('ok'))
+    return bool(result)
+
+def _stock_levels(sh, product_ids):
+    ids = [pid for pid in dict.fromkeys(str(p).strip() for p in product_ids) if pid]
+    if not ids:
+        return {}
+    rows = _product_rows(_get_worksheet(sh, "TonKho"), ids)
+    return {pid: (_record_number(rows[pid][1], 'SoLuong') if pid in rows else None) for pid in ids}
+
+def _outbox_when_offline(kind, product_ids=None):
+    """Chạy hàm ghi trên bản lưu khi offline và đưa nó vào outbox để phát lại.
+
+    product_ids(arguments) -> các MaSanPham bị đổi tồn kho, để đối chiếu khi phát lại.
+    Thời điểm thực hiện được giữ cố định (_now) nên lần phát lại tạo đúng mã đơn/ngày.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            sh = get_connection()
+            at = _now(pytz.timezone('Asia/Ho_Chi_Minh'))
+            if not isinstance(sh, SQLiteSpreadsheet):
+                with _pinned_write(sh, at):
+                    return func(*args, **kwargs)
+
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            with _pinned_write(sh, at):
+                expected = _stock_levels(sh, product_ids(bound.arguments)) if product_ids else {}
+                result = func(*args, **kwargs)
+            if _write_succeeded(result):
+                _get_offline_outbox().add(kind, bound.arguments, at.isoformat(), expected)
+            return result
+
+        _OUTBOX_WRITERS[kind] = wrapper
+        return wrapper
+    return decorator
+
+def _start_offline_worker():
+    with _OFFLINE_LOCK:
+        if _OFFLINE_STATE['thread'] is not None:
+            return
+        thread = threading.Thread(target=_offline_worker_loop, daemon=True)
+        _OFFLINE_STATE['thread'] = thread
+        thread.start()
+
+def _offline_worker_loop():
+    wake = _OFFLINE_STATE['wake']
+    while True:
+        try:
+            _offline_tick()
+        except Exception as e:
+            _handle_connection_error(e)
+        wake.wait(timeout=float(st.secrets.get("offline_retry_seconds", 30)))
+        wake.clear()
+
+def _offline_tick():
+    if _is_offline():
+        try:
+            sh = _open_connection()
+        except Exception as e:
+            reset_connection()
+            _OFFLINE_STATE['error'] = str(e)
+            return
+        if sh is None:
+            return
+        _mark_online()
+    else:
+        sh = get_connection(allow_offline=False)
+        if not sh:
+            return
+
+    outbox = _get_offline_outbox()
+    if outbox.pending_count():
+        _replay_offline_outbox(sh, outbox)
+    elif (
+        _storage_mode() != 'sqlite_mirror'
+        and time.time() - _OFFLINE_STATE['snapshot_at'] >= float(st.secrets.get("offline_snapshot_seconds", 300))
+    ):
+        _refresh_offline_snapshot(sh)
+
+@_api_priority(PRIORITY_BACKGROUND)
+def _refresh_offline_snapshot(sh):
+    store = _get_offline_store()
+    for name in _OFFLINE_SHEETS:
+        try:
+            ws = _get_worksheet(sh, name)
+        except gspread.exceptions.WorksheetNotFound:
+            continue
+        # Nếu trong lúc tải đã có ghi offline vào bản lưu thì giữ bản lưu, lần sau tải lại.
+        store.replace(name, _read_sheet_values(ws), store.generation(name))
+    _OFFLINE_STATE['snapshot_at'] = time.time()
+
+@_api_priority(PRIORITY_POS)
+def _replay_offline_outbox(sh, outbox):
+    for write in outbox.pending():
+        if write['started']:
+            # Lần phát lại trước dừng giữa chừng: không biết đã ghi tới đâu, để người dùng kiểm tra.
+            outbox.add_conflict(write['id'], "Bị gián đoạn khi đang ghi lên Google Sheets, cần kiểm tra lại tay.", applied=None)
+            continue
+        expected = write['expected']
+        try:
+            if expected:
+                live = _stock_levels(sh, list(expected))
+            else:
+                _get_worksheet(sh, "TonKho").get("A1")
+                live = {}
+        except Exception as e:
+            # Chưa ghi gì: giữ nguyên trong outbox, thử lại ở lượt sau.
+            _handle_connection_error(e)
+            return False
+        details = [
+            {'MaSanPham': pid, 'expected': qty, 'live': live.get(pid)}
+            for pid, qty in expected.items() if live.get(pid) != qty
+        ]
+
+        outbox.mark_started(write['id'])
+        at = datetime.fromisoformat(write['at'])
+        with _pinned_write(sh, at):
+            result = _OUTBOX_WRITERS[write['kind']](**write['kwargs'])
+        if _write_succeeded(result):
+            if details:
+                outbox.add_conflict(write['id'], "Tồn kho trên Google Sheets đã thay đổi trong lúc offline.", details, applied=True)
+            outbox.mark_done(write['id'])
+            continue
+        if _CONN_STATE['sheet'] is None:
+            # Lỗi kết nối giữa chừng (kết nối đã bị reset): có thể đã ghi một phần.
+            outbox.add_conflict(write['id'], "Mất kết nối khi đang ghi lên Google Sheets, cần kiểm tra lại tay.", details, applied=None)
+            return False
+        reason = result.get('message') if isinstance(result, dict) else None
+        outbox.add_conflict(
+            write['id'],
+            reason or "Google Sheets không nhận thao tác này (vd: không đủ tồn kho).",
+            details,
+            applied=False,
+        )
+    return True
+
+def offline_status():
+    """Trạng thái chế độ offline cho sidebar (mọi giá trị rỗng khi không bật offline_mode)."""
+    if not _offline_enabled():
+        return {'offline': False, 'since': None, 'snapshot_at': None, 'pending': 0, 'conflicts': []}
+    _start_offline_worker()
+    outbox = _get_offline_outbox()
+    return {
+        'offline': _is_offline(),
+        'since': _OFFLINE_STATE['since'],
+        'snapshot_at': _get_offline_store().synced_at("TonKho"),
+        'pending': outbox.pending_count(),
+        'conflicts': outbox.conflicts(),
+    }
+
+def dismiss_offline_conflicts():
+    _get_offline_outbox().dismiss_conflicts()
+
+# --- CACHE THEO SHEET ---
+# Mỗi sheet có một số phiên bản: hàm ghi chỉ tăng phiên bản của những sheet nó đã ghi,
+# loader chỉ tải lại khi phiên bản của sheet mình đổi hoặc quá ttl (để nhận sửa tay
+# trên Google Sheets). Cache dùng chung cho cả process, mỗi sheet chỉ một luồng tải.
+_SHEET_VERSIONS_LOCK = threading.Lock()
+_SHEET_VERSIONS = {}
+_SHEET_CACHE = {}
+
+def _sheet_version(name):
+    with _SHEET_VERSIONS_LOCK:
+        return _SHEET_VERSIONS.get(name, 0)
+
+def _bump_sheet_versions(*names):
+    with _SHEET_VERSIONS_LOCK:
+        for name in names:
+            _SHEET_VERSIONS[name] = _SHEET_VERSIONS.get(name, 0) + 1
+
+def _sheet_cached(sheet, ttl=60):
+    def decorator(loader):
+        state = _SHEET_CACHE.setdefault(sheet, {
+            'lock': threading.Lock(), 'version': None, 'value': None, 'loaded_at': 0.0,
+            'generation': 0, 'revalidating': False, 'loader': loader,
+        })
+
+        @functools.wraps(loader)
+        def wrapper():
+            with state['lock']:
+                version = _sheet_version(sheet)
+                if state['version'] != version or time.monotonic() - state['loaded_at'] >= ttl:
+                    state['value'] = loader()
+                    state['version'] = version
+                    state['loaded_at'] = time.monotonic()
+                # Trả bản sao: UI được phép thêm cột/sửa frame mà không làm bẩn cache.
+                return state['value'].copy()
+        return wrapper
+    return decorator
+
+_REPORT_MEMO_LOCK = threading.Lock()
+_REPORT_MEMO = {}
+
+def report_memo(name, params, sheets, compute, ttl=60):
+    """Kết quả compute() của màn hình báo cáo, dùng lại tới khi params đổi, một trong các
+    sheet đổi phiên bản hoặc quá ttl giây (dữ liệu do process khác ghi)."""
+    key = (params, tuple(_sheet_version(sheet) for sheet in sheets))
+    with _REPORT_MEMO_LOCK:
+        entry = _REPORT_MEMO.get(name)
+        if entry is not None and entry['key'] == key and time.monotonic() - entry['loaded_at'] < ttl:
+            return entry['value']
+    value = compute()
+    with _REPORT_MEMO_LOCK:
+        _REPORT_MEMO[name] = {'key': key, 'loaded_at': time.monotonic(), 'value': value}
+    return value
+
+def _patch_sheet_cache(sheet, patch):
+    """Sửa thẳng bản cache còn mới bằng patch(frame) -> bool rồi kiểm tra lại ở nền.
+
+    Không patch được (chưa có cache, cache đã cũ, patch trả False/lỗi) thì tăng phiên bản
+    sheet để lần đọc sau tải lại như bình thường.
+    """
+    state = _SHEET_CACHE.get(sheet)
+    patched = False
+    if state is not None:
+        with state['lock']:
+            if state['value'] is not None and state['version'] == _sheet_version(sheet):
+                try:
+                    patched = bool(patch(state['value']))
+                except Exception:
+                    patched = False
+                if patched:
+                    state['generation'] += 1
+    if not patched:
+        _bump_sheet_versions(sheet)
+        return False
+    _schedule_sheet_revalidation(sheet)
+    return True
+
+def _schedule_sheet_revalidation(sheet):
+    state = _SHEET_CACHE[sheet]
+    with state['lock']:
+        if state['revalidating']:
+            return
+        state['revalidating'] = True
+    threading.Thread(target=_revalidate_sheet_cache, args=(sheet,), daemon=True).start()
+
+@_api_priority(PRIORITY_BACKGROUND)
+def _revalidate_sheet_cache(sheet):
+    # Tải lại ngoài khóa để UI vẫn đọc được bản đã patch; chỉ thay bản cache nếu trong lúc
+    # tải không có patch/ghi mới nào, nếu có thì tải lại lần nữa.
+    state = _SHEET_CACHE[sheet]
+    while True:
+        with state['lock']:
+            generation = state['generation']
+            version = state['version']
+        try:
+            value = state['loader']()
+        except Exception:
+            value = None
+        with state['lock']:
+            if value is None or value.empty or state['version'] != version or version != _sheet_version(sheet):
+                state['revalidating'] = False
+                return
+            if state['generation'] == generation:
+                state['value'] = value
+                state['loaded_at'] = time.monotonic()
+                state['revalidating'] = False
+                return
+
 # --- HAM HELPER: DOC DU LIEU AN TOAN ---
-def safe_get_data(worksheet):
+def _read_sheet_values(worksheet):
     try:
+        # Ưu tiên đọc toàn bộ cột để không bỏ sót các cột nằm ngoài A:Z (vd: AA, AB...)
+        return worksheet.get_all_values(value_render_option='UNFORMATTED_VALUE')
+    except TypeError:
+        # Fallback nếu version gspread cũ chưa hỗ trợ value_render_option cho get_all_values
+        return worksheet.get_all_values()
+    except Exception:
         try:
-            # Ưu tiên đọc toàn bộ cột để không bỏ sót các cột nằm ngoài A:Z (vd: AA, AB...)
-            data = worksheet.get_all_values(value_render_option='UNFORMATTED_VALUE')
-        except TypeError:
-            # Fallback nếu version gspread cũ chưa hỗ trợ value_render_option cho get_all_values
-            data = worksheet.get_all_values()
+            return worksheet.get("A:ZZ", value_render_option='UNFORMATTED_VALUE')
         except Exception:
-            try:
-                data = worksheet.get("A:ZZ", value_render_option='UNFORMATTED_VALUE')
-            except Exception:
-                # Fallback nếu version gspread cũ
-                data = worksheet.get_all_values()
-        if not data: return pd.DataFrame()
-        
-        headers = data[0]
-        rows = data[1:]
-        
-        df = pd.DataFrame(rows)
-        
-        seen = {}
-        clean_headers = []
-        for i, h in enumerate(headers):
-            h = str(h).strip()
-            if not h: h = f"Col_{i}"
-            if h in seen:
-                seen[h] += 1
-                h = f"{h}_{seen[h]}"
-            else:
-                seen[h] = 0
-            clean_headers.append(h)
-            
-        if len(df.columns) == len(clean_headers):
-            df.columns = clean_headers
+            # Fallback nếu version gspread cũ
+            return worksheet.get_all_values()
+
+def _values_to_frame(data):
+    if not data: return pd.DataFrame()
+
+    headers = data[0]
+    rows = data[1:]
+
+    df = pd.DataFrame(rows)
+
+    seen = {}
+    clean_headers = []
+    for i, h in enumerate(headers):
+        h = str(h).strip()
+        if not h: h = f"Col_{i}"
+        if h in seen:
+            seen[h] += 1
+            h = f"{h}_{seen[h]}"
         else:
-            df = df.iloc[:, :len(clean_headers)]
-            df.columns = clean_headers[:df.shape[1]]
-            
-        return df
+            seen[h] = 0
+        clean_headers.append(h)
+
+    if len(df.columns) == len(clean_headers):
+        df.columns = clean_headers
+    else:
+        df = df.iloc[:, :len(clean_headers)]
+        df.columns = clean_headers[:df.shape[1]]
+
+    return df
+
+def safe_get_data(worksheet):
+    try:
+        return _values_to_frame(_read_sheet_values(worksheet))
     except Exception as e:
+        _handle_connection_error(e)
         st.error(f"Lỗi đọc dữ liệu: {e}")
         return pd.DataFrame()
 
 # --- 1. TAI TON KHO (CLEAN PRICE KHI LOAD) ---
-@st.cache_data(ttl=60)
-def load_inventory():
+@_sheet_cached("TonKho", ttl=60)
+def _load_inventory_sheet():
     sh = get_connection()
     if sh:
         try:
-            wks = sh.worksheet("TonKho")
+            wks = _get_worksheet(sh, "TonKho")
             df = safe_get_data(wks)
             
             # Không dùng clean_to_float; dùng to_numeric tối thiểu để tránh lỗi tính toán
@@ -165,60 +828,566 @@ def load_inventory():
             for col in numeric_cols:
                 if col in df.columns:
                     df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
+            # Mỗi lần tải thật (không lấy từ cache) là một phiên bản tồn kho mới;
+            # các chỉ mục dựng từ tồn kho dùng số này để biết khi nào cần dựng lại.
+            df.attrs['revision'] = next(_INVENTORY_REVISIONS)
             return df
-        except:
+        except Exception as e:
+            _handle_connection_error(e)
             return pd.DataFrame()
     return pd.DataFrame()
 
+_INVENTORY_REVISIONS = itertools.count(1)
+
+def load_inventory():
+    """Tồn kho trên sheet, trừ đi các đơn đã nhận vào nhật ký thanh toán mà luồng nền chưa trừ kho."""
+    df = _load_inventory_sheet()
+    pending = _get_checkout_journal().pending_quantities() if _checkout_mode() == 'journal' else {}
+    if not pending or df.empty or 'MaSanPham' not in df.columns or 'SoLuong' not in df.columns:
+        return df
+    ids = product_ids(df)
+    first_pos = dict(zip(ids[::-1], range(len(ids) - 1, -1, -1)))
+    col = df.columns.get_loc('SoLuong')
+    for pid, qty in pending.items():
+        if pid in first_pos:
+            df.iat[first_pos[pid], col] -= qty
+    # Số tồn hiển thị đổi theo nhật ký: nhãn chọn sản phẩm phải tính lại.
+    df.attrs['revision'] = (df.attrs.get('revision'), tuple(sorted(pending.items())))
+    return df
+
+# --- 1a. CHI MUC TIM KIEM SAN PHAM ---
+_SEARCH_INDEX_LOCK = threading.Lock()
+_SEARCH_INDEX = {'revision': None, 'index': None}
+_PRODUCT_OPTIONS = {'current': None}
+
+def product_ids(df_inv):
+    return df_inv['MaSanPham'].fillna('').astype(str).str.strip()
+
+def get_product_search_index(df_inv):
+    """Chỉ mục tìm kiếm cho df_inv; dựng lại khi danh mục (mã/tên) thay đổi."""
+    revision = df_inv.attrs.get('revision')
+    with _SEARCH_INDEX_LOCK:
+        index = _SEARCH_INDEX['index']
+        if index is not None and revision is not None and _SEARCH_INDEX['revision'] == revision:
+            return index
+    ids = product_ids(df_inv).tolist()
+    names = df_inv['TenSanPham'].fillna('').astype(str).str.strip().tolist()
+    # Bán hàng chỉ đổi số lượng tồn: danh mục giống hệt thì giữ chỉ mục cũ.
+    if index is None or not index.same_catalog(ids, names):
+        index = ProductSearchIndex(ids, names)
+    with _SEARCH_INDEX_LOCK:
+        _SEARCH_INDEX['revision'] = revision
+        _SEARCH_INDEX['index'] = index
+    return index
+
+def get_product_options(df_inv):
+    """Nhãn selectbox và vị trí dòng theo MaSanPham, tính một lần cho mỗi phiên bản tồn kho."""
+    revision = df_inv.attrs.get('revision')
+    with _SEARCH_INDEX_LOCK:
+        current = _PRODUCT_OPTIONS['current']
+        if current is not None and revision is not None and current['revision'] == revision:
+            return current
+    ids = product_ids(df_inv)
+    qty = pd.to_numeric(df_inv['SoLuong'], errors='coerce').fillna(0).astype(int).astype(str)
+    labels = (
+        df_inv['TenSanPham'].fillna('').astype(str).str.strip()
+        + ' | Mã: ' + ids
+        + ' | Tồn: ' + qty + ' '
+        + df_inv['DonVi'].fillna('').astype(str).str.strip()
+    )
+    # Mã trùng: giữ dòng đầu tiên như các hàm ghi.
+    first = ~ids.duplicated()
+    options = {
+        'revision': revision,
+        'labels': dict(zip(ids[first], labels[first])),
+        'positions': dict(zip(ids[first], first.to_numpy().nonzero()[0].tolist())),
+    }
+    with _SEARCH_INDEX_LOCK:
+        _PRODUCT_OPTIONS['current'] = options
+    return options
+
+def search_products(df_inv, query, limit=50):
+    """Các dòng df_inv khớp query (không phân biệt dấu), xếp theo mức độ khớp."""
+    if df_inv.empty or not str(query).strip():
+        return df_inv
+    positions = get_product_search_index(df_inv).search(query, limit=limit)
+    return df_inv.iloc[positions]
+
+# --- 1b. CHI MUC MaSanPham -> DONG TonKho ---
+# Các hàm ghi tra dòng sản phẩm qua chỉ mục dùng chung này thay vì quét cột MaSanPham
+# hoặc tải lại cả TonKho. Giá trị của các dòng cần dùng được đọc lại trong một batch_get
+# và kiểm tra mã; nếu mã lệch (sheet bị sửa tay) thì dựng lại chỉ mục.
+_PRODUCT_INDEX_LOCK = threading.RLock()
+_PRODUCT_INDEX = {'rows': None, 'header': [], 'loaded_at': 0.0}
+
+def _invalidate_product_index():
+    with _PRODUCT_INDEX_LOCK:
+        _PRODUCT_INDEX['rows'] = None
+
+def _build_product_index(ws):
+    header_part, id_part = ws.batch_get(['1:1', 'A:A'], value_render_option='UNFORMATTED_VALUE')
+    header = [str(h).strip() for h in (header_part[0] if header_part else [])]
+    id_col = header.index('MaSanPham') + 1 if 'MaSanPham' in header else 1
+    if id_col == 1:
+        ids = [row[0] if row else '' for row in id_part[1:]]
+    else:
+        ids = ws.col_values(id_col, value_render_option='UNFORMATTED_VALUE')[1:]
+    _PRODUCT_INDEX['rows'] = build_row_index(ids, first_row=2)
+    _PRODUCT_INDEX['header'] = header
+    _PRODUCT_INDEX['loaded_at'] = time.monotonic()
+
+def _index_product_row(product_id, row):
+    with _PRODUCT_INDEX_LOCK:
+        if _PRODUCT_INDEX['rows'] is not None:
+            _PRODUCT_INDEX['rows'].setdefault(str(product_id).strip(), row)
+
+def _product_rows(ws, product_ids):
+    """Đọc các dòng TonKho của product_ids; trả về {MaSanPham: (dòng trên sheet, {cột: giá trị})}.
+
+    Mã không có trong TonKho không xuất hiện trong kết quả.
+    """
+    ids = list(dict.fromkeys(str(pid).strip() for pid in product_ids))
+    rebuilt = False
+    while True:
+        with _PRODUCT_INDEX_LOCK:
+            state = _PRODUCT_INDEX
+            if state['rows'] is None or time.monotonic() - state['loaded_at'] >= _SALES_FULL_RELOAD_SECONDS:
+                _build_product_index(ws)
+                rebuilt = True
+            elif any(pid not in state['rows'] for pid in ids):
+                # Sản phẩm có thể vừa được thêm tay vào sheet.
+                _build_product_index(ws)
+                rebuilt = True
+            header = list(state['header'])
+            found = {pid: state['rows'][pid] for pid in ids if pid in state['rows']}
+        if not found:
+            return {}
+
+        end_col = column_letter(max(len(header), 1))
+        parts = ws.batch_get(
+            [f"A{row}:{end_col}{row}" for row in found.values()],
+            value_render_option='UNFORMATTED_VALUE'
+        )
+        result = {}
+        for (pid, row), part in zip(found.items(), parts):
+            cells = list(part[0]) if part else []
+            record = dict(zip(header, cells + [''] * (len(header) - len(cells))))
+            if str(record.get('MaSanPham', '')).strip() != pid:
+                break
+            result[pid] = (row, record)
+        else:
+            return result
+
+        if rebuilt:
+            raise RuntimeError("TonKho vừa thay đổi trong lúc xử lý, vui lòng thử lại.")
+        _invalidate_product_index()
+
+def _record_number(record, column):
+    value = pd.to_numeric(record.get(column, ''), errors='coerce')
+    return 0.0 if pd.isna(value) else float(value)
+
+def _patch_inventory_cache(cells=None, new_rows=None, products=None):
+    """Ghi lại vào tồn kho đang cache đúng các giá trị vừa ghi lên TonKho.
+
+    cells: {dòng sheet: {cột: giá trị}}; new_rows: {dòng sheet: [giá trị theo thứ tự cột]};
+    products: {MaSanPham: {cột: giá trị}} khi chưa biết dòng trên sheet.
+    """
+    cells = dict(cells or {})
+    new_rows = new_rows or {}
+
+    def patch(df):
+        if products:
+            ids = product_ids(df)
+            first_pos = dict(zip(ids[::-1], range(len(ids) - 1, -1, -1)))
+            for pid, values in products.items():
+                if pid not in first_pos:
+                    return False
+                cells[first_pos[pid] + 2] = values
+        for sheet_row, values in cells.items():
+            pos = sheet_row - 2
+            if pos < 0 or pos >= len(df) or any(col not in df.columns for col in values):
+                return False
+            for col, value in values.items():
+                try:
+                    df.iat[pos, df.columns.get_loc(col)] = value
+                except TypeError:
+                    # vd. số lẻ vào cột int64: đổi kiểu cột, chuẩn hóa lại ở dưới.
+                    df[col] = df[col].astype(object)
+                    df.iat[pos, df.columns.get_loc(col)] = value
+        for sheet_row in sorted(new_rows):
+            if sheet_row - 2 != len(df):
+                return False
+            row = list(new_rows[sheet_row])[:len(df.columns)]
+            row += [''] * (len(df.columns) - len(row))
+            df.loc[len(df)] = row
+        for col in ['SoLuong', 'GiaNhap', 'GiaBan']:
+            if col in df.columns and not pd.api.types.is_numeric_dtype(df[col]):
+                df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
+        df.attrs['revision'] = next(_INVENTORY_REVISIONS)
+        return True
+
+    return _patch_sheet_cache("TonKho", patch)
+
 # --- 2. TAI LICH SU BAN (CLEAN PRICE KHI LOAD) ---
+SALES_COLUMNS = [
+    'NgayBan', 'MaHoaDon', 'MaSanPham', 'TenSanPham',
+    'DonVi', 'SoLuong', 'GiaBan', 'ThanhTien',
+    'GiaVonLucBan', 'LoiNhuan', 'HinhThucTT'
+]
+# Cache lịch sử bán dùng chung cho cả process: chỉ tải phần đuôi mới ghi thêm,
+# tải lại toàn bộ khi có dòng bị xóa/đổi header hoặc sau _SALES_FULL_RELOAD_SECONDS
+# (để nhận các sửa tay trên sheet). Dòng hoàn trả (SoLuong âm) được trừ thẳng vào
+# dòng bán gốc nên mọi báo cáo đọc từ cache đã là số sau hoàn trả.
+_SALES_TAIL_CHECK_SECONDS = 5
+_SALES_FULL_RELOAD_SECONDS = 600
+_SALES_CACHE_LOCK = threading.Lock()
+_SALES_CACHE = {
+    'df': None,
+    'header': None,
+    'row_count': 0,
+    'anchor': None,
+    # Dấu vân tay các dòng đã cache (rows_fingerprint) để lần tải lại toàn bộ biết có dòng cũ bị sửa tay.
+    'fingerprint': 0,
+    'loaded_at': 0.0,
+    'checked_at': 0.0,
+    'stale': False,
+    # Các tháng (năm, tháng) có dòng mới chưa ghi ra Parquet; None = cần kiểm tra mọi tháng.
+    'dirty_months': None,
+    # Bảng TongHopNgay cần đối chiếu lại với lịch sử bán: lần tải lại toàn bộ thấy sheet
+    # khác bản cache (dòng bị xóa/sửa tay, đổi header) hoặc ghi tổng hợp lỗi/phát lại đơn.
+    'rollup_unverified': False,
+}
+
+def _parse_sales_frame(df):
+    if df.empty:
+        return pd.DataFrame(columns=SALES_COLUMNS)
+
+    df.columns = [str(c).strip() for c in df.columns]
+    for col in SALES_COLUMNS:
+        if col not in df.columns:
+            df[col] = ''
+    df = df[SALES_COLUMNS].copy()
+
+    if 'NgayBan' in df.columns:
+        df['NgayBan'] = _parse_sheet_datetime_series(df['NgayBan'])
+
+    # Không dùng clean_to_float; dùng to_numeric tối thiểu để tránh lỗi tính toán
+    numeric_cols = ['SoLuong', 'GiaBan', 'ThanhTien', 'GiaVonLucBan', 'LoiNhuan']
+    for col in numeric_cols:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
+
+    df['MaHoaDon'] = df['MaHoaDon'].apply(_normalize_id_text)
+    df['HinhThucTT'] = df['HinhThucTT'].astype(str).str.strip().apply(_normalize_payment_method)
+    return df
+
+def _mark_sales_cache_stale():
+    # Có dòng mới được ghi: lần tải sau kiểm tra phần đuôi ngay, không chờ hết chu kỳ.
+    with _SALES_CACHE_LOCK:
+        _SALES_CACHE['stale'] = True
+
+def _mark_rollup_unverified():
+    with _SALES_CACHE_LOCK:
+        _SALES_CACHE['rollup_unverified'] = True
+
+def _invalidate_sales_cache():
+    with _SALES_CACHE_LOCK:
+        _SALES_CACHE['df'] = None
+
+def _refresh_sales_cache(wks):
+    cache = _SALES_CACHE
+    now = time.monotonic()
+    if cache['df'] is not None:
+        if not cache['stale'] and now - cache['checked_at'] < _SALES_TAIL_CHECK_SECONDS:
+            return cache['df']
+        if now - cache['loaded_at'] < _SALES_FULL_RELOAD_SECONDS:
+            new_rows = read_sheet_tail(wks, cache['row_count'], cache['anchor'], cache['header'])
+            if new_rows is not None:
+                if new_rows:
+                    df_new = _parse_sales_frame(_values_to_frame([cache['header']] + new_rows))
+                    df_all = pd.concat([cache['df'], df_new], ignore_index=True)
+                    returned_months = set()
+                    if (df_new['SoLuong'] < 0).any():
+                        # Dòng hoàn trả mới sửa lại các dòng bán cũ, có thể thuộc tháng trước.
+                        df_all, returned_months = net_sales_returns(df_all)
+                    cache['df'] = df_all
+                    if cache['dirty_months'] is not None:
+                        new_dates = df_new['NgayBan']
+                        cache['dirty_months'].update(zip(
+                            new_dates.dt.year.fillna(0).astype(int),
+                            new_dates.dt.month.fillna(0).astype(int)
+                        ))
+                        cache['dirty_months'].update(returned_months)
+                    cache['row_count'] += len(new_rows)
+                    cache['anchor'] = new_rows[-1]
+                    cache['fingerprint'] += rows_fingerprint(new_rows, len(cache['header']))
+                cache['checked_at'] = now
+                cache['stale'] = False
+                return cache['df']
+
+    data = _read_sheet_values(wks)
+    df, _ = net_sales_returns(_parse_sales_frame(_values_to_frame(data)))
+    cache['dirty_months'] = None
+    # Lần tải lại toàn bộ khác bản cache ở ngoài phần dòng mới nối thêm (header đổi, dòng bị
+    # xóa hay sửa tay) thì bảng tổng hợp theo ngày cũng có thể đã sai.
+    width = len(data[0]) if data else 0
+    known = max(min(cache['row_count'], len(data)), 1) if cache['header'] is not None else 1
+    known_fingerprint = rows_fingerprint(data[1:known], width)
+    if cache['header'] is not None and (
+        not data or list(data[0]) != cache['header'] or len(data) < cache['row_count']
+        or known_fingerprint != cache['fingerprint']
+    ):
+        cache['rollup_unverified'] = True
+    if data:
+        cache['df'] = df
+        cache['fingerprint'] = known_fingerprint + rows_fingerprint(data[known:], width)
+        cache['header'] = list(data[0])
+        cache['row_count'] = len(data)
+        cache['anchor'] = list(data[-1])
+        cache['loaded_at'] = now
+        cache['checked_at'] = now
+        cache['stale'] = False
+    else:
+        cache['df'] = None
+    return df
+
+@_api_priority(PRIORITY_REPORT)
 def load_sales_history():
     sh = get_connection()
     if sh:
         try:
-            wks = sh.worksheet("LichSuBan")
-            COL_NAMES = [
-                'NgayBan', 'MaHoaDon', 'MaSanPham', 'TenSanPham',
-                'DonVi', 'SoLuong', 'GiaBan', 'ThanhTien', 
-                'GiaVonLucBan', 'LoiNhuan', 'HinhThucTT'
-            ]
-
-            df = safe_get_data(wks)
-            if df.empty:
-                return pd.DataFrame(columns=COL_NAMES)
-
-            df.columns = [str(c).strip() for c in df.columns]
-            for col in COL_NAMES:
-                if col not in df.columns:
-                    df[col] = ''
-            df = df[COL_NAMES].copy()
-
-            if 'NgayBan' in df.columns:
-                df['NgayBan'] = _parse_sheet_datetime_series(df['NgayBan'])
-                
-            # Không dùng clean_to_float; dùng to_numeric tối thiểu để tránh lỗi tính toán
-            numeric_cols = ['SoLuong', 'GiaBan', 'ThanhTien', 'GiaVonLucBan', 'LoiNhuan']
-            for col in numeric_cols:
-                if col in df.columns:
-                    df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
-
-            df['MaHoaDon'] = df['MaHoaDon'].apply(_normalize_id_text)
-            df['HinhThucTT'] = df['HinhThucTT'].astype(str).str.strip().apply(_normalize_payment_method)
-            
-            return df
+            wks = _get_worksheet(sh, "LichSuBan")
+            with _SALES_CACHE_LOCK:
+                df = _refresh_sales_cache(wks)
+            # Trả bản sao vì các màn hình có gán thêm cột vào DataFrame.
+            return df.copy()
         except Exception as e:
+            _handle_connection_error(e)
             st.warning(f"Lỗi tải lịch sử: {e}")
             return pd.DataFrame()
     return pd.DataFrame()
 
-# --- 2b. TAI DU LIEU CONG NO ---
-@st.cache_data(ttl=60)
+# --- 2a. TRUY VAN BAO CAO THEO KHOANG NGAY (PARQUET) ---
+# Lịch sử bán được chụp ra Parquet chia theo tháng; báo cáo chỉ đọc các tháng và cột cần dùng.
+# Không có pyarrow thì lọc trực tiếp trên cache lịch sử bán trong bộ nhớ.
+def _analytics_dir():
+    return st.secrets.get("analytics_dir", os.path.join("analytics", "sales"))
+
+def _sync_sales_snapshot(df_all):
+    dirty = _SALES_CACHE['dirty_months']
+    if dirty is not None and not dirty:
+        return True
+    try:
+        write_sales_snapshot(df_all, _analytics_dir(), months=dirty)
+        _SALES_CACHE['dirty_months'] = set()
+        return True
+    except Exception as e:
+        st.warning(f"Không ghi được dữ liệu phân tích Parquet: {e}")
+        return False
+
+@_api_priority(PRIORITY_REPORT)
+def load_sales_period(start=None, end=None, columns=None):
+    sh = get_connection()
+    empty = pd.DataFrame(columns=columns if columns is not None else SALES_COLUMNS)
+    if not sh:
+        return empty
+    try:
+        wks = _get_worksheet(sh, "LichSuBan")
+        with _SALES_CACHE_LOCK:
+            df_all = _refresh_sales_cache(wks)
+            use_parquet = parquet_available() and _sync_sales_snapshot(df_all)
+            if not use_parquet:
+                df = filter_by_date(df_all, start, end)
+                return (df[list(columns)] if columns is not None else df).reset_index(drop=True).copy()
+        return read_sales(_analytics_dir(), start, end, columns)
+    except Exception as e:
+        _handle_connection_error(e)
+        st.warning(f"Lỗi tải dữ liệu báo cáo: {e}")
+        return empty
+
+# --- 2b. BANG TONG HOP DOANH THU THEO NGAY (TongHopNgay) ---
+# Mỗi dòng là tổng doanh thu/lợi nhuận/số đơn/số lượng của một ngày theo hình thức thanh toán.
+# process_checkout/process_return cộng dồn trực tiếp; bản trong bộ nhớ là bản làm việc,
+# sheet TongHopNgay là bản lưu để khởi động lại không phải tính lại từ đầu.
+ROLLUP_SHEET = "TongHopNgay"
+_ROLLUP_LOCK = threading.Lock()
+_ROLLUP_STATE = {'data': None, 'positions': {}, 'loaded_at': 0.0}
+
+def _get_rollup_worksheet(sh):
+    try:
+        return _get_worksheet(sh, ROLLUP_SHEET)
+    except gspread.exceptions.WorksheetNotFound:
+        _sheets_call('add_worksheet', sh.add_worksheet, title=ROLLUP_SHEET, rows=1000, cols=len(ROLLUP_COLUMNS))
+        return _get_worksheet(sh, ROLLUP_SHEET)
+
+def _ensure_rollup_loaded(sh):
+    state = _ROLLUP_STATE
+    if state['data'] is not None and time.monotonic() - state['loaded_at'] < _SALES_FULL_RELOAD_SECONDS:
+        return
+    rollup, positions = rows_to_rollup(_read_sheet_values(_get_rollup_worksheet(sh)))
+    state['data'] = rollup
+    state['positions'] = positions
+    state['loaded_at'] = time.monotonic()
+
+def _write_rollup_buckets(sh, changed):
+    if not changed:
+        return
+    ws = _get_rollup_worksheet(sh)
+    positions = _ROLLUP_STATE['positions']
+    data = []
+    if not positions:
+        data.append({'range': f"A1:{rowcol_to_a1(1, len(ROLLUP_COLUMNS))}", 'values': [ROLLUP_COLUMNS]})
+    next_row = max(positions.values(), default=1) + 1
+    for key in sorted(changed):
+        if key not in positions:
+            positions[key] = next_row
+            next_row += 1
+        row = positions[key]
+        data.append({
+            'range': f"{rowcol_to_a1(row, 1)}:{rowcol_to_a1(row, len(ROLLUP_COLUMNS))}",
+            'values': [rollup_to_row(key, changed[key])],
+        })
+    ensure_worksheet_capacity(ws, next_row - 1, len(ROLLUP_COLUMNS))
+    ws.batch_update(data, value_input_option='RAW')
+    # Biểu đồ báo cáo nhớ theo phiên bản TongHopNgay (report_memo): đối chiếu lại phải làm mới chúng.
+    _bump_sheet_versions(ROLLUP_SHEET)
+
+def _record_rollup(sh, deltas):
+    # deltas: [(ngay 'YYYY-MM-DD', hinh_thuc_tt, doanh_thu, loi_nhuan, so_don, so_luong)]
+    # Lỗi ở đây không được làm hỏng giao dịch đã ghi: chỉ đánh dấu để đối chiếu lại.
+    deltas = [d for d in deltas if d[0]]
+    if not deltas:
+        return
+    try:
+        with _ROLLUP_LOCK:
+            _ensure_rollup_loaded(sh)
+            if not _ROLLUP_STATE['positions']:
+                # Chưa có bảng tổng hợp: lần tải đầu tiên sẽ dựng lại từ toàn bộ lịch sử.
+                return
+            changed_keys = {apply_delta(_ROLLUP_STATE['data'], *delta) for delta in deltas}
+            _write_rollup_buckets(sh, {k: _ROLLUP_STATE['data'][k] for k in changed_keys})
+    except Exception as e:
+        _handle_connection_error(e)
+        with _ROLLUP_LOCK:
+            _ROLLUP_STATE['data'] = None
+        _mark_rollup_unverified()
+
+def _reconcile_daily_rollup(sh):
+    # Thứ tự khóa: lịch sử bán trước, bảng tổng hợp sau (giống các mutator không giữ cả hai).
+    with _SALES_CACHE_LOCK:
+        df_all = _refresh_sales_cache(_get_worksheet(sh, "LichSuBan"))
+        target = rollup_from_sales(df_all)
+        with _ROLLUP_LOCK:
+            _ensure_rollup_loaded(sh)
+            changed = diff_rollups(_ROLLUP_STATE['data'], target)
+            _write_rollup_buckets(sh, changed)
+            _ROLLUP_STATE['data'] = target
+        _SALES_CACHE['rollup_unverified'] = False
+
+@_api_priority(PRIORITY_REPORT)
+def load_daily_rollup():
+    sh = get_connection()
+    if not sh:
+        return rollup_frame({})
+    try:
+        with _ROLLUP_LOCK:
+            _ensure_rollup_loaded(sh)
+            missing = not _ROLLUP_STATE['positions']
+        with _SALES_CACHE_LOCK:
+            unverified = _SALES_CACHE['rollup_unverified']
+        if missing or unverified:
+            _reconcile_daily_rollup(sh)
+        with _ROLLUP_LOCK:
+            return rollup_frame(_ROLLUP_STATE['data'])
+    except Exception as e:
+        _handle_connection_error(e)
+        with _ROLLUP_LOCK:
+            _ROLLUP_STATE['data'] = None
+        st.warning(f"Lỗi tải bảng tổng hợp doanh thu: {e}")
+        return rollup_frame({})
+
+# --- 2c. TAI DU LIEU CONG NO ---
+# Chỉ mục phiếu còn nợ (DebtIndex): MaPhieuNo -> các dòng CongNo của phiếu. Dựng một lần
+# từ toàn sheet, sau đó chỉ đọc phần đuôi như cache LichSuBan; ghi nợ và thu nợ cập nhật
+# thẳng vào chỉ mục, phiếu trả đủ thì rời chỉ mục. Màn hình công nợ và settle_debt vì vậy
+# chỉ phụ thuộc số phiếu còn mở chứ không phụ thuộc toàn bộ lịch sử công nợ.
+_DEBT_INDEX_LOCK = threading.RLock()
+_DEBT_INDEX = {'index': None, 'loaded_at': 0.0, 'checked_at': 0.0}
+
+def _invalidate_debt_index():
+    with _DEBT_INDEX_LOCK:
+        _DEBT_INDEX['index'] = None
+
+def _debt_index(ws, refresh=False):
+    with _DEBT_INDEX_LOCK:
+        state = _DEBT_INDEX
+        index = state['index']
+        now = time.monotonic()
+        if index is not None and now - state['loaded_at'] < _SALES_FULL_RELOAD_SECONDS:
+            if not refresh and now - state['checked_at'] < _SALES_TAIL_CHECK_SECONDS:
+                return index
+            new_rows = read_sheet_tail(ws, index.row_count, index.anchor, index.header)
+            if new_rows is not None:
+                index.add_rows(new_rows, index.row_count + 1)
+                state['checked_at'] = now
+                return index
+        index = DebtIndex.from_values(_read_sheet_values(ws))
+        state.update(index=index, loaded_at=now, checked_at=now)
+        return index
+
+def _index_debt_rows(headers, rows, first_row):
+    # Gọi sau khi ghi phiếu nợ mới; không biết dòng (hoặc header vừa đổi) thì để lần sau đọc lại.
+    with _DEBT_INDEX_LOCK:
+        index = _DEBT_INDEX['index']
+        if index is None:
+            return
+        if index.header != [str(h).strip() for h in headers]:
+            _DEBT_INDEX['index'] = None
+        elif first_row == index.row_count + 1:
+            index.add_rows(rows, first_row)
+        else:
+            _DEBT_INDEX['checked_at'] = 0.0
+
+def _open_slip_rows(ws, slip_key):
+    """(chỉ mục, [(dòng, giá trị)]) của phiếu còn nợ, đọc lại từ sheet trong một batch_get.
+
+    Chỉ mục lệch với sheet (header đổi hoặc dòng không còn thuộc phiếu) thì dựng lại rồi thử
+    thêm một lần. Phiếu không có trong chỉ mục: đã trả đủ hoặc không tồn tại -> [].
+    """
+    with _DEBT_INDEX_LOCK:
+        for attempt in range(2):
+            index = _debt_index(ws)
+            sheet_rows = [row for row, _ in index.slip_rows(slip_key)]
+            if not sheet_rows:
+                # Phiếu có thể vừa được ghi từ process khác sau lần đọc đuôi gần nhất.
+                index = _debt_index(ws, refresh=True)
+                sheet_rows = [row for row, _ in index.slip_rows(slip_key)]
+            if not sheet_rows:
+                return index, []
+            end_col = column_letter(max(len(index.header), 1))
+            parts = ws.batch_get(
+                [f"A1:{end_col}1"] + [f"A{row}:{end_col}{row}" for row in sheet_rows],
+                value_render_option='UNFORMATTED_VALUE'
+            )
+            header = [str(h).strip() for h in (parts[0][0] if parts[0] else [])]
+            values = [list(part[0]) if part else [] for part in parts[1:]]
+            if header == index.header and all(index.slip_id(row) == slip_key for row in values):
+                return index, list(zip(sheet_rows, values))
+            _invalidate_debt_index()
+        return index, []
+
+@_sheet_cached("CongNo", ttl=60)
 def load_debt_records():
     sh = get_connection()
     COL_NAMES = ['TenKH', 'Ngay', 'TenSanPham', 'SoLuong', 'ThanhTien']
     if sh:
         try:
-            wks = sh.worksheet("CongNo")
-            df = safe_get_data(wks)
+            wks = _get_worksheet(sh, "CongNo")
+            with _DEBT_INDEX_LOCK:
+                index = _debt_index(wks)
+                width = len(index.header)
+                open_rows = [list(row) + [''] * (width - len(row)) for _, row in index.open_rows()]
+                df = _values_to_frame([index.header] + open_rows) if width else pd.DataFrame()
 
             if df.empty:
                 return pd.DataFrame(columns=COL_NAMES + ['MaPhieuNo', 'TienDaTra', 'TienConLai', 'NgayRaw', 'NgayParsed'])
@@ -264,90 +1433,96 @@ def load_debt_records():
             df['TienConLai'] = raw_remaining.fillna(calc_remaining)
             df['TienConLai'] = df['TienConLai'].clip(lower=0)
 
-            # Chỉ giữ các phiếu còn dư nợ (>0), nhưng giữ toàn bộ dòng của phiếu đó để xem chi tiết.
-            open_debt_ids = (
-                df.groupby('MaPhieuNo', as_index=False)['TienConLai']
-                .sum()
-                .query('TienConLai > 0')['MaPhieuNo']
-                .astype(str)
-                .tolist()
-            )
-            if open_debt_ids:
-                df = df[df['MaPhieuNo'].astype(str).isin(open_debt_ids)]
-            else:
-                df = df.iloc[0:0]
-
+            # Chỉ mục chỉ chứa các phiếu còn dư nợ (>0), kèm toàn bộ dòng của phiếu để xem chi tiết.
             df = df[(df['TenKH'] != '') & (df['TenSanPham'] != '')]
             return df.reset_index(drop=True)
         except Exception as e:
+            _handle_connection_error(e)
             st.warning(f"Lỗi tải công nợ: {e}")
             return pd.DataFrame(columns=COL_NAMES + ['MaPhieuNo', 'TienDaTra', 'TienConLai', 'NgayRaw', 'NgayParsed'])
     return pd.DataFrame(columns=COL_NAMES + ['MaPhieuNo', 'TienDaTra', 'TienConLai', 'NgayRaw', 'NgayParsed'])
 
+DEBT_CUSTOMER_COLUMNS = ['TenKH', 'TongNo', 'DaTra', 'ConNo', 'SoPhieu', 'NgayCuNhat']
+
+def load_debt_customers():
+    # Tổng công nợ theo khách (chỉ các phiếu còn nợ) được chỉ mục giữ sẵn và cập nhật theo từng
+    # lần ghi nợ/thu nợ, nên không cần groupby hay cache riêng (cache CongNo là của load_debt_records).
+    sh = get_connection()
+    if sh:
+        try:
+            wks = _get_worksheet(sh, "CongNo")
+            with _DEBT_INDEX_LOCK:
+                summaries = _debt_index(wks).customer_summaries()
+            df = pd.DataFrame([s for s in summaries if s['TenKH']], columns=DEBT_CUSTOMER_COLUMNS)
+            df['NgayCuNhat'] = pd.to_datetime(df['NgayCuNhat'], errors='coerce')
+            return df.sort_values(by='ConNo', ascending=False).reset_index(drop=True)
+        except Exception as e:
+            _handle_connection_error(e)
+            st.warning(f"Lỗi tải công nợ theo khách: {e}")
+    return pd.DataFrame(columns=DEBT_CUSTOMER_COLUMNS)
+
 # --- 3. XU LY BAN HANG (FIX: không clean giá từ cart vì đã là float) ---
+def _prepare_sales_headers(ws_sales):
+    sales_headers = _get_sheet_headers(ws_sales)
+    if not sales_headers:
+        sales_headers = list(SALES_COLUMNS)
+        for col_idx, col_name in enumerate(sales_headers, start=1):
+            ws_sales.update_cell(1, col_idx, col_name)
+
+    for col_name in SALES_COLUMNS:
+        sales_headers = _ensure_sheet_column(ws_sales, sales_headers, col_name)
+    return sales_headers, {name: idx for idx, name in enumerate(sales_headers)}
+
+@_api_priority(PRIORITY_POS)
 def process_checkout(cart_items, payment_method='Tiền mặt'):
+    if _checkout_mode() == 'journal':
+        return _enqueue_checkout(cart_items, payment_method)
+    return _write_checkout(cart_items, payment_method)
+
+@_outbox_when_offline("checkout", lambda a: [item['MaSanPham'] for item in a['cart_items']])
+def _write_checkout(cart_items, payment_method):
     sh = get_connection()
     if not sh: return False
     
     inventory_updates = []
     applied_inventory_updates = []
     try:
-        ws_inventory = sh.worksheet("TonKho")
-        ws_sales = sh.worksheet("LichSuBan")
-        sales_headers = _get_sheet_headers(ws_sales)
-        required_cols = [
-            'NgayBan', 'MaHoaDon', 'MaSanPham', 'TenSanPham',
-            'DonVi', 'SoLuong', 'GiaBan', 'ThanhTien',
-            'GiaVonLucBan', 'LoiNhuan', 'HinhThucTT'
-        ]
-        if not sales_headers:
-            sales_headers = ['NgayBan', 'MaHoaDon', 'MaSanPham', 'TenSanPham', 'DonVi', 'SoLuong', 'GiaBan', 'ThanhTien', 'GiaVonLucBan', 'LoiNhuan', 'HinhThucTT']
-            for col_idx, col_name in enumerate(sales_headers, start=1):
-                ws_sales.update_cell(1, col_idx, col_name)
-
-        for col_name in required_cols:
-            sales_headers = _ensure_sheet_column(ws_sales, sales_headers, col_name)
-        sales_idx = {name: idx for idx, name in enumerate(sales_headers)}
+        ws_inventory = _get_worksheet(sh, "TonKho")
+        ws_sales = _get_worksheet(sh, "LichSuBan")
+        sales_headers, sales_idx = _prepare_sales_headers(ws_sales)
         if 'HinhThucTT' not in sales_idx:
             st.error("Sheet LichSuBan thiếu cột HinhThucTT.")
             return False
         payment_method = _normalize_payment_method(payment_method)
         
-        # Dùng cùng nguồn với UI để đảm bảo số đã được parse ổn định
-        df_inv = load_inventory()
-        if df_inv.empty:
-            st.error("Không tải được dữ liệu tồn kho.")
-            return False
-        if 'MaSanPham' in df_inv.columns:
-            df_inv['MaSanPham'] = df_inv['MaSanPham'].astype(str).str.strip()
-        
-        # Không clean dữ liệu tồn kho theo yêu cầu
+        # Tra dòng TonKho qua chỉ mục sản phẩm; SL/giá vốn của cả giỏ đọc trong một batch_get.
+        product_rows = _product_rows(ws_inventory, [item['MaSanPham'] for item in cart_items])
         
         sales_rows = []
         tz = pytz.timezone('Asia/Ho_Chi_Minh')  # VN time
-        timestamp = datetime.now(tz).strftime("%Y-%m-%d %H:%M:%S")
-        order_id = datetime.now(tz).strftime("%Y%m%d%H%M%S")
+        timestamp = _now(tz).strftime("%Y-%m-%d %H:%M:%S")
+        order_id = _now(tz).strftime("%Y%m%d%H%M%S")
         
         for item in cart_items:
-            ma_sp = str(item['MaSanPham'])
+            ma_sp = str(item['MaSanPham']).strip()
             qty_sell = int(item['SoLuongBan'])  # SL luôn int
             
-            match_idx = df_inv.index[df_inv['MaSanPham'] == ma_sp].tolist()
+            match = product_rows.get(ma_sp)
             
-            if match_idx:
-                idx = match_idx[0]
+            if match:
+                inventory_row, record = match
                 try:
-                    current_qty = float(df_inv.at[idx, 'SoLuong'])
+                    current_qty = _record_number(record, 'SoLuong')
                     # Giá bán lấy từ giỏ hàng (giá cuối cùng khách mua)
                     gia_ban = float(item['GiaBan'])
                     # Giá vốn lấy từ tồn kho để tính lợi nhuận
-                    cost_price = float(df_inv.at[idx, 'GiaNhap'])
+                    cost_price = _record_number(record, 'GiaNhap')
                 except Exception:
                     st.error(f"Dữ liệu giá/SL của sản phẩm {ma_sp} không phải số. Vui lòng kiểm tra tồn kho.")
                     return False
                 
                 new_qty = current_qty - qty_sell
-                inventory_updates.append((idx + 2, current_qty, new_qty))
+                inventory_updates.append((inventory_row, current_qty, new_qty))
                 
                 # Lưu số nguyên VND để tránh lỗi định dạng khi ghi Sheets
                 gia_ban_int = int(round(gia_ban))
@@ -371,34 +1546,53 @@ def process_checkout(cart_items, payment_method='Tiền mặt'):
         
         if sales_rows:
             # Ghi theo range cố định để đảm bảo không bị hụt cột HinhThucTT khi append.
-            existing_rows = ws_sales.get_all_values()
-            start_row = len(existing_rows) + 1
-            end_row = start_row + len(sales_rows) - 1
-            end_col = len(sales_headers)
-            start_cell = gspread.utils.rowcol_to_a1(start_row, 1)
-            end_cell = gspread.utils.rowcol_to_a1(end_row, end_col)
-
-            # update(range, values) không tự mở rộng grid của Google Sheets.
-            # Chừa thêm một vùng đệm để không phải resize sau mỗi lần thanh toán.
-            ensure_worksheet_capacity(ws_sales, end_row, end_col)
-
-            # Nếu ghi lịch sử thất bại, hoàn lại mọi cập nhật tồn kho đã thực hiện.
-            for inventory_row, old_qty, new_qty in inventory_updates:
-                ws_inventory.update_cell(inventory_row, 4, new_qty)
-                applied_inventory_updates.append((inventory_row, old_qty))
+            # Dòng bắt đầu lấy từ con trỏ ghi thay vì get_all_values() toàn bộ lịch sử.
+            with _APPEND_LOCKS['LichSuBan']:
+                start_row = _next_append_row(ws_sales, "LichSuBan")
+                end_row = start_row + len(sales_rows) - 1
+                end_col = len(sales_headers)
+                start_cell = rowcol_to_a1(start_row, 1)
+                end_cell = rowcol_to_a1(end_row, end_col)
+
+                # update(range, values) không tự mở rộng grid của Google Sheets.
+                # Chừa thêm một vùng đệm để không phải resize sau mỗi lần thanh toán.
+                ensure_worksheet_capacity(ws_sales, end_row, end_col)
+
+                # Nếu ghi lịch sử thất bại, hoàn lại mọi cập nhật tồn kho đã thực hiện.
+                for inventory_row, old_qty, new_qty in inventory_updates:
+                    ws_inventory.update_cell(inventory_row, 4, new_qty)
+                    applied_inventory_updates.append((inventory_row, old_qty))
 
-            ws_sales.update(
-                f"{start_cell}:{end_cell}",
-                sales_rows,
-                value_input_option='RAW'
-            )
+                try:
+                    ws_sales.update(
+                        f"{start_cell}:{end_cell}",
+                        sales_rows,
+                        value_input_option='RAW'
+                    )
+                except Exception:
+                    _set_append_row("LichSuBan", None)
+                    raise
+                _set_append_row("LichSuBan", end_row + 1)
+                _index_sales_rows(start_row, sales_rows, sales_idx['MaHoaDon'])
+            _mark_sales_cache_stale()
+            _record_rollup(sh, [(
+                timestamp[:10],
+                payment_method,
+                sum(r[sales_idx['ThanhTien']] for r in sales_rows),
+                sum(r[sales_idx['LoiNhuan']] for r in sales_rows),
+                1,
+                sum(r[sales_idx['SoLuong']] for r in sales_rows),
+            )])
             # Từ đây giao dịch đã ghi đủ lịch sử và tồn kho; lỗi làm mới cache
             # không được phép kích hoạt rollback tồn kho.
             applied_inventory_updates.clear()
-            st.cache_data.clear()
+            _bump_sheet_versions("LichSuBan")
+            # Tồn kho đang cache được sửa đúng các số vừa ghi, không tải lại cả TonKho.
+            _patch_inventory_cache(cells={row: {'SoLuong': new_qty} for row, _, new_qty in inventory_updates})
             return True
             
     except Exception as e:
+        _handle_connection_error(e)
         rollback_errors = []
         for inventory_row, old_qty in reversed(applied_inventory_updates):
             try:
@@ -411,7 +1605,211 @@ def process_checkout(cart_items, payment_method='Tiền mặt'):
         return False
     return False
 
+# --- 3a. THANH TOAN QUA NHAT KY (checkout_mode = "journal") ---
+# Đơn được ghi vào file nhật ký cục bộ (fsync) rồi trả mã đơn ngay cho thu ngân;
+# một luồng nền ghi dần các đơn lên LichSuBan/TonKho theo lô, thử lại khi lỗi
+# và đọc lại nhật ký sau khi khởi động lại. Mỗi bước của một lô được đánh dấu trong
+# nhật ký để chạy lại không ghi trùng.
+_JOURNAL_LOCK = threading.Lock()
+_JOURNAL_STATE = {'journal': None, 'thread': None, 'wake': threading.Event(), 'last_order_id': 0}
+_JOURNAL_BATCH_SIZE = 50
+
+def _checkout_mode():
+    return str(st.secrets.get("checkout_mode", "sync")).strip().lower()
+
+def _get_checkout_journal():
+    with _JOURNAL_LOCK:
+        if _JOURNAL_STATE['journal'] is None:
+            path = st.secrets.get("checkout_journal_path", "qtmc_checkout_journal.jsonl")
+            _JOURNAL_STATE['journal'] = CheckoutJournal(path)
+        return _JOURNAL_STATE['journal']
+
+def _start_checkout_worker():
+    journal = _get_checkout_journal()
+    with _JOURNAL_LOCK:
+        if _JOURNAL_STATE['thread'] is not None:
+            return
+        thread = threading.Thread(target=_checkout_worker_loop, args=(journal,), daemon=True)
+        _JOURNAL_STATE['thread'] = thread
+        thread.start()
+
+def checkout_queue_status():
+    """Số đơn đã nhận nhưng chưa ghi xong lên Google Sheets (0 khi không dùng nhật ký)."""
+    if _checkout_mode() != 'journal':
+        return 0
+    _start_checkout_worker()
+    return _get_checkout_journal().pending_count()
+
+def _next_order_id(tz):
+    # Mã đơn theo giây; hai đơn trong cùng một giây lấy số kế tiếp để không trùng khóa nhật ký.
+    with _JOURNAL_LOCK:
+        order_num = max(int(datetime.now(tz).strftime("%Y%m%d%H%M%S")), _JOURNAL_STATE['last_order_id'] + 1)
+        _JOURNAL_STATE['last_order_id'] = order_num
+    return str(order_num)
+
+def _enqueue_checkout(cart_items, payment_method):
+    try:
+        payment_method = _normalize_payment_method(payment_method)
+        df_inv = load_inventory()
+        if df_inv.empty or 'MaSanPham' not in df_inv.columns:
+            st.error("Không tải được dữ liệu tồn kho.")
+            return False
+        ids = product_ids(df_inv)
+        first_pos = dict(zip(ids[::-1], range(len(ids) - 1, -1, -1)))
+
+        lines = []
+        for item in cart_items:
+            ma_sp = str(item['MaSanPham']).strip()
+            pos = first_pos.get(ma_sp)
+            if pos is None:
+                continue
+            qty_sell = int(item['SoLuongBan'])
+            try:
+                gia_ban_int = int(round(float(item['GiaBan'])))
+                cost_price_int = int(round(float(df_inv.iat[pos, df_inv.columns.get_loc('GiaNhap')])))
+            except Exception:
+                st.error(f"Dữ liệu giá/SL của sản phẩm {ma_sp} không phải số. Vui lòng kiểm tra tồn kho.")
+                return False
+            lines.append({
+                'MaSanPham': ma_sp,
+                'TenSanPham': item['TenSanPham'],
+                'DonVi': item['DonVi'],
+                'SoLuong': qty_sell,
+                'GiaBan': gia_ban_int,
+                'ThanhTien': gia_ban_int * qty_sell,
+                'GiaVonLucBan': cost_price_int,
+                'LoiNhuan': (gia_ban_int - cost_price_int) * qty_sell,
+            })
+        if not lines:
+            return False
+
+        tz = pytz.timezone('Asia/Ho_Chi_Minh')
+        order_id = _next_order_id(tz)
+        timestamp = datetime.now(tz).strftime("%Y-%m-%d %H:%M:%S")
+        _get_checkout_journal().add_checkout(order_id, {
+            'NgayBan': timestamp,
+            'HinhThucTT': payment_method,
+            'lines': lines,
+        })
+        # load_inventory trừ ngay các đơn còn trong nhật ký nên tồn kho hiển thị đã là số sau bán,
+        # kể cả khi cache TonKho được tải lại từ sheet trước khi luồng nền kịp ghi.
+        _start_checkout_worker()
+        _JOURNAL_STATE['wake'].set()
+        return order_id
+    except Exception as e:
+        st.error(f"Lỗi ghi nhật ký thanh toán: {e}")
+        return False
+
+def _checkout_worker_loop(journal):
+    wake = _JOURNAL_STATE['wake']
+    delay = 0
+    while True:
+        try:
+            _drain_checkout_journal(journal)
+            delay = 0
+        except Exception as e:
+            _handle_connection_error(e)
+            delay = min(max(delay * 2, 2), 60)
+        wake.wait(timeout=delay or 30)
+        wake.clear()
+
+def _drain_checkout_journal(journal):
+    # Lô dở dang (trước khi khởi động lại) được làm tiếp trước, sau đó mới gom lô mới.
+    for batch, entries, steps, intent in journal.open_batches():
+        _apply_checkout_batch(journal, batch, entries, steps, intent)
+    while True:
+        entries = journal.unbatched(limit=_JOURNAL_BATCH_SIZE)
+        if not entries:
+            return
+        batch = journal.start_batch([e['id'] for e in entries])
+        _apply_checkout_batch(journal, batch, entries, set(), None)
+
+def _append_sales_rows(ws_sales, sales_rows, width):
+    with _APPEND_LOCKS['LichSuBan']:
+        start_row = _next_append_row(ws_sales, "LichSuBan")
+        end_row = start_row + len(sales_rows) - 1
+        ensure_worksheet_capacity(ws_sales, end_row, width)
+        try:
+            ws_sales.update(
+                f"{rowcol_to_a1(start_row, 1)}:{rowcol_to_a1(end_row, width)}",
+                sales_rows,
+                value_input_option='RAW'
+            )
+        except Exception:
+            _set_append_row("LichSuBan", None)
+            raise
+        _set_append_row("LichSuBan", end_row + 1)
+    return start_row
+
+@_api_priority(PRIORITY_POS)
+def _apply_checkout_batch(journal, batch, entries, steps, intent):
+    sh = get_connection(allow_offline=False)
+    if not sh:
+        raise ConnectionError("Không kết nối được Google Sheets.")
+
+    if 'sales' not in steps:
+        ws_sales = _get_worksheet(sh, "LichSuBan")
+        sales_headers, sales_idx = _prepare_sales_headers(ws_sales)
+        # Đơn đã có trên sheet (ghi xong nhưng chưa kịp đánh dấu) thì không ghi lại.
+        with _SALES_CACHE_LOCK:
+            df_sales = _refresh_sales_cache(ws_sales)
+        written = set(df_sales['MaHoaDon']) if not df_sales.empty else set()
+        fresh = [e for e in entries if _normalize_id_text(e['id']) not in written]
+
+        sales_rows = []
+        for entry in fresh:
+            for line in entry['lines']:
+                values = dict(line, NgayBan=entry['NgayBan'], MaHoaDon=entry['id'], HinhThucTT=entry['HinhThucTT'])
+                row = [''] * len(sales_headers)
+                for name, value in values.items():
+                    row[sales_idx[name]] = value
+                sales_rows.append(row)
+        if sales_rows:
+            start_row = _append_sales_rows(ws_sales, sales_rows, len(sales_headers))
+            _index_sales_rows(start_row, sales_rows, sales_idx['MaHoaDon'])
+            _mark_sales_cache_stale()
+        if len(fresh) < len(entries):
+            _mark_rollup_unverified()
+        _record_rollup(sh, [(
+            entry['NgayBan'][:10],
+            entry['HinhThucTT'],
+            sum(line['ThanhTien'] for line in entry['lines']),
+            sum(line['LoiNhuan'] for line in entry['lines']),
+            1,
+            sum(line['SoLuong'] for line in entry['lines']),
+        ) for entry in fresh])
+        journal.mark_step(batch, 'sales')
+        _bump_sheet_versions("LichSuBan")
+
+    if 'inventory' not in steps:
+        ws_inventory = _get_worksheet(sh, "TonKho")
+        qty_by_product = {}
+        for entry in entries:
+            for line in entry['lines']:
+                qty_by_product[line['MaSanPham']] = qty_by_product.get(line['MaSanPham'], 0) + line['SoLuong']
+        product_rows = _product_rows(ws_inventory, list(qty_by_product))
+
+        updates = {}
+        for pid, (row, record) in product_rows.items():
+            current = _record_number(record, 'SoLuong')
+            if intent is not None and str(row) in intent and current == intent[str(row)][1]:
+                # Lô này đã trừ kho dòng này trước khi khởi động lại.
+                continue
+            updates[row] = [current, current - qty_by_product[pid]]
+        if updates:
+            journal.record_intent(batch, updates)
+            ws_inventory.batch_update(
+                [{'range': rowcol_to_a1(row, 4), 'values': [[new]]} for row, (_, new) in updates.items()],
+                value_input_option='RAW'
+            )
+            _patch_inventory_cache(cells={row: {'SoLuong': new} for row, (_, new) in updates.items()})
+        journal.mark_step(batch, 'inventory')
+
+    journal.finish_batch(batch)
+
 # --- 3b. XU LY BAN NO (CONG NO) ---
+@_api_priority(PRIORITY_POS)
+@_outbox_when_offline("debt_checkout", lambda a: [item.get('MaSanPham', '') for item in a['cart_items']])
 def process_debt_checkout(customer_name, cart_items, debt_datetime=None):
     sh = get_connection()
     if not sh:
@@ -426,8 +1824,8 @@ def process_debt_checkout(customer_name, cart_items, debt_datetime=None):
         return False
 
     try:
-        ws_inventory = sh.worksheet("TonKho")
-        ws_debt = sh.worksheet("CongNo")
+        ws_inventory = _get_worksheet(sh, "TonKho")
+        ws_debt = _get_worksheet(sh, "CongNo")
         debt_headers = _get_sheet_headers(ws_debt)
         if not debt_headers:
             debt_headers = ['TenKH', 'Ngay', 'TenSanPham', 'SoLuong', 'ThanhTien']
@@ -439,15 +1837,8 @@ def process_debt_checkout(customer_name, cart_items, debt_datetime=None):
 
         header_idx = {name: idx for idx, name in enumerate(debt_headers)}
 
-        df_inv = load_inventory()
-        if df_inv.empty:
-            st.error("Không tải được dữ liệu tồn kho.")
-            return False
-        if 'MaSanPham' not in df_inv.columns:
-            st.error("Sheet tồn kho thiếu cột MaSanPham.")
-            return False
-
-        df_inv['MaSanPham'] = df_inv['MaSanPham'].astype(str).str.strip()
+        product_rows = _product_rows(ws_inventory, [item.get('MaSanPham', '') for item in cart_items])
+        remaining_qty = {}
 
         # Validate toàn bộ trước để tránh ghi dở dang.
         inventory_updates = []
@@ -467,13 +1858,16 @@ def process_debt_checkout(customer_name, cart_items, debt_datetime=None):
                 st.error(f"Số lượng/giá bán của sản phẩm {ten_sp or ma_sp} không hợp lệ.")
                 return False
 
-            match_idx = df_inv.index[df_inv['MaSanPham'] == ma_sp].tolist()
-            if not match_idx:
+            match = product_rows.get(ma_sp)
+            if not match:
                 st.error(f"Không tìm thấy sản phẩm mã {ma_sp} trong tồn kho.")
                 return False
 
-            idx = match_idx[0]
-            current_qty = float(pd.to_numeric(df_inv.at[idx, 'SoLuong'], errors='coerce'))
+            inventory_row, record = match
+            if ma_sp in remaining_qty:
+                current_qty = remaining_qty[ma_sp]
+            else:
+                current_qty = float(pd.to_numeric(record.get('SoLuong', ''), errors='coerce'))
             if pd.isna(current_qty):
                 st.error(f"Dữ liệu số lượng tồn kho của {ten_sp or ma_sp} không hợp lệ.")
                 return False
@@ -482,13 +1876,13 @@ def process_debt_checkout(customer_name, cart_items, debt_datetime=None):
                 return False
 
             new_qty = current_qty - qty_sell
-            df_inv.at[idx, 'SoLuong'] = new_qty
-            inventory_updates.append((idx + 2, new_qty))
+            remaining_qty[ma_sp] = new_qty
+            inventory_updates.append((inventory_row, new_qty))
             debt_rows.append([ten_sp, qty_sell, sale_price_int * qty_sell])
 
         tz = pytz.timezone('Asia/Ho_Chi_Minh')
         if debt_datetime is None:
-            debt_dt = datetime.now(tz)
+            debt_dt = _now(tz)
         else:
             if hasattr(debt_datetime, "year") and hasattr(debt_datetime, "hour"):
                 debt_dt = debt_datetime
@@ -503,10 +1897,11 @@ def process_debt_checkout(customer_name, cart_items, debt_datetime=None):
                 debt_dt = debt_dt.astimezone(tz)
 
         timestamp = debt_dt.strftime("%Y-%m-%d %H:%M:%S")
-        debt_id = datetime.now(tz).strftime("CN%Y%m%d%H%M%S%f")[:-3]
+        debt_id = _now(tz).strftime("CN%Y%m%d%H%M%S%f")[:-3]
 
         for row_idx, new_qty in inventory_updates:
             ws_inventory.update_cell(row_idx, 4, new_qty)
+        _patch_inventory_cache(cells={row_idx: {'SoLuong': new_qty} for row_idx, new_qty in inventory_updates})
 
         rows_to_append = []
         for ten_sp, qty_sell, thanh_tien in debt_rows:
@@ -522,162 +1917,353 @@ def process_debt_checkout(customer_name, cart_items, debt_datetime=None):
             debt_row[header_idx['TienConLai']] = thanh_tien
             rows_to_append.append(debt_row)
 
-        ws_debt.append_rows(rows_to_append)
+        response = ws_debt.append_rows(rows_to_append)
+        _index_debt_rows(debt_headers, rows_to_append, appended_first_row(response))
 
-        st.cache_data.clear()
+        _bump_sheet_versions("CongNo")
         return debt_id
     except Exception as e:
+        _handle_connection_error(e)
         st.error(f"Lỗi tạo công nợ: {e}")
         return False
 
 # --- 4. XU LY NHAP HANG (FIX: không clean giá từ list vì đã là float) ---
+@_api_priority(PRIORITY_POS)
+@_outbox_when_offline("import", lambda a: [item['MaSanPham'] for item in a['import_list']])
 def process_import(import_list):
     sh = get_connection()
     if not sh: return False
     
     try:
-        ws_inventory = sh.worksheet("TonKho")
-        ws_import = sh.worksheet("LichSuNhap")
-        df_inv = safe_get_data(ws_inventory)
+        ws_inventory = _get_worksheet(sh, "TonKho")
+        ws_import = _get_worksheet(sh, "LichSuNhap")
+        product_rows = _product_rows(ws_inventory, [item['MaSanPham'] for item in import_list])
         
         tz = pytz.timezone('Asia/Ho_Chi_Minh')  # VN time
-        timestamp = datetime.now(tz).strftime("%Y-%m-%d %H:%M:%S")
+        timestamp = _now(tz).strftime("%Y-%m-%d %H:%M:%S")
         import_log_rows = []
+        inventory_updates = []
+        patched_cells = {}
+        running_qty = {}
+        new_rows = []
+        new_row_pos = {}
         
         for item in import_list:
-            ma_sp = str(item['MaSanPham'])
+            ma_sp = str(item['MaSanPham']).strip()
             qty_in = item['SoLuong']
             price_in = int(round(float(item['GiaNhap'])))  # Đã là float từ input
             price_out = int(round(float(item['GiaBan'])))  # Đã là float từ input
             
-            exists = False
-            row_idx_update = -1
-            
-            if not df_inv.empty and 'MaSanPham' in df_inv.columns:
-                matches = df_inv.index[df_inv['MaSanPham'] == ma_sp].tolist()
-                if matches:
-                    exists = True
-                    row_idx_update = matches[0]
-            
-            if exists:
-                current_qty = float(df_inv.at[row_idx_update, 'SoLuong'])
+            if ma_sp in product_rows:
+                inventory_row, record = product_rows[ma_sp]
+                current_qty = running_qty.get(ma_sp, _record_number(record, 'SoLuong'))
                 new_qty = current_qty + qty_in
-                ws_inventory.update_cell(row_idx_update + 2, 4, new_qty) 
-                ws_inventory.update_cell(row_idx_update + 2, 5, price_in) 
-                ws_inventory.update_cell(row_idx_update + 2, 6, price_out)
+                running_qty[ma_sp] = new_qty
+                inventory_updates.append({
+                    'range': f"D{inventory_row}:F{inventory_row}",
+                    'values': [[new_qty, price_in, price_out]],
+                })
+                patched_cells[inventory_row] = {'SoLuong': new_qty, 'GiaNhap': price_in, 'GiaBan': price_out}
+            elif ma_sp in new_row_pos:
+                pending = new_rows[new_row_pos[ma_sp]]
+                pending[3] += qty_in
+                pending[4] = price_in
+                pending[5] = price_out
             else:
-                new_row = [ma_sp, item['TenSanPham'], item['DonVi'], qty_in, price_in, price_out, item.get('NhaCungCap', '')]
-                ws_inventory.append_row(new_row)
+                new_row_pos[ma_sp] = len(new_rows)
+                new_rows.append([ma_sp, item['TenSanPham'], item['DonVi'], qty_in, price_in, price_out, item.get('NhaCungCap', '')])
             
             import_log_rows.append([timestamp, ma_sp, item['TenSanPham'], item.get('NhaCungCap', ''), item['DonVi'], qty_in, price_in, qty_in * price_in])
+        
+        if inventory_updates:
+            ws_inventory.batch_update(inventory_updates, value_input_option='RAW')
+        if new_rows:
+            # Sản phẩm mới ghi vào các dòng trống kế tiếp rồi thêm thẳng vào chỉ mục.
+            with _APPEND_LOCKS['TonKho']:
+                start_row = _next_append_row(ws_inventory, "TonKho")
+                end_row = start_row + len(new_rows) - 1
+                ensure_worksheet_capacity(ws_inventory, end_row, len(new_rows[0]))
+                try:
+                    ws_inventory.update(
+                        f"{rowcol_to_a1(start_row, 1)}:{rowcol_to_a1(end_row, len(new_rows[0]))}",
+                        new_rows,
+                        value_input_option='RAW'
+                    )
+                except Exception:
+                    _set_append_row("TonKho", None)
+                    raise
+                _set_append_row("TonKho", end_row + 1)
+            for offset, row in enumerate(new_rows):
+                _index_product_row(row[0], start_row + offset)
+        if inventory_updates or new_rows:
+            _patch_inventory_cache(
+                cells=patched_cells,
+                new_rows={start_row + offset: row for offset, row in enumerate(new_rows)} if new_rows else None
+            )
             
         if import_log_rows:
             ws_import.append_rows(import_log_rows)
-            st.cache_data.clear()
+            _bump_sheet_versions("LichSuNhap")
             
         return True
     except Exception as e:
+        _handle_connection_error(e)
         st.error(f"Lỗi nhập hàng: {str(e)}")
         return False
 
 # --- 4b. CAP NHAT GIA VON / GIA BAN ---
+@_api_priority(PRIORITY_POS)
 def update_product_prices(product_id, cost_price, sale_price=None):
-    sh = get_connection()
+    sh = _online_connection()
     if not sh:
         return False
 
     try:
-        ws_inventory = sh.worksheet("TonKho")
-        df_inv = safe_get_data(ws_inventory)
-        if df_inv.empty or 'MaSanPham' not in df_inv.columns:
-            return False
-
-        df_inv['MaSanPham'] = df_inv['MaSanPham'].astype(str).str.strip()
+        ws_inventory = _get_worksheet(sh, "TonKho")
         pid = str(product_id).strip()
 
-        match_idx = df_inv.index[df_inv['MaSanPham'] == pid].tolist()
-        if not match_idx:
+        match = _product_rows(ws_inventory, [pid]).get(pid)
+        if not match:
             return False
 
-        idx = match_idx[0]
+        inventory_row = match[0]
         cost_int = int(round(float(cost_price)))
         if cost_int <= 0:
             st.error("Giá vốn không hợp lệ.")
             return False
 
-        ws_inventory.update_cell(idx + 2, 5, cost_int)
-
+        new_values = {'GiaNhap': cost_int}
         if sale_price is not None:
             sale_int = int(round(float(sale_price)))
             if sale_int <= 0:
                 st.error("Giá bán không hợp lệ.")
                 return False
-            ws_inventory.update_cell(idx + 2, 6, sale_int)
+            new_values['GiaBan'] = sale_int
 
-        st.cache_data.clear()
+        ws_inventory.update_cell(inventory_row, 5, cost_int)
+        if 'GiaBan' in new_values:
+            ws_inventory.update_cell(inventory_row, 6, new_values['GiaBan'])
+
+        _patch_inventory_cache(cells={inventory_row: new_values})
         return True
     except Exception as e:
+        _handle_connection_error(e)
         st.error(f"Lỗi cập nhật giá: {e}")
         return False
 
-# --- 5. XU LY HOAN TRA (GIỮ NGUYÊN: XÓA DÒNG → KHÔNG CÒN _RET) ---
+# --- 5. XU LY HOAN TRA (GHI THÊM DÒNG TRẢ, KHÔNG XÓA DÒNG) ---
+# Hoàn trả ghi thêm một dòng SoLuong âm cùng MaHoaDon/MaSanPham vào cuối LichSuBan
+# (NgayBan là lúc trả), không xóa dòng bán nên số dòng trên sheet không bao giờ dịch
+# chuyển. Các dòng của một đơn được tra qua chỉ mục MaHoaDon -> dòng LichSuBan, đọc lại
+# trong một batch_get để kiểm tra mã; mã lệch (sheet bị sửa tay) thì dựng lại chỉ mục.
+_ORDER_INDEX_LOCK = threading.RLock()
+_ORDER_INDEX = {'rows': None, 'column': 2, 'next_row': 2, 'loaded_at': 0.0}
+
+def _invalidate_order_index():
+    with _ORDER_INDEX_LOCK:
+        _ORDER_INDEX['rows'] = None
+
+def _add_order_rows(order_ids, first_row):
+    rows = _ORDER_INDEX['rows']
+    for offset, value in enumerate(order_ids):
+        order_id = _normalize_id_text(value)
+        if order_id:
+            sheet_rows = rows.setdefault(order_id, [])
+            if first_row + offset not in sheet_rows:
+                sheet_rows.append(first_row + offset)
+    _ORDER_INDEX['next_row'] = max(_ORDER_INDEX['next_row'], first_row + len(order_ids))
+
+def _build_order_index(ws):
+    header_part, id_part = ws.batch_get(['1:1', 'B:B'], value_render_option='UNFORMATTED_VALUE')
+    header = [str(h).strip() for h in (header_part[0] if header_part else [])]
+    column = header.index('MaHoaDon') + 1 if 'MaHoaDon' in header else 2
+    if column == 2:
+        ids = [row[0] if row else '' for row in id_part[1:]]
+    else:
+        ids = ws.col_values(column, value_render_option='UNFORMATTED_VALUE')[1:]
+    _ORDER_INDEX.update(rows={}, column=column, next_row=2, loaded_at=time.monotonic())
+    _add_order_rows(ids, 2)
+
+def _order_rows(ws, order_id):
+    """Các dòng LichSuBan (bán và trả) của order_id theo chỉ mục; [] nếu không có đơn."""
+    with _ORDER_INDEX_LOCK:
+        state = _ORDER_INDEX
+        if state['rows'] is None or time.monotonic() - state['loaded_at'] >= _SALES_FULL_RELOAD_SECONDS:
+            _build_order_index(ws)
+        elif order_id not in state['rows']:
+            # Đơn ghi sau lần dựng chỉ mục (từ process khác): chỉ đọc phần đuôi cột MaHoaDon.
+            col = column_letter(state['column'])
+            tail = ws.get(f"{col}{state['next_row']}:{col}", value_render_option='UNFORMATTED_VALUE')
+            _add_order_rows([row[0] if row else '' for row in tail], state['next_row'])
+        return sorted(state['rows'].get(order_id, []))
+
+def _index_sales_rows(start_row, sales_rows, order_idx):
+    with _ORDER_INDEX_LOCK:
+        if _ORDER_INDEX['rows'] is not None:
+            _add_order_rows([row[order_idx] for row in sales_rows], start_row)
+
+@_api_priority(PRIORITY_POS)
 def process_return(order_id, product_id, qty_return):
-    sh = get_connection()
+    return process_return_lines(order_id, {product_id: qty_return})
+
+def _return_quantity(value):
+    qty = pd.to_numeric(value, errors='coerce')
+    if pd.isna(qty) or qty <= 0:
+        return 0
+    return int(qty) if float(qty).is_integer() else float(qty)
+
+@_api_priority(PRIORITY_POS)
+def process_return_lines(order_id, quantities=None):
+    """Hoàn trả nhiều món của một đơn trong một lần ghi.
+
+    quantities: {MaSanPham: số lượng trả}; None = trả hết phần còn lại của cả đơn.
+    Số lượng vượt quá phần còn lại của món được giảm xuống bằng phần còn lại.
+    Trả về True nếu có ít nhất một món được hoàn trả.
+    """
+    sh = _online_connection()
     if not sh: return False
 
     try:
-        ws_sales = sh.worksheet("LichSuBan")
-        ws_inventory = sh.worksheet("TonKho")
-
-        records = ws_sales.get_all_values()
-        if len(records) < 2:
-            return False
-
-        headers = [str(h).strip() for h in records[0]]
-        idx_map = {name: i for i, name in enumerate(headers)}
-        idx_order = idx_map.get('MaHoaDon', 1)
-        idx_product = idx_map.get('MaSanPham', 2)
+        ws_sales = _get_worksheet(sh, "LichSuBan")
+        ws_inventory = _get_worksheet(sh, "TonKho")
 
         target_order = _normalize_id_text(order_id)
         if target_order == '':
             return False
-        target_product = str(product_id).strip()
-        row_to_delete = None
-        for i in range(1, len(records)):
-            row = records[i]
-            order_val = _normalize_id_text(row[idx_order]) if idx_order < len(row) else ''
-            product_val = str(row[idx_product]).strip() if idx_product < len(row) else ''
-            if target_order == order_val and product_val == target_product:
-                row_to_delete = i + 1  # Row index in sheet (1-based)
-                break
-
-        if not row_to_delete:
-            return False
-
-        # Xóa dòng trong sheet LichSuBan
-        ws_sales.delete_rows(row_to_delete)
+        wanted = None
+        if quantities is not None:
+            wanted = {}
+            for pid, qty in quantities.items():
+                pid = str(pid).strip()
+                wanted[pid] = wanted.get(pid, 0) + _return_quantity(qty)
+            if not any(wanted.values()):
+                return False
 
-        # Cập nhật tồn kho
-        df_inv = safe_get_data(ws_inventory)
-        if 'MaSanPham' in df_inv.columns:
-            df_inv['MaSanPham'] = df_inv['MaSanPham'].astype(str).str.strip()
-        qty_return_num = float(pd.to_numeric(qty_return, errors='coerce'))
-        if pd.isna(qty_return_num):
-            qty_return_num = 0.0
+        for attempt in range(2):
+            sheet_rows = _order_rows(ws_sales, target_order)
+            if not sheet_rows:
+                return False
+            with _APPEND_LOCKS['LichSuBan']:
+                with _CONN_LOCK:
+                    cursor = _CONN_STATE['row_cursors'].get("LichSuBan")
+                # Header, các dòng của đơn và ô dò con trỏ ghi trong cùng một lệnh đọc.
+                ranges = ['1:1'] + [f"{row}:{row}" for row in sheet_rows]
+                if cursor and cursor >= 2:
+                    ranges.append(cursor_probe_range(cursor))
+                parts = ws_sales.batch_get(ranges, value_render_option='UNFORMATTED_VALUE')
+                headers = [str(h).strip() for h in (parts[0][0] if parts[0] else [])]
+                idx_map = {name: i for i, name in enumerate(headers)}
+                if any(col not in idx_map for col in SALES_COLUMNS):
+                    st.error("Sheet LichSuBan thiếu cột, không thể hoàn trả.")
+                    return False
 
-        match_idx = df_inv.index[df_inv['MaSanPham'] == str(product_id).strip()].tolist()
-        if match_idx:
-            idx = match_idx[0]
-            current_qty = float(df_inv.at[idx, 'SoLuong'])
-            ws_inventory.update_cell(idx + 2, 4, current_qty + qty_return_num)
+                def cell(row, name):
+                    i = idx_map[name]
+                    return row[i] if i < len(row) else ''
+
+                def number(row, name):
+                    value = pd.to_numeric(cell(row, name), errors='coerce')
+                    if pd.isna(value):
+                        return 0
+                    return value.item() if hasattr(value, 'item') else value
+
+                order_lines = [list(part[0]) if part else [] for part in parts[1:1 + len(sheet_rows)]]
+                if any(_normalize_id_text(cell(row, 'MaHoaDon')) != target_order for row in order_lines):
+                    _invalidate_order_index()
+                    continue
+
+                by_product = {}
+                for row in order_lines:
+                    by_product.setdefault(str(cell(row, 'MaSanPham')).strip(), []).append(row)
+
+                tz = pytz.timezone('Asia/Ho_Chi_Minh')  # VN time
+                timestamp = _now(tz).strftime("%Y-%m-%d %H:%M:%S")
+                return_rows = []
+                returned_qty = {}
+                deltas = {}
+                for pid, product_lines in by_product.items():
+                    sold = [row for row in product_lines if number(row, 'SoLuong') > 0]
+                    already_returned = -sum(number(row, 'SoLuong') for row in product_lines if number(row, 'SoLuong') < 0)
+                    # Phần còn lại của từng dòng bán sau các lần trả trước (trừ dần theo thứ tự như khi tải lịch sử).
+                    remaining = [number(row, 'SoLuong') for row in sold]
+                    for pos, take in allocate_return(list(remaining), already_returned):
+                        remaining[pos] -= take
+                    requested = sum(remaining) if wanted is None else wanted.get(pid, 0)
+                    allocation = allocate_return(remaining, requested)
+                    if not allocation:
+                        continue
+                    qty = sum(take for _, take in allocation)
+                    revenue = sum(return_amount(number(sold[pos], 'ThanhTien'), number(sold[pos], 'SoLuong'), take) for pos, take in allocation)
+                    profit = sum(return_amount(number(sold[pos], 'LoiNhuan'), number(sold[pos], 'SoLuong'), take) for pos, take in allocation)
+                    sale = sold[allocation[0][0]]
+
+                    return_row = [''] * len(headers)
+                    for name in ('MaHoaDon', 'MaSanPham', 'TenSanPham', 'DonVi', 'GiaBan', 'GiaVonLucBan', 'HinhThucTT'):
+                        return_row[idx_map[name]] = cell(sale, name)
+                    return_row[idx_map['NgayBan']] = timestamp
+                    return_row[idx_map['SoLuong']] = -qty
+                    return_row[idx_map['ThanhTien']] = -revenue
+                    return_row[idx_map['LoiNhuan']] = -profit
+                    return_rows.append(return_row)
+                    returned_qty[pid] = qty
+
+                    # Doanh thu bị trả tính vào ngày bán gốc, như khi dòng bán bị xóa.
+                    sold_at = _parse_sheet_datetime_series(pd.Series([cell(sale, 'NgayBan')])).iloc[0]
+                    key = (sold_at.strftime('%Y-%m-%d') if pd.notna(sold_at) else '', _normalize_payment_method(cell(sale, 'HinhThucTT')))
+                    delta = deltas.setdefault(key, [0, 0, 0, 0])
+                    delta[0] -= revenue
+                    delta[1] -= profit
+                    delta[3] -= qty
+                if not return_rows:
+                    return False
 
-        st.cache_data.clear()
+                probe = parts[1 + len(sheet_rows)] if len(parts) > 1 + len(sheet_rows) else None
+                start_row = cursor if probe is not None and cursor_confirmed(probe) else _next_append_row(ws_sales, "LichSuBan")
+                end_row = start_row + len(return_rows) - 1
+                ensure_worksheet_capacity(ws_sales, end_row, len(headers))
+                try:
+                    ws_sales.update(
+                        f"{rowcol_to_a1(start_row, 1)}:{rowcol_to_a1(end_row, len(headers))}",
+                        return_rows,
+                        value_input_option='RAW'
+                    )
+                except Exception:
+                    _set_append_row("LichSuBan", None)
+                    raise
+                _set_append_row("LichSuBan", end_row + 1)
+                _index_sales_rows(start_row, return_rows, idx_map['MaHoaDon'])
+            break
+        else:
+            raise RuntimeError("LichSuBan vừa thay đổi trong lúc xử lý, vui lòng thử lại.")
+        _mark_sales_cache_stale()
+
+        # Cộng lại tồn kho của mọi món trong một batch_update.
+        product_rows = _product_rows(ws_inventory, list(returned_qty))
+        inventory_cells = {}
+        for pid, (inventory_row, record) in product_rows.items():
+            inventory_cells[inventory_row] = _record_number(record, 'SoLuong') + returned_qty[pid]
+        if inventory_cells:
+            ws_inventory.batch_update(
+                [{'range': rowcol_to_a1(row, 4), 'values': [[qty]]} for row, qty in inventory_cells.items()],
+                value_input_option='RAW'
+            )
+            _patch_inventory_cache(cells={row: {'SoLuong': qty} for row, qty in inventory_cells.items()})
+
+        # Đơn hết dòng còn hàng sau lần trả này thì bớt một đơn trong ngày bán.
+        order_qty = sum(number(row, 'SoLuong') for row in order_lines) - sum(returned_qty.values())
+        if order_qty <= 0:
+            deltas[next(iter(deltas))][2] = -1
+        _record_rollup(sh, [(day, payment_method, *delta) for (day, payment_method), delta in deltas.items()])
+        _bump_sheet_versions("LichSuBan")
         return True
     except Exception as e:
+        _handle_connection_error(e)
         st.error(f"Lỗi hoàn trả: {e}")
         return False
 
 # --- 6. XU LY THANH TOAN CONG NO ---
+@_api_priority(PRIORITY_POS)
+@_outbox_when_offline("settle_debt")
 def settle_debt(debt_id, payment_amount, customer_name=None, debt_time_raw=None):
     sh = get_connection()
     if not sh:
@@ -697,46 +2283,29 @@ def settle_debt(debt_id, payment_amount, customer_name=None, debt_time_raw=None)
         return {"ok": False, "message": "Số tiền khách trả phải lớn hơn 0."}
 
     try:
-        ws_debt = sh.worksheet("CongNo")
-        headers = _get_sheet_headers(ws_debt)
-        if not headers:
-            return {"ok": False, "message": "Sheet CongNo chưa có dữ liệu hợp lệ."}
-        for col_name in ['MaPhieuNo', 'TrangThai', 'TienDaTra', 'TienConLai', 'TenKH', 'Ngay', 'ThanhTien']:
-            headers = _ensure_sheet_column(ws_debt, headers, col_name)
-
-        try:
-            records = ws_debt.get("A:Z", value_render_option='UNFORMATTED_VALUE')
-        except Exception:
-            try:
-                records = ws_debt.get_all_values(value_render_option='UNFORMATTED_VALUE')
-            except Exception:
-                records = ws_debt.get_all_values()
-        if len(records) < 2:
-            return {"ok": False, "message": "Không tìm thấy dữ liệu công nợ."}
-
-        idx_map = {name: i for i, name in enumerate(headers)}
-        idx_customer = idx_map['TenKH']
-        idx_time = idx_map['Ngay']
-        idx_debt = idx_map['MaPhieuNo']
-        idx_status = idx_map['TrangThai']
-        idx_total = idx_map['ThanhTien']
-        idx_paid = idx_map['TienDaTra']
-        idx_remaining = idx_map['TienConLai']
-
-        matched_rows = []
-        for i in range(1, len(records)):
-            row = records[i]
-            record_debt_id = str(row[idx_debt]).strip() if idx_debt < len(row) else ''
-            ten_kh = str(row[idx_customer]).strip() if idx_customer < len(row) else ''
-            record_time = str(row[idx_time]).strip() if idx_time < len(row) else ''
-
-            is_match = False
-            if debt_id and record_debt_id:
-                is_match = (record_debt_id == debt_id)
-            elif customer_name and debt_time_raw:
-                is_match = (ten_kh == customer_name and record_time == debt_time_raw)
-
-            if is_match:
+        ws_debt = _get_worksheet(sh, "CongNo")
+        required = ['MaPhieuNo', 'TrangThai', 'TienDaTra', 'TienConLai', 'TenKH', 'Ngay', 'ThanhTien']
+        with _DEBT_INDEX_LOCK:
+            index = _debt_index(ws_debt)
+            if any(col_name not in index.idx for col_name in required):
+                headers = _get_sheet_headers(ws_debt)
+                if not headers:
+                    return {"ok": False, "message": "Sheet CongNo chưa có dữ liệu hợp lệ."}
+                for col_name in required:
+                    headers = _ensure_sheet_column(ws_debt, headers, col_name)
+                _invalidate_debt_index()
+
+            slip_key = debt_id or f"LEGACY|{customer_name}|{debt_time_raw}"
+            index, slip_rows = _open_slip_rows(ws_debt, slip_key)
+            if not slip_rows:
+                return {"ok": False, "message": "Không tìm thấy phiếu công nợ còn nợ (có thể đã thanh toán đủ)."}
+
+            idx_map = index.idx
+            idx_total = idx_map['ThanhTien']
+            idx_paid = idx_map['TienDaTra']
+
+            matched_rows = []
+            for sheet_row, row in slip_rows:
                 try:
                     row_total = float(row[idx_total]) if idx_total < len(row) and str(row[idx_total]).strip() != '' else 0.0
                 except Exception:
@@ -749,70 +2318,80 @@ def settle_debt(debt_id, payment_amount, customer_name=None, debt_time_raw=None)
                 row_remain = max(0.0, row_total - row_paid)
 
                 matched_rows.append({
-                    'sheet_row': i + 1,
+                    'sheet_row': sheet_row,
                     'row_total': row_total,
                     'row_paid': row_paid,
                     'row_remain': row_remain,
                 })
 
-        if not matched_rows:
-            return {"ok": False, "message": "Không tìm thấy phiếu công nợ cần cập nhật."}
-
-        total_debt = sum(x['row_total'] for x in matched_rows)
-        total_paid_before = sum(x['row_paid'] for x in matched_rows)
-        total_remaining_before = sum(x['row_remain'] for x in matched_rows)
-
-        if total_remaining_before <= 0:
-            return {"ok": False, "message": "Phiếu này đã thanh toán đủ."}
-        if pay_now > total_remaining_before:
-            return {
-                "ok": False,
-                "message": f"Số tiền trả vượt quá số còn nợ ({int(total_remaining_before):,} đ).".replace(',', '.')
-            }
-
-        remaining_to_allocate = float(pay_now)
-        for row_info in matched_rows:
-            if remaining_to_allocate <= 0:
-                break
+            total_debt = sum(x['row_total'] for x in matched_rows)
+            total_paid_before = sum(x['row_paid'] for x in matched_rows)
+            total_remaining_before = sum(x['row_remain'] for x in matched_rows)
+
+            if total_remaining_before <= 0:
+                return {"ok": False, "message": "Phiếu này đã thanh toán đủ."}
+            if pay_now > total_remaining_before:
+                return {
+                    "ok": False,
+                    "message": f"Số tiền trả vượt quá số còn nợ ({int(total_remaining_before):,} đ).".replace(',', '.')
+                }
+
+            remaining_to_allocate = float(pay_now)
+            for row_info in matched_rows:
+                if remaining_to_allocate <= 0:
+                    break
+
+                take = min(row_info['row_remain'], remaining_to_allocate)
+                row_info['row_paid'] = row_info['row_paid'] + take
+                row_info['row_remain'] = max(0.0, row_info['row_total'] - row_info['row_paid'])
+                remaining_to_allocate -= take
+
+            for row_info in matched_rows:
+                if row_info['row_remain'] <= 0:
+                    row_status = 'DaTra'
+                elif row_info['row_paid'] > 0:
+                    row_status = 'DaTra1Phan'
+                else:
+                    row_status = 'ChuaTra'
+
+                row_info['cells'] = {
+                    'TienDaTra': int(round(row_info['row_paid'])),
+                    'TienConLai': int(round(row_info['row_remain'])),
+                    'TrangThai': row_status,
+                }
+
+            ws_debt.batch_update(
+                [
+                    {'range': rowcol_to_a1(row_info['sheet_row'], idx_map[name] + 1), 'values': [[value]]}
+                    for row_info in matched_rows for name, value in row_info['cells'].items()
+                ],
+                value_input_option='RAW'
+            )
+            for row_info in matched_rows:
+                index.update_row(row_info['sheet_row'], slip_key, row_info['cells'])
 
-            take = min(row_info['row_remain'], remaining_to_allocate)
-            row_info['row_paid'] = row_info['row_paid'] + take
-            row_info['row_remain'] = max(0.0, row_info['row_total'] - row_info['row_paid'])
-            remaining_to_allocate -= take
+            total_paid_after = sum(x['row_paid'] for x in matched_rows)
+            total_remaining_after = max(0.0, total_debt - total_paid_after)
 
-        for row_info in matched_rows:
-            if row_info['row_remain'] <= 0:
-                row_status = 'DaTra'
-            elif row_info['row_paid'] > 0:
-                row_status = 'DaTra1Phan'
+            if total_remaining_after <= 0:
+                status_text = "Đã trả"
             else:
-                row_status = 'ChuaTra'
+                status_text = (
+                    "Đã trả 1 phần, còn thiếu "
+                    + f"{int(round(total_remaining_after)):,} đ".replace(',', '.')
+                )
 
-            ws_debt.update_cell(row_info['sheet_row'], idx_paid + 1, int(round(row_info['row_paid'])))
-            ws_debt.update_cell(row_info['sheet_row'], idx_remaining + 1, int(round(row_info['row_remain'])))
-            ws_debt.update_cell(row_info['sheet_row'], idx_status + 1, row_status)
-
-        total_paid_after = sum(x['row_paid'] for x in matched_rows)
-        total_remaining_after = max(0.0, total_debt - total_paid_after)
-
-        if total_remaining_after <= 0:
-            status_text = "Đã trả"
-        else:
-            status_text = (
-                "Đã trả 1 phần, còn thiếu "
-                + f"{int(round(total_remaining_after)):,} đ".replace(',', '.')
-            )
-
-        st.cache_data.clear()
-        return {
-            "ok": True,
-            "status_text": status_text,
-            "total_debt": int(round(total_debt)),
-            "paid_before": int(round(total_paid_before)),
-            "paid_now": int(round(pay_now)),
-            "paid_after": int(round(total_paid_after)),
-            "remaining": int(round(total_remaining_after)),
-        }
+            _bump_sheet_versions("CongNo")
+            return {
+                "ok": True,
+                "status_text": status_text,
+                "total_debt": int(round(total_debt)),
+                "paid_before": int(round(total_paid_before)),
+                "paid_now": int(round(pay_now)),
+                "paid_after": int(round(total_paid_after)),
+                "remaining": int(round(total_remaining_after)),
+            }
     except Exception as e:
+        _handle_connection_error(e)
         st.error(f"Lỗi cập nhật công nợ: {e}")
         return {"ok": False, "message": f"Lỗi cập nhật công nợ: {e}"}
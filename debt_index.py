@@ -0,0 +1,170 @@
+"""Open debt slips of sheet CongNo, indexed by MaPhieuNo.
+
+Only slips with money still owed are kept, with the sheet row and values of every
+line, so the debt screen and settlement work on open debts instead of the whole
+history. Slips without MaPhieuNo (written before the column existed) are keyed
+``LEGACY|TenKH|Ngay`` like the debt screen does.
+
+Per-customer totals of the open slips are kept alongside and adjusted whenever a
+slip is added, paid or dropped.
+"""
+from datetime import datetime, timedelta
+
+PAID_STATUSES = ('datra', 'da tra', 'paid')
+DATE_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d', '%d/%m/%Y %H:%M:%S', '%d/%m/%Y %H:%M', '%d/%m/%Y')
+SHEETS_EPOCH = datetime(1899, 12, 30)
+
+
+def _number(value, default=0.0):
+    try:
+        return float(value) if str(value).strip() != '' else default
+    except (TypeError, ValueError):
+        return default
+
+
+def parse_debt_date(value):
+    """Datetime of a Ngay cell (text or Sheets serial number), None if unreadable."""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return SHEETS_EPOCH + timedelta(days=value)
+    text = str(value).strip()
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+class DebtIndex:
+    def __init__(self, header):
+        self.header = [str(h).strip() for h in header]
+        self.idx = {name: i for i, name in enumerate(self.header)}
+        self.slips = {}
+        self.slip_totals = {}
+        self.customers = {}
+        self.row_count = 1
+        self.anchor = list(header)
+
+    @classmethod
+    def from_values(cls, values):
+        """Build from the full sheet (header first)."""
+        index = cls(values[0] if values else [])
+        index.add_rows(values[1:], 2)
+        return index
+
+    def cell(self, row, name):
+        i = self.idx.get(name)
+        return row[i] if i is not None and i < len(row) else ''
+
+    def slip_id(self, row):
+        debt_id = str(self.cell(row, 'MaPhieuNo')).strip()
+        if debt_id:
+            return debt_id
+        return f"LEGACY|{str(self.cell(row, 'TenKH')).strip()}|{str(self.cell(row, 'Ngay')).strip()}"
+
+    def amounts(self, row):
+        """(total, paid, remaining) of one line, read the same way as the debt screen."""
+        total = _number(self.cell(row, 'ThanhTien'))
+        paid = _number(self.cell(row, 'TienDaTra'))
+        status = str(self.cell(row, 'TrangThai')).strip().lower()
+        if paid <= 0 and status in PAID_STATUSES:
+            paid = total
+        remaining = _number(self.cell(row, 'TienConLai'), default=None)
+        if remaining is None:
+            remaining = max(total - paid, 0.0)
+        return total, paid, max(remaining, 0.0)
+
+    def add_rows(self, rows, first_row):
+        """Index rows written at ``first_row``...; slips that turn out fully paid are dropped."""
+        touched = set()
+        for offset, row in enumerate(rows):
+            row = list(row)
+            if not any(str(v).strip() for v in row):
+                continue
+            debt_id = self.slip_id(row)
+            self.slips.setdefault(debt_id, {})[first_row + offset] = row
+            touched.add(debt_id)
+        if rows and first_row == self.row_count + 1:
+            self.row_count = first_row + len(rows) - 1
+            self.anchor = list(rows[-1])
+        for debt_id in touched:
+            self._refresh_slip(debt_id)
+
+    def update_row(self, sheet_row, debt_id, values):
+        """Apply written cells ({column name: value}) to an indexed line."""
+        row = self.slips.get(debt_id, {}).get(sheet_row)
+        if row is None:
+            return
+        for name, value in values.items():
+            i = self.idx[name]
+            row.extend([''] * (i + 1 - len(row)))
+            row[i] = value
+        if sheet_row == self.row_count:
+            self.anchor = list(row)
+        self._refresh_slip(debt_id)
+
+    def _refresh_slip(self, debt_id):
+        # Trừ phần cũ của phiếu khỏi tổng của khách, tính lại; phiếu đã trả đủ thì bỏ khỏi chỉ mục.
+        previous = self.slip_totals.pop(debt_id, None)
+        if previous is not None:
+            self._add_to_customer(previous, -1)
+        rows = self.slips[debt_id]
+        lines = [self.amounts(row) for row in rows.values()]
+        if sum(remaining for _, _, remaining in lines) <= 0:
+            del self.slips[debt_id]
+            return
+        first = rows[min(rows)]
+        totals = {
+            'debt_id': debt_id,
+            'customer': str(self.cell(first, 'TenKH')).strip(),
+            'total': sum(total for total, _, _ in lines),
+            'paid': sum(paid for _, paid, _ in lines),
+            'remaining': sum(remaining for _, _, remaining in lines),
+            'date': parse_debt_date(self.cell(first, 'Ngay')),
+        }
+        self.slip_totals[debt_id] = totals
+        self._add_to_customer(totals, 1)
+
+    def _add_to_customer(self, totals, sign):
+        name = totals['customer']
+        customer = self.customers.setdefault(name, {'total': 0.0, 'paid': 0.0, 'remaining': 0.0, 'slips': {}})
+        for key in ('total', 'paid', 'remaining'):
+            customer[key] += sign * totals[key]
+        if sign > 0:
+            customer['slips'][totals['debt_id']] = totals['date']
+        else:
+            customer['slips'].pop(totals['debt_id'], None)
+            if not customer['slips']:
+                del self.customers[name]
+
+    def slip_rows(self, debt_id):
+        """[(sheet row, values)] of an open slip, in sheet order."""
+        return sorted(self.slips.get(debt_id, {}).items())
+
+    def find_legacy(self, customer_name, debt_time_raw):
+        return self.slip_rows(f"LEGACY|{customer_name}|{debt_time_raw}")
+
+    def open_rows(self):
+        """Every line of every open slip as [(sheet row, values)], in sheet order."""
+        return sorted(item for rows in self.slips.values() for item in rows.items())
+
+    def open_count(self):
+        return len(self.slips)
+
+    def customer_summary(self, name):
+        """Totals of a customer's open slips, or None when the customer owes nothing."""
+        customer = self.customers.get(name)
+        if customer is None:
+            return None
+        dates = [d for d in customer['slips'].values() if d is not None]
+        return {
+            'TenKH': name,
+            'TongNo': customer['total'],
+            'DaTra': customer['paid'],
+            'ConNo': customer['remaining'],
+            'SoPhieu': len(customer['slips']),
+            'NgayCuNhat': min(dates) if dates else None,
+        }
+
+    def customer_summaries(self):
+        return [self.customer_summary(name) for name in sorted(self.customers)]
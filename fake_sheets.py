@@ -0,0 +1,231 @@
+"""In-memory Spreadsheet/Worksheet with simulated API latency and quota accounting (for benchmarks).
+
+Only the gspread surface data_manager uses is implemented. Every method call counts
+as one API request: it sleeps ``latency_ms`` plus ``per_kcell_ms`` for each thousand
+cells sent or returned, and is logged in the spreadsheet's QuotaTracker.
+"""
+import threading
+import time
+from collections import deque
+
+import gspread
+
+from sheet_utils import parse_a1_range
+
+WRITE_METHODS = frozenset({
+    'update', 'update_cell', 'batch_update', 'append_row', 'append_rows', 'delete_rows', 'resize', 'add_worksheet',
+})
+
+
+class _QuotaResponse:
+    status_code = 429
+    headers = {}
+    text = 'Quota exceeded'
+
+    def json(self):
+        return {'error': {'code': 429, 'message': self.text, 'status': 'RESOURCE_EXHAUSTED'}}
+
+
+class QuotaTracker:
+    """Sliding one-minute request counts for reads and writes, like the Sheets per-user quota."""
+
+    def __init__(self, read_per_minute=60, write_per_minute=60, enforce=False, clock=time.monotonic):
+        self.limits = {'read': read_per_minute, 'write': write_per_minute}
+        self.enforce = enforce
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._recent = {'read': deque(), 'write': deque()}
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = {'read': 0, 'write': 0}
+            self.by_method = {}
+            self.cells = 0
+            self.exceeded = 0
+            self.peak_per_minute = {'read': 0, 'write': 0}
+
+    def record(self, method, cells=0):
+        kind = 'write' if method in WRITE_METHODS else 'read'
+        now = self._clock()
+        with self._lock:
+            recent = self._recent[kind]
+            recent.append(now)
+            while recent and recent[0] <= now - 60:
+                recent.popleft()
+            over = len(recent) > self.limits[kind]
+            if over and self.enforce:
+                recent.pop()
+            else:
+                self.calls[kind] += 1
+                self.by_method[method] = self.by_method.get(method, 0) + 1
+                self.cells += cells
+            self.peak_per_minute[kind] = max(self.peak_per_minute[kind], len(recent))
+            self.exceeded += int(over)
+        if over and self.enforce:
+            raise gspread.exceptions.APIError(_QuotaResponse())
+
+    def summary(self):
+        with self._lock:
+            return {
+                'reads': self.calls['read'],
+                'writes': self.calls['write'],
+                'by_method': dict(self.by_method),
+                'cells': self.cells,
+                'quota_exceeded': self.exceeded,
+                'peak_reads_per_minute': self.peak_per_minute['read'],
+                'peak_writes_per_minute': self.peak_per_minute['write'],
+            }
+
+
+def _cells(values):
+    return sum(len(row) for row in values)
+
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet, title, rows=1000, cols=26):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.row_count = rows
+        self.col_count = cols
+        self.data = []
+
+    def _api(self, method, cells=0):
+        self.spreadsheet.api_call(method, cells)
+
+    # --- grid helpers ---
+    def _ensure(self, row, col):
+        while len(self.data) < row:
+            self.data.append([])
+        line = self.data[row - 1]
+        if len(line) < col:
+            line.extend([''] * (col - len(line)))
+        return line
+
+    def _last_row(self):
+        last = len(self.data)
+        while last and not any(str(v).strip() for v in self.data[last - 1]):
+            last -= 1
+        return last
+
+    def _block(self, start_row, start_col, end_row, end_col):
+        end_row = min(end_row or self._last_row(), len(self.data))
+        result = []
+        for line in self.data[(start_row or 1) - 1:end_row]:
+            row = list(line[(start_col or 1) - 1:end_col])
+            while row and row[-1] == '':
+                row.pop()
+            result.append(row)
+        while result and not result[-1]:
+            result.pop()
+        return result
+
+    def _write_block(self, start_row, start_col, values):
+        for offset, row in enumerate(values):
+            line = self._ensure(start_row + offset, start_col + len(row) - 1)
+            line[start_col - 1:start_col - 1 + len(row)] = list(row)
+
+    def load(self, values):
+        """Replace the content without counting an API call (test data setup)."""
+        self.data = [list(row) for row in values]
+        self.row_count = max(self.row_count, len(self.data))
+        self.col_count = max([self.col_count] + [len(row) for row in self.data])
+
+    # --- reads ---
+    def get_all_values(self, value_render_option=None, **kwargs):
+        width = max([len(row) for row in self.data[:self._last_row()]] + [0])
+        values = [list(row) + [''] * (width - len(row)) for row in self.data[:self._last_row()]]
+        self._api('get_all_values', _cells(values))
+        return values
+
+    def get(self, range_name=None, value_render_option=None, **kwargs):
+        values = self._block(*parse_a1_range(range_name)) if range_name else self._block(1, 1, None, None)
+        self._api('get', _cells(values))
+        return values
+
+    def batch_get(self, ranges, value_render_option=None, **kwargs):
+        values = [self._block(*parse_a1_range(r)) for r in ranges]
+        self._api('batch_get', sum(_cells(v) for v in values))
+        return values
+
+    def row_values(self, row, value_render_option=None, **kwargs):
+        values = self._block(row, 1, row, None)
+        self._api('row_values', _cells(values))
+        return values[0] if values else []
+
+    def col_values(self, col, value_render_option=None, **kwargs):
+        values = [line[col - 1] if len(line) >= col else '' for line in self.data]
+        while values and str(values[-1]).strip() == '':
+            values.pop()
+        self._api('col_values', len(values))
+        return values
+
+    # --- writes ---
+    def update_cell(self, row, col, value):
+        self._api('update_cell', 1)
+        self._ensure(row, col)[col - 1] = value
+
+    def update(self, range_name, values=None, value_input_option=None, **kwargs):
+        if isinstance(range_name, list):
+            range_name, values = values, range_name
+        self._api('update', _cells(values))
+        start_row, start_col, _, _ = parse_a1_range(range_name)
+        self._write_block(start_row or 1, start_col or 1, values)
+
+    def batch_update(self, data, value_input_option=None, **kwargs):
+        self._api('batch_update', sum(_cells(item['values']) for item in data))
+        for item in data:
+            start_row, start_col, _, _ = parse_a1_range(item['range'])
+            self._write_block(start_row or 1, start_col or 1, item['values'])
+
+    def append_row(self, values, **kwargs):
+        return self.append_rows([values], _method='append_row')
+
+    def append_rows(self, values, _method='append_rows', **kwargs):
+        self._api(_method, _cells(values))
+        start = self._last_row() + 1
+        self._write_block(start, 1, values)
+        self.row_count = max(self.row_count, start + len(values) - 1)
+        return {'updates': {'updatedRange': f"{self.title}!A{start}:A{start + len(values) - 1}"}}
+
+    def delete_rows(self, start_index, end_index=None):
+        self._api('delete_rows')
+        del self.data[start_index - 1:(end_index or start_index)]
+        self.row_count -= (end_index or start_index) - start_index + 1
+
+    def resize(self, rows=None, cols=None):
+        self._api('resize')
+        self.row_count = rows if rows is not None else self.row_count
+        self.col_count = cols if cols is not None else self.col_count
+
+
+class FakeSpreadsheet:
+    def __init__(self, latency_ms=0.0, per_kcell_ms=0.0, quota=None, sleep=time.sleep):
+        self.latency_ms = latency_ms
+        self.per_kcell_ms = per_kcell_ms
+        self.quota = quota or QuotaTracker()
+        self._sleep = sleep
+        self._sheets = {}
+
+    def api_call(self, method, cells=0):
+        self.quota.record(method, cells)
+        delay = self.latency_ms + self.per_kcell_ms * cells / 1000.0
+        if delay > 0:
+            self._sleep(delay / 1000.0)
+
+    def add_sheet(self, title, values=(), rows=1000, cols=26):
+        """Create a sheet with content without counting API calls (test data setup)."""
+        ws = FakeWorksheet(self, title, rows, cols)
+        ws.load(values)
+        self._sheets[title] = ws
+        return ws
+
+    def worksheet(self, title):
+        self.api_call('worksheet')
+        if title not in self._sheets:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return self._sheets[title]
+
+    def add_worksheet(self, title, rows=1000, cols=26, **kwargs):
+        self.api_call('add_worksheet')
+        return self.add_sheet(title, rows=rows, cols=cols)
@@ -1,4 +1,5 @@
 import streamlit as st
+from streamlit.errors import StreamlitAPIException
 import pandas as pd
 import plotly.graph_objects as go
 from datetime import datetime, date
@@ -36,6 +37,8 @@ st.markdown("""
 # --- QUAN LY STATE ---
 if 'is_logged_in' not in st.session_state:
     st.session_state['is_logged_in'] = False
+if 'is_admin' not in st.session_state:
+    st.session_state['is_admin'] = False
 if 'sales_cart' not in st.session_state:
     st.session_state['sales_cart'] = []
 if 'import_cart' not in st.session_state:
@@ -44,10 +47,66 @@ if 'debt_cart' not in st.session_state:
     st.session_state['debt_cart'] = []
 if 'debt_selected' not in st.session_state:
     st.session_state['debt_selected'] = None
+if 'order_selected' not in st.session_state:
+    st.session_state['order_selected'] = None
+if 'debt_table_gen' not in st.session_state:
+    st.session_state['debt_table_gen'] = 0
 if 'sales_payment_method' not in st.session_state:
     st.session_state['sales_payment_method'] = "Tiền mặt"
 
 # --- HAM HO TRO ---
+SEARCH_RESULT_LIMIT = 50  # Số sản phẩm tối đa hiển thị cho một từ khóa tìm kiếm
+DEBT_PAGE_SIZE = 50  # Số phiếu nợ mỗi trang trong danh sách công nợ
+DEBT_SORT_OPTIONS = {
+    "Ngày mua nợ (mới nhất trước)": ('NgayParsed', False),
+    "Ngày mua nợ (cũ nhất trước)": ('NgayParsed', True),
+    "Còn thiếu (nhiều nhất trước)": ('ConNo', False),
+    "Khách hàng (A-Z)": ('TenKH', True),
+}
+ORDER_PAGE_SIZE = 25  # Số đơn mỗi trang trong lịch sử đơn hàng
+DEBT_VIEW_SLIPS = "Từng phiếu nợ"
+DEBT_VIEW_CUSTOMERS = "Theo khách hàng"
+
+# st.fragment (Streamlit >= 1.37) hoặc st.experimental_fragment (1.33-1.36); bản cũ hơn không có
+# fragment thì các panel chạy như hàm thường và mọi thao tác chạy lại cả trang như trước.
+_st_fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None)
+
+def fragment(func):
+    return _st_fragment(func) if _st_fragment else func
+
+def rerun_fragment():
+    # Chỉ chạy lại fragment đang chạy. Bản Streamlit chưa hỗ trợ scope, hoặc lượt chạy hiện tại
+    # là chạy cả trang (scope="fragment" chỉ hợp lệ khi fragment tự chạy lại) thì chạy lại cả trang.
+    if _st_fragment is None:
+        st.rerun()
+    try:
+        st.rerun(scope="fragment")
+    except (TypeError, StreamlitAPIException):
+        st.rerun()
+
+def lazy_tabs(labels, key):
+    """[(tab, đang mở)] cho st.tabs: chỉ tab đang mở mới cần dựng nội dung. Bản Streamlit chưa
+    hỗ trợ on_change cho tabs thì mọi tab đều được coi là đang mở (dựng hết như trước)."""
+    try:
+        tabs = st.tabs(labels, key=key, on_change="rerun")
+    except TypeError:
+        return [(tab, True) for tab in st.tabs(labels)]
+    return [(tab, getattr(tab, 'open', None) is not False) for tab in tabs]
+
+def paginate_frame(df, key, page_size, unit):
+    """Trả về (các dòng của trang đang chọn, số trang); ô chọn trang chỉ hiện khi có hơn một trang."""
+    page_count = max(1, -(-len(df) // page_size))
+    if page_count == 1:
+        return df, 1
+    # Trang nằm trong session_state (không truyền value=) để kẹp lại khi danh sách ngắn đi
+    # mà Streamlit không cảnh báo widget vừa có value mặc định vừa bị gán qua Session State.
+    st.session_state[key] = min(max(int(st.session_state.get(key, 1)), 1), page_count)
+    p1, p2 = st.columns([1, 3])
+    page = int(p1.number_input(f"Trang (1-{page_count})", min_value=1, max_value=page_count, step=1, key=key))
+    start = (page - 1) * page_size
+    p2.caption(f"Hiển thị {start + 1}-{min(start + page_size, len(df))} / {len(df)} {unit}")
+    return df.iloc[start:start + page_size], page
+
 def format_currency(amount):
     # VN style: dot nghìn, no decimal
     return f"{amount:,.0f} đ".replace(',', '.')
@@ -191,6 +250,31 @@ def load_debt_records_safe():
         df['TienConLai'] = ''
     return df
 
+def load_debt_customers_safe(df_debt):
+    fn = getattr(dm, "load_debt_customers", None)
+    if callable(fn):
+        try:
+            df = fn()
+            if isinstance(df, pd.DataFrame):
+                return df
+        except Exception as e:
+            st.warning(f"Lỗi khi tải công nợ theo khách từ data_manager: {e}")
+
+    # Fallback cho bản data_manager cũ: tự cộng dồn từ danh sách phiếu còn nợ.
+    if df_debt.empty:
+        return pd.DataFrame(columns=['TenKH', 'TongNo', 'DaTra', 'ConNo', 'SoPhieu', 'NgayCuNhat'])
+    df = (
+        df_debt.groupby('TenKH', as_index=False)
+        .agg(
+            TongNo=('ThanhTien', 'sum'),
+            DaTra=('TienDaTra', 'sum'),
+            ConNo=('TienConLai', 'sum'),
+            SoPhieu=('MaPhieuNo', 'nunique'),
+            NgayCuNhat=('NgayParsed', 'min')
+        )
+    )
+    return df.sort_values(by='ConNo', ascending=False).reset_index(drop=True)
+
 # --- RENDER HEADER ---
 def render_header():
     c1, c2 = st.columns([1, 8])
@@ -215,7 +299,12 @@ def render_login():
             submitted = st.form_submit_button("Truy cập ngay")
             if submitted:
                 sys_pass = st.secrets.get("app_password", "123456")
-                if password == sys_pass:
+                admin_pass = st.secrets.get("admin_password")
+                if admin_pass and password == admin_pass:
+                    st.session_state['is_logged_in'] = True
+                    st.session_state['is_admin'] = True
+                    st.rerun()
+                elif password == sys_pass:
                     st.session_state['is_logged_in'] = True
                     st.rerun()
                 else:
@@ -224,157 +313,168 @@ def render_login():
 # --- 2. MAN HINH BAN HANG (VỚI SỬA GIÁ TẠM + NHẬP NHANH + XÓA TỪNG MÓN) ---
 def render_sales(df_inv):
     st.subheader("🛒 Bán Hàng Tại Quầy")
+    render_sales_pos(df_inv)
+    render_sales_day()
+
+# Quầy bán và bảng hàng đã bán là các fragment riêng: thao tác giỏ hàng chỉ chạy lại phần
+# quầy (xóa món chỉ chạy lại giỏ), không tải lại tồn kho hay bảng thống kê theo ngày.
+@fragment
+def render_sales_pos(df_inv):
     col_search, col_cart = st.columns([5, 5], gap="large")
-    
     with col_search:
-        st.info("Tìm kiếm sản phẩm")
-        if not df_inv.empty:
-            search_term = st.text_input("🔍 Nhập tên hoặc mã sản phẩm", key="sales_search")
-            
-            filtered_df = df_inv
-            if search_term:
-                filtered_df = df_inv[
-                    df_inv['TenSanPham'].str.contains(search_term, case=False, na=False) |
-                    df_inv['MaSanPham'].str.contains(search_term, case=False, na=False)
-                ]
+        render_sales_search(df_inv)
+    with col_cart:
+        render_sales_cart()
+
+def render_sales_search(df_inv):
+    st.info("Tìm kiếm sản phẩm")
+    if not df_inv.empty:
+        search_term = st.text_input("🔍 Nhập tên hoặc mã sản phẩm", key="sales_search")
+        
+        filtered_df = dm.search_products(df_inv, search_term, limit=SEARCH_RESULT_LIMIT)
+        
+        if not filtered_df.empty:
+            product_options = dm.get_product_options(df_inv)
+            selected_id = st.selectbox(
+                "Chọn sản phẩm:",
+                [""] + dm.product_ids(filtered_df).drop_duplicates().tolist(),
+                format_func=lambda pid: product_options['labels'].get(pid, pid),
+                key="sales_select"
+            )
             
-            if not filtered_df.empty:
-                options = filtered_df.apply(
-                    lambda x: f"{x['TenSanPham']} | Mã: {x['MaSanPham']} | Tồn: {int(x['SoLuong'])} {x['DonVi']}", axis=1
-                ).tolist()
-                selected_str = st.selectbox("Chọn sản phẩm:", [""] + options, key="sales_select")
+            if selected_id:
+                selected_item = df_inv.iloc[product_options['positions'][selected_id]]
                 
-                if selected_str:
-                    selected_item = filtered_df[
-                        filtered_df.apply(
-                            lambda x: f"{x['TenSanPham']} | Mã: {x['MaSanPham']} | Tồn: {int(x['SoLuong'])} {x['DonVi']}", axis=1
-                        ) == selected_str
-                    ].iloc[0]
+                with st.container(border=True):
+                    st.markdown(f"### {selected_item['TenSanPham']}")
+                    c1, c2, c3 = st.columns(3)
+                    c1.metric("Mã SP", selected_item['MaSanPham'])
+                    c2.metric("Đơn vị", selected_item['DonVi'])
+                    c3.metric("Tồn kho hiện tại", int(selected_item['SoLuong']))
                     
-                    with st.container(border=True):
-                        st.markdown(f"### {selected_item['TenSanPham']}")
-                        c1, c2, c3 = st.columns(3)
-                        c1.metric("Mã SP", selected_item['MaSanPham'])
-                        c2.metric("Đơn vị", selected_item['DonVi'])
-                        c3.metric("Tồn kho hiện tại", int(selected_item['SoLuong']))
-                        
-                        if selected_item['SoLuong'] < 10 and selected_item['SoLuong'] > 0:
-                            st.warning(f"⚠️ Tồn kho thấp: chỉ còn {int(selected_item['SoLuong'])} {selected_item['DonVi']}! Nên nhập thêm.")
-                        elif selected_item['SoLuong'] == 0:
-                            st.error(f"🚨 Hết hàng: Tồn kho = 0!")
-                        
-                        st.divider()
-                        
-                        col_price_temp, col_qty = st.columns([1, 1])
-                        default_price = float(selected_item['GiaBan'])
-                        temp_price = col_price_temp.number_input("Giá bán tạm thời (đ)", min_value=0.0, value=default_price, step=1000.0, key=f"temp_price_{selected_item['MaSanPham']}", format="%.0f")
-                        qty_sell = col_qty.number_input("Số lượng mua:", min_value=1, value=1, step=1, key=f"qty_sell_{selected_item['MaSanPham']}")
+                    if selected_item['SoLuong'] < 10 and selected_item['SoLuong'] > 0:
+                        st.warning(f"⚠️ Tồn kho thấp: chỉ còn {int(selected_item['SoLuong'])} {selected_item['DonVi']}! Nên nhập thêm.")
+                    elif selected_item['SoLuong'] == 0:
+                        st.error(f"🚨 Hết hàng: Tồn kho = 0!")
+                    
+                    st.divider()
+                    
+                    col_price_temp, col_qty = st.columns([1, 1])
+                    default_price = float(selected_item['GiaBan'])
+                    temp_price = col_price_temp.number_input("Giá bán tạm thời (đ)", min_value=0.0, value=default_price, step=1000.0, key=f"temp_price_{selected_item['MaSanPham']}", format="%.0f")
+                    qty_sell = col_qty.number_input("Số lượng mua:", min_value=1, value=1, step=1, key=f"qty_sell_{selected_item['MaSanPham']}")
 
-                        if qty_sell > selected_item['SoLuong']:
-                            st.error(f"Không đủ tồn kho! Cần thêm ít nhất {qty_sell - selected_item['SoLuong']} {selected_item['DonVi']}.")
+                    if qty_sell > selected_item['SoLuong']:
+                        st.error(f"Không đủ tồn kho! Cần thêm ít nhất {qty_sell - selected_item['SoLuong']} {selected_item['DonVi']}.")
+                        
+                        st.markdown("#### 📦 Nhập nhanh bổ sung tồn kho ngay tại đây")
+                        with st.form(key=f"quick_import_realtime_{selected_item['MaSanPham']}"):
+                            col_q, col_gn, col_gb = st.columns(3)
+                            suggested_qty = max(10, qty_sell - selected_item['SoLuong'])
+                            quick_qty = col_q.number_input("Số lượng nhập thêm", min_value=1, value=suggested_qty)
+                            quick_gn = col_gn.number_input("Giá nhập mới", value=float(selected_item['GiaNhap']), step=1000.0, format="%.0f")
+                            quick_gb = col_gb.number_input("Giá bán mới (nếu thay đổi)", value=float(selected_item['GiaBan']), step=1000.0, format="%.0f")
                             
-                            st.markdown("#### 📦 Nhập nhanh bổ sung tồn kho ngay tại đây")
-                            with st.form(key=f"quick_import_realtime_{selected_item['MaSanPham']}"):
-                                col_q, col_gn, col_gb = st.columns(3)
-                                suggested_qty = max(10, qty_sell - selected_item['SoLuong'])
-                                quick_qty = col_q.number_input("Số lượng nhập thêm", min_value=1, value=suggested_qty)
-                                quick_gn = col_gn.number_input("Giá nhập mới", value=float(selected_item['GiaNhap']), step=1000.0, format="%.0f")
-                                quick_gb = col_gb.number_input("Giá bán mới (nếu thay đổi)", value=float(selected_item['GiaBan']), step=1000.0, format="%.0f")
-                                
-                                if st.form_submit_button("💾 Nhập nhanh & Thêm vào giỏ ngay", type="primary"):
-                                    if quick_gn > 0 and quick_gb > 0:  # Validate
-                                        temp_import = [{
+                            if st.form_submit_button("💾 Nhập nhanh & Thêm vào giỏ ngay", type="primary"):
+                                if quick_gn > 0 and quick_gb > 0:  # Validate
+                                    temp_import = [{
+                                        "MaSanPham": selected_item['MaSanPham'],
+                                        "TenSanPham": selected_item['TenSanPham'],
+                                        "DonVi": selected_item['DonVi'],
+                                        "SoLuong": quick_qty,
+                                        "GiaNhap": quick_gn,
+                                        "GiaBan": quick_gb,
+                                        "NhaCungCap": ""
+                                    }]
+                                    
+                                    if dm.process_import(temp_import):
+                                        st.success(f"Đã nhập thêm {quick_qty} {selected_item['DonVi']} vào kho!")
+                                        st.session_state['sales_cart'].append({
                                             "MaSanPham": selected_item['MaSanPham'],
                                             "TenSanPham": selected_item['TenSanPham'],
                                             "DonVi": selected_item['DonVi'],
-                                            "SoLuong": quick_qty,
-                                            "GiaNhap": quick_gn,
-                                            "GiaBan": quick_gb,
-                                            "NhaCungCap": ""
-                                        }]
-                                        
-                                        if dm.process_import(temp_import):
-                                            st.success(f"Đã nhập thêm {quick_qty} {selected_item['DonVi']} vào kho!")
-                                            st.session_state['sales_cart'].append({
-                                                "MaSanPham": selected_item['MaSanPham'],
-                                                "TenSanPham": selected_item['TenSanPham'],
-                                                "DonVi": selected_item['DonVi'],
-                                                "GiaBan": temp_price,
-                                                "SoLuongBan": qty_sell,
-                                                "ThanhTien": qty_sell * temp_price
-                                            })
-                                            st.toast("Đã thêm vào giỏ thành công!")
-                                            st.rerun()
-                                    else:
-                                        st.error("Giá nhập/bán không hợp lệ!")
-
-                        if st.button("➕ Thêm vào giỏ", type="primary", key=f"add_normal_{selected_item['MaSanPham']}"):
-                            if qty_sell <= selected_item['SoLuong'] and temp_price > 0:
-                                st.session_state['sales_cart'].append({
-                                    "MaSanPham": selected_item['MaSanPham'],
-                                    "TenSanPham": selected_item['TenSanPham'],
-                                    "DonVi": selected_item['DonVi'],
-                                    "GiaBan": temp_price,
-                                    "SoLuongBan": qty_sell,
-                                    "ThanhTien": qty_sell * temp_price
-                                })
-                                st.toast(f"Đã thêm {selected_item['TenSanPham']} vào giỏ với giá {format_currency(temp_price)}!")
-                                st.rerun()
-                            else:
-                                st.error("Vui lòng kiểm tra giá và tồn kho!")
-            else:
-                st.warning("Không tìm thấy sản phẩm nào.")
+                                            "GiaBan": temp_price,
+                                            "SoLuongBan": qty_sell,
+                                            "ThanhTien": qty_sell * temp_price
+                                        })
+                                        st.toast("Đã thêm vào giỏ thành công!")
+                                        st.rerun()
+                                else:
+                                    st.error("Giá nhập/bán không hợp lệ!")
+
+                    if st.button("➕ Thêm vào giỏ", type="primary", key=f"add_normal_{selected_item['MaSanPham']}"):
+                        if qty_sell <= selected_item['SoLuong'] and temp_price > 0:
+                            st.session_state['sales_cart'].append({
+                                "MaSanPham": selected_item['MaSanPham'],
+                                "TenSanPham": selected_item['TenSanPham'],
+                                "DonVi": selected_item['DonVi'],
+                                "GiaBan": temp_price,
+                                "SoLuongBan": qty_sell,
+                                "ThanhTien": qty_sell * temp_price
+                            })
+                            st.toast(f"Đã thêm {selected_item['TenSanPham']} vào giỏ với giá {format_currency(temp_price)}!")
+                        else:
+                            st.error("Vui lòng kiểm tra giá và tồn kho!")
         else:
-            st.warning("Kho hàng trống.")
+            st.warning("Không tìm thấy sản phẩm nào.")
+    else:
+        st.warning("Kho hàng trống.")
 
-    with col_cart:
-        st.info("Giỏ hàng hiện tại")
-        if st.session_state['sales_cart']:
-            total_bill = 0
-            for idx in range(len(st.session_state['sales_cart']) - 1, -1, -1):
-                item = st.session_state['sales_cart'][idx]
-                with st.container(border=True):
-                    col_name, col_qty, col_price, col_total, col_del = st.columns([3, 1, 2, 2, 1])
-                    col_name.write(f"**{item['TenSanPham']}** ({item['MaSanPham']})")
-                    col_qty.write(f"{item['SoLuongBan']} {item['DonVi']}")
-                    col_price.write(f"Giá: {format_currency(item['GiaBan'])}")
-                    item_total = item['SoLuongBan'] * item['GiaBan']
-                    col_total.write(f"**{format_currency(item_total)}**")
-                    if col_del.button("🗑", key=f"del_cart_{idx}"):
-                        st.session_state['sales_cart'].pop(idx)
-                        st.rerun()
-                total_bill += item_total
-            
-            st.markdown(f"<h3 style='text-align: right; color: red;'>Tổng cộng: {format_currency(total_bill)}</h3>", unsafe_allow_html=True)
+@fragment
+def render_sales_cart():
+    st.info("Giỏ hàng hiện tại")
+    if st.session_state['sales_cart']:
+        total_bill = 0
+        for idx in range(len(st.session_state['sales_cart']) - 1, -1, -1):
+            item = st.session_state['sales_cart'][idx]
+            with st.container(border=True):
+                col_name, col_qty, col_price, col_total, col_del = st.columns([3, 1, 2, 2, 1])
+                col_name.write(f"**{item['TenSanPham']}** ({item['MaSanPham']})")
+                col_qty.write(f"{item['SoLuongBan']} {item['DonVi']}")
+                col_price.write(f"Giá: {format_currency(item['GiaBan'])}")
+                item_total = item['SoLuongBan'] * item['GiaBan']
+                col_total.write(f"**{format_currency(item_total)}**")
+                if col_del.button("🗑", key=f"del_cart_{idx}"):
+                    st.session_state['sales_cart'].pop(idx)
+                    rerun_fragment()
+            total_bill += item_total
+        
+        st.markdown(f"<h3 style='text-align: right; color: red;'>Tổng cộng: {format_currency(total_bill)}</h3>", unsafe_allow_html=True)
 
-            payment_method = st.radio(
-                "Hình thức thanh toán",
-                ["Tiền mặt", "Chuyển khoản"],
-                horizontal=True,
-                key="sales_payment_method"
-            )
-            
-            c1, c2 = st.columns(2)
-            if c1.button("🗑 Xóa toàn bộ giỏ"):
+        payment_method = st.radio(
+            "Hình thức thanh toán",
+            ["Tiền mặt", "Chuyển khoản"],
+            horizontal=True,
+            key="sales_payment_method"
+        )
+        
+        c1, c2 = st.columns(2)
+        if c1.button("🗑 Xóa toàn bộ giỏ"):
+            st.session_state['sales_cart'] = []
+            rerun_fragment()
+        if c2.button("✅ THANH TOÁN", type="primary"):
+            checkout_result = process_checkout_safe(st.session_state['sales_cart'], payment_method)
+            if checkout_result:
                 st.session_state['sales_cart'] = []
+                st.balloons()
+                if isinstance(checkout_result, str):
+                    st.toast(f"Đã nhận đơn {checkout_result}")
+                st.success(f"Thanh toán thành công ({payment_method})!")
                 st.rerun()
-            if c2.button("✅ THANH TOÁN", type="primary"):
-                if process_checkout_safe(st.session_state['sales_cart'], payment_method):
-                    st.session_state['sales_cart'] = []
-                    st.balloons()
-                    st.success(f"Thanh toán thành công ({payment_method})!")
-                    st.rerun()
-        else:
-            st.caption("Chưa có hàng trong giỏ.")
+    else:
+        st.caption("Chưa có hàng trong giỏ.")
 
+@fragment
+def render_sales_day():
     # Thêm bảng thống kê hàng đã bán theo ngày
     st.subheader("📋 Danh sách hàng đã bán")
-    df_sales = dm.load_sales_history()
-    if not df_sales.empty and 'NgayBan' in df_sales.columns:
+    # Tổng theo ngày lấy từ bảng tổng hợp TongHopNgay; chỉ bảng chi tiết mới đọc các dòng của ngày đó.
+    df_rollup = dm.load_daily_rollup()
+    if not df_rollup.empty:
         tz = pytz.timezone('Asia/Ho_Chi_Minh')
         today_date = datetime.now(tz).date()
 
-        valid_dates = df_sales['NgayBan'].dropna().dt.date
+        valid_dates = df_rollup['Ngay'].dropna().dt.date
         if not valid_dates.empty:
             min_date = valid_dates.min()
             # Luôn cho phép chọn ngày hôm nay dù chưa phát sinh đơn.
@@ -393,21 +493,10 @@ def render_sales(df_inv):
             key="sales_day_filter"
         )
 
-        df_day = df_sales[(df_sales['NgayBan'].dt.date == selected_date) & (df_sales['SoLuong'] > 0)]
-        if not df_day.empty:
-            df_day = df_day.copy()
-            payment_values = df_day['HinhThucTT'] if 'HinhThucTT' in df_day.columns else ''
-            payment_values = pd.Series(payment_values, index=df_day.index).fillna('').astype(str).str.strip()
-            payment_norm = payment_values.str.lower()
-            is_transfer = (
-                payment_norm.str.contains('chuy')
-                | payment_norm.str.contains('khoan')
-                | payment_norm.str.contains('bank')
-                | payment_norm.eq('ck')
-            )
-
-            total_day = df_day['ThanhTien'].sum()
-            transfer_day = df_day.loc[is_transfer, 'ThanhTien'].sum()
+        rollup_day = df_rollup[df_rollup['Ngay'].dt.date == selected_date]
+        if not rollup_day.empty and rollup_day['SoLuongSP'].sum() > 0:
+            total_day = rollup_day['DoanhThu'].sum()
+            transfer_day = rollup_day.loc[rollup_day['HinhThucTT'] == 'Chuyển khoản', 'DoanhThu'].sum()
             cash_day = total_day - transfer_day
 
             m1, m2, m3 = st.columns(3)
@@ -415,6 +504,11 @@ def render_sales(df_inv):
             m2.metric("Chuyển khoản", format_currency(transfer_day))
             m3.metric("Tiền mặt", format_currency(cash_day))
 
+            df_day = dm.load_sales_period(
+                selected_date, selected_date,
+                columns=['MaSanPham', 'TenSanPham', 'SoLuong', 'ThanhTien', 'LoiNhuan']
+            )
+            df_day = df_day[df_day['SoLuong'] > 0]
             df_summary = df_day.groupby(['MaSanPham', 'TenSanPham']).agg({
                 'SoLuong': 'sum',
                 'ThanhTien': 'sum',
@@ -465,163 +559,7 @@ def render_debt(df_inv):
     )
     debt_purchase_dt = tz.localize(datetime.combine(debt_purchase_date, debt_purchase_time))
 
-    col_search, col_cart = st.columns([5, 5], gap="large")
-
-    with col_search:
-        st.info("Tìm kiếm sản phẩm để thêm vào giỏ nợ")
-        if not inv.empty:
-            search_term = st.text_input("🔍 Nhập tên hoặc mã sản phẩm", key="debt_search")
-
-            filtered_df = inv
-            if search_term:
-                filtered_df = inv[
-                    inv['TenSanPham'].str.contains(search_term, case=False, na=False) |
-                    inv['MaSanPham'].str.contains(search_term, case=False, na=False)
-                ]
-
-            filtered_df = filtered_df.reset_index(drop=True)
-            if not filtered_df.empty:
-                options = filtered_df.apply(
-                    lambda x: f"{x['TenSanPham']} | Mã: {x['MaSanPham']} | Tồn: {int(x['SoLuong'])} {x['DonVi']}", axis=1
-                ).tolist()
-                selected_str = st.selectbox("Chọn sản phẩm:", [""] + options, key="debt_select")
-
-                if selected_str:
-                    selected_rows = filtered_df[
-                        filtered_df.apply(
-                            lambda x: f"{x['TenSanPham']} | Mã: {x['MaSanPham']} | Tồn: {int(x['SoLuong'])} {x['DonVi']}", axis=1
-                        ) == selected_str
-                    ]
-                    if selected_rows.empty:
-                        st.error("Không xác định được sản phẩm đã chọn. Vui lòng chọn lại.")
-                        return
-                    selected_item = selected_rows.iloc[0]
-
-                    with st.container(border=True):
-                        st.markdown(f"### {selected_item['TenSanPham']}")
-                        c1, c2, c3 = st.columns(3)
-                        c1.metric("Mã SP", selected_item['MaSanPham'])
-                        c2.metric("Đơn vị", selected_item['DonVi'])
-                        c3.metric("Tồn kho hiện tại", int(selected_item['SoLuong']))
-
-                        if selected_item['SoLuong'] < 10 and selected_item['SoLuong'] > 0:
-                            st.warning(f"⚠️ Tồn kho thấp: chỉ còn {int(selected_item['SoLuong'])} {selected_item['DonVi']}! Nên nhập thêm.")
-                        elif selected_item['SoLuong'] == 0:
-                            st.error("🚨 Hết hàng: Tồn kho = 0!")
-
-                        st.divider()
-
-                        col_price_temp, col_qty = st.columns([1, 1])
-                        default_price = float(selected_item['GiaBan'])
-                        temp_price = col_price_temp.number_input(
-                            "Giá bán nợ (đ)",
-                            min_value=0.0,
-                            value=default_price,
-                            step=1000.0,
-                            key=f"debt_temp_price_{selected_item['MaSanPham']}",
-                            format="%.0f"
-                        )
-                        qty_sell = col_qty.number_input(
-                            "Số lượng mua nợ",
-                            min_value=1,
-                            value=1,
-                            step=1,
-                            key=f"debt_qty_sell_{selected_item['MaSanPham']}"
-                        )
-
-                        if qty_sell > selected_item['SoLuong']:
-                            st.error(f"Không đủ tồn kho! Cần thêm ít nhất {qty_sell - selected_item['SoLuong']} {selected_item['DonVi']}.")
-                            st.markdown("#### 📦 Nhập nhanh bổ sung tồn kho ngay tại đây")
-                            with st.form(key=f"debt_quick_import_{selected_item['MaSanPham']}"):
-                                col_q, col_gn, col_gb = st.columns(3)
-                                suggested_qty = max(10, qty_sell - selected_item['SoLuong'])
-                                quick_qty = col_q.number_input("Số lượng nhập thêm", min_value=1, value=suggested_qty)
-                                quick_gn = col_gn.number_input("Giá nhập mới", value=float(selected_item['GiaNhap']), step=1000.0, format="%.0f")
-                                quick_gb = col_gb.number_input("Giá bán mới", value=float(selected_item['GiaBan']), step=1000.0, format="%.0f")
-
-                                if st.form_submit_button("💾 Nhập nhanh & Thêm vào giỏ nợ", type="primary"):
-                                    if quick_gn > 0 and quick_gb > 0:
-                                        temp_import = [{
-                                            "MaSanPham": selected_item['MaSanPham'],
-                                            "TenSanPham": selected_item['TenSanPham'],
-                                            "DonVi": selected_item['DonVi'],
-                                            "SoLuong": quick_qty,
-                                            "GiaNhap": quick_gn,
-                                            "GiaBan": quick_gb,
-                                            "NhaCungCap": ""
-                                        }]
-                                        if dm.process_import(temp_import):
-                                            st.success(f"Đã nhập thêm {quick_qty} {selected_item['DonVi']} vào kho!")
-                                            st.session_state['debt_cart'].append({
-                                                "MaSanPham": selected_item['MaSanPham'],
-                                                "TenSanPham": selected_item['TenSanPham'],
-                                                "DonVi": selected_item['DonVi'],
-                                                "GiaBan": temp_price,
-                                                "SoLuongBan": qty_sell,
-                                                "ThanhTien": qty_sell * temp_price
-                                            })
-                                            st.toast("Đã thêm vào giỏ nợ thành công!")
-                                            st.rerun()
-                                    else:
-                                        st.error("Giá nhập/bán không hợp lệ!")
-
-                        if st.button("➕ Thêm vào giỏ nợ", type="primary", key=f"add_debt_{selected_item['MaSanPham']}"):
-                            if qty_sell <= selected_item['SoLuong'] and temp_price > 0:
-                                st.session_state['debt_cart'].append({
-                                    "MaSanPham": selected_item['MaSanPham'],
-                                    "TenSanPham": selected_item['TenSanPham'],
-                                    "DonVi": selected_item['DonVi'],
-                                    "GiaBan": temp_price,
-                                    "SoLuongBan": qty_sell,
-                                    "ThanhTien": qty_sell * temp_price
-                                })
-                                st.toast(f"Đã thêm {selected_item['TenSanPham']} vào giỏ nợ!")
-                                st.rerun()
-                            else:
-                                st.error("Vui lòng kiểm tra giá và tồn kho!")
-            else:
-                st.warning("Không tìm thấy sản phẩm nào.")
-        else:
-            st.warning("Kho hàng trống.")
-
-    with col_cart:
-        st.info("Giỏ công nợ hiện tại")
-        if st.session_state['debt_cart']:
-            total_bill = 0
-            for idx in range(len(st.session_state['debt_cart']) - 1, -1, -1):
-                item = st.session_state['debt_cart'][idx]
-                with st.container(border=True):
-                    col_name, col_qty, col_price, col_total, col_del = st.columns([3, 1, 2, 2, 1])
-                    col_name.write(f"**{item['TenSanPham']}** ({item['MaSanPham']})")
-                    col_qty.write(f"{item['SoLuongBan']} {item['DonVi']}")
-                    col_price.write(f"Giá: {format_currency(item['GiaBan'])}")
-                    item_total = item['SoLuongBan'] * item['GiaBan']
-                    col_total.write(f"**{format_currency(item_total)}**")
-                    if col_del.button("🗑", key=f"del_debt_cart_{idx}"):
-                        st.session_state['debt_cart'].pop(idx)
-                        st.rerun()
-                total_bill += item_total
-
-            st.markdown(f"<h3 style='text-align: right; color: red;'>Tổng nợ: {format_currency(total_bill)}</h3>", unsafe_allow_html=True)
-            c1, c2 = st.columns(2)
-            if c1.button("🗑 Xóa toàn bộ giỏ nợ"):
-                st.session_state['debt_cart'] = []
-                st.rerun()
-            if c2.button("✅ HOÀN THÀNH GIỎ NỢ", type="primary"):
-                if not customer_name:
-                    st.error("Vui lòng nhập tên khách hàng trước khi lưu công nợ.")
-                else:
-                    debt_id = process_debt_checkout_safe(
-                        customer_name,
-                        st.session_state['debt_cart'],
-                        debt_purchase_dt
-                    )
-                    if debt_id:
-                        st.session_state['debt_cart'] = []
-                        st.success(f"Đã lưu công nợ thành công! Mã phiếu nợ: {debt_id}")
-                        st.rerun()
-        else:
-            st.caption("Chưa có hàng trong giỏ nợ.")
+    render_debt_pos(inv, customer_name, debt_purchase_dt)
 
     st.divider()
     st.subheader("📋 Danh Sách Khách Công Nợ")
@@ -664,6 +602,17 @@ def render_debt(df_inv):
         st.error("Khoảng ngày lọc không hợp lệ (Từ ngày phải nhỏ hơn hoặc bằng Đến ngày).")
         return
 
+    view_mode = st.radio(
+        "Xem công nợ theo",
+        [DEBT_VIEW_SLIPS, DEBT_VIEW_CUSTOMERS],
+        horizontal=True,
+        key="debt_view_mode"
+    )
+    if view_mode == DEBT_VIEW_CUSTOMERS:
+        render_debt_customers(df_debt, customer_filter)
+        render_debt_payment(df_debt)
+        return
+
     filtered_debt = df_debt.copy()
     if customer_filter:
         filtered_debt = filtered_debt[
@@ -690,7 +639,14 @@ def render_debt(df_inv):
             NgayParsed=('NgayParsed', 'max')
         )
     )
-    summary = summary.sort_values(by='NgayParsed', ascending=False, na_position='last').reset_index(drop=True)
+    sort_label = st.selectbox(
+        "Sắp xếp phiếu nợ",
+        list(DEBT_SORT_OPTIONS),
+        key="debt_sort",
+        on_change=lambda: st.session_state.pop("debt_page", None)
+    )
+    sort_col, ascending = DEBT_SORT_OPTIONS[sort_label]
+    summary = summary.sort_values(by=sort_col, ascending=ascending, na_position='last').reset_index(drop=True)
 
     if st.session_state.get('debt_selected'):
         selected = st.session_state['debt_selected']
@@ -698,38 +654,248 @@ def render_debt(df_inv):
         if not still_exists:
             st.session_state['debt_selected'] = None
 
-    header1, header2, header3, header4, header5, header6, header7 = st.columns([2.2, 2.2, 1.5, 1.5, 1.5, 1.8, 1.0])
-    header1.markdown("**Khách hàng**")
-    header2.markdown("**Mã phiếu nợ**")
-    header3.markdown("**Tổng công nợ**")
-    header4.markdown("**Đã trả**")
-    header5.markdown("**Còn thiếu**")
-    header6.markdown("**Ngày mua nợ**")
-    header7.markdown("**SL**")
-
-    for idx, row in summary.iterrows():
-        customer = str(row['TenKH']).strip()
-        debt_id = str(row['MaPhieuNo']).strip()
-        debt_time_raw = str(row['NgayRaw']).strip()
-        if pd.notna(row['NgayParsed']):
-            debt_time_display = row['NgayParsed'].strftime("%d/%m/%Y %H:%M")
-        else:
-            debt_time_display = debt_time_raw
-
-        c1, c2, c3, c4, c5, c6, c7 = st.columns([2.2, 2.2, 1.5, 1.5, 1.5, 1.8, 1.0])
-        if c1.button(customer, key=f"debt_customer_{idx}_{debt_id}"):
+    # Chỉ dựng bảng cho trang đang xem; chọn một dòng trong bảng để mở phần thu tiền bên dưới.
+    page_df, page = paginate_frame(summary, "debt_page", DEBT_PAGE_SIZE, "phiếu nợ")
+    view_df = pd.DataFrame({
+        'Khách hàng': page_df['TenKH'].astype(str).str.strip(),
+        'Mã phiếu nợ': page_df['MaPhieuNo'].astype(str).str.strip(),
+        'Tổng công nợ': page_df['TongNo'].apply(format_currency),
+        'Đã trả': page_df['DaTra'].apply(format_currency),
+        'Còn thiếu': page_df['ConNo'].apply(format_currency),
+        'Ngày mua nợ': page_df['NgayParsed'].dt.strftime("%d/%m/%Y %H:%M").fillna(page_df['NgayRaw'].astype(str)),
+        'SL': page_df['TongSoLuong'].astype(int),
+    })
+
+    table_key = f"debt_table_{sort_label}_{page}_{st.session_state['debt_table_gen']}"
+
+    def select_debt_row():
+        rows = st.session_state[table_key].selection.rows
+        if rows:
+            row = page_df.iloc[rows[0]]
             st.session_state['debt_selected'] = {
-                'MaPhieuNo': debt_id,
-                'TenKH': customer,
-                'NgayRaw': debt_time_raw
+                'MaPhieuNo': str(row['MaPhieuNo']).strip(),
+                'TenKH': str(row['TenKH']).strip(),
+                'NgayRaw': str(row['NgayRaw']).strip()
             }
-        c2.code(debt_id)
-        c3.write(format_currency(row['TongNo']))
-        c4.write(format_currency(row['DaTra']))
-        c5.write(format_currency(row['ConNo']))
-        c6.write(debt_time_display)
-        c7.write(int(row['TongSoLuong']))
+        else:
+            st.session_state['debt_selected'] = None
 
+    st.dataframe(
+        view_df,
+        hide_index=True,
+        use_container_width=True,
+        on_select=select_debt_row,
+        selection_mode="single-row",
+        key=table_key
+    )
+
+    render_debt_payment(filtered_debt)
+
+# Quầy bán nợ là fragment như quầy bán hàng: thao tác giỏ nợ không chạy lại danh sách công nợ.
+@fragment
+def render_debt_pos(inv, customer_name, debt_purchase_dt):
+    col_search, col_cart = st.columns([5, 5], gap="large")
+    with col_search:
+        render_debt_search(inv)
+    with col_cart:
+        render_debt_cart(customer_name, debt_purchase_dt)
+
+def render_debt_search(inv):
+    st.info("Tìm kiếm sản phẩm để thêm vào giỏ nợ")
+    if not inv.empty:
+        search_term = st.text_input("🔍 Nhập tên hoặc mã sản phẩm", key="debt_search")
+
+        filtered_df = dm.search_products(inv, search_term, limit=SEARCH_RESULT_LIMIT)
+
+        if not filtered_df.empty:
+            product_options = dm.get_product_options(inv)
+            selected_id = st.selectbox(
+                "Chọn sản phẩm:",
+                [""] + dm.product_ids(filtered_df).drop_duplicates().tolist(),
+                format_func=lambda pid: product_options['labels'].get(pid, pid),
+                key="debt_select"
+            )
+
+            if selected_id:
+                if selected_id not in product_options['positions']:
+                    st.error("Không xác định được sản phẩm đã chọn. Vui lòng chọn lại.")
+                    return
+                selected_item = inv.iloc[product_options['positions'][selected_id]]
+
+                with st.container(border=True):
+                    st.markdown(f"### {selected_item['TenSanPham']}")
+                    c1, c2, c3 = st.columns(3)
+                    c1.metric("Mã SP", selected_item['MaSanPham'])
+                    c2.metric("Đơn vị", selected_item['DonVi'])
+                    c3.metric("Tồn kho hiện tại", int(selected_item['SoLuong']))
+
+                    if selected_item['SoLuong'] < 10 and selected_item['SoLuong'] > 0:
+                        st.warning(f"⚠️ Tồn kho thấp: chỉ còn {int(selected_item['SoLuong'])} {selected_item['DonVi']}! Nên nhập thêm.")
+                    elif selected_item['SoLuong'] == 0:
+                        st.error("🚨 Hết hàng: Tồn kho = 0!")
+
+                    st.divider()
+
+                    col_price_temp, col_qty = st.columns([1, 1])
+                    default_price = float(selected_item['GiaBan'])
+                    temp_price = col_price_temp.number_input(
+                        "Giá bán nợ (đ)",
+                        min_value=0.0,
+                        value=default_price,
+                        step=1000.0,
+                        key=f"debt_temp_price_{selected_item['MaSanPham']}",
+                        format="%.0f"
+                    )
+                    qty_sell = col_qty.number_input(
+                        "Số lượng mua nợ",
+                        min_value=1,
+                        value=1,
+                        step=1,
+                        key=f"debt_qty_sell_{selected_item['MaSanPham']}"
+                    )
+
+                    if qty_sell > selected_item['SoLuong']:
+                        st.error(f"Không đủ tồn kho! Cần thêm ít nhất {qty_sell - selected_item['SoLuong']} {selected_item['DonVi']}.")
+                        st.markdown("#### 📦 Nhập nhanh bổ sung tồn kho ngay tại đây")
+                        with st.form(key=f"debt_quick_import_{selected_item['MaSanPham']}"):
+                            col_q, col_gn, col_gb = st.columns(3)
+                            suggested_qty = max(10, qty_sell - selected_item['SoLuong'])
+                            quick_qty = col_q.number_input("Số lượng nhập thêm", min_value=1, value=suggested_qty)
+                            quick_gn = col_gn.number_input("Giá nhập mới", value=float(selected_item['GiaNhap']), step=1000.0, format="%.0f")
+                            quick_gb = col_gb.number_input("Giá bán mới", value=float(selected_item['GiaBan']), step=1000.0, format="%.0f")
+
+                            if st.form_submit_button("💾 Nhập nhanh & Thêm vào giỏ nợ", type="primary"):
+                                if quick_gn > 0 and quick_gb > 0:
+                                    temp_import = [{
+                                        "MaSanPham": selected_item['MaSanPham'],
+                                        "TenSanPham": selected_item['TenSanPham'],
+                                        "DonVi": selected_item['DonVi'],
+                                        "SoLuong": quick_qty,
+                                        "GiaNhap": quick_gn,
+                                        "GiaBan": quick_gb,
+                                        "NhaCungCap": ""
+                                    }]
+                                    if dm.process_import(temp_import):
+                                        st.success(f"Đã nhập thêm {quick_qty} {selected_item['DonVi']} vào kho!")
+                                        st.session_state['debt_cart'].append({
+                                            "MaSanPham": selected_item['MaSanPham'],
+                                            "TenSanPham": selected_item['TenSanPham'],
+                                            "DonVi": selected_item['DonVi'],
+                                            "GiaBan": temp_price,
+                                            "SoLuongBan": qty_sell,
+                                            "ThanhTien": qty_sell * temp_price
+                                        })
+                                        st.toast("Đã thêm vào giỏ nợ thành công!")
+                                        st.rerun()
+                                else:
+                                    st.error("Giá nhập/bán không hợp lệ!")
+
+                    if st.button("➕ Thêm vào giỏ nợ", type="primary", key=f"add_debt_{selected_item['MaSanPham']}"):
+                        if qty_sell <= selected_item['SoLuong'] and temp_price > 0:
+                            st.session_state['debt_cart'].append({
+                                "MaSanPham": selected_item['MaSanPham'],
+                                "TenSanPham": selected_item['TenSanPham'],
+                                "DonVi": selected_item['DonVi'],
+                                "GiaBan": temp_price,
+                                "SoLuongBan": qty_sell,
+                                "ThanhTien": qty_sell * temp_price
+                            })
+                            st.toast(f"Đã thêm {selected_item['TenSanPham']} vào giỏ nợ!")
+                        else:
+                            st.error("Vui lòng kiểm tra giá và tồn kho!")
+        else:
+            st.warning("Không tìm thấy sản phẩm nào.")
+    else:
+        st.warning("Kho hàng trống.")
+
+@fragment
+def render_debt_cart(customer_name, debt_purchase_dt):
+    st.info("Giỏ công nợ hiện tại")
+    if st.session_state['debt_cart']:
+        total_bill = 0
+        for idx in range(len(st.session_state['debt_cart']) - 1, -1, -1):
+            item = st.session_state['debt_cart'][idx]
+            with st.container(border=True):
+                col_name, col_qty, col_price, col_total, col_del = st.columns([3, 1, 2, 2, 1])
+                col_name.write(f"**{item['TenSanPham']}** ({item['MaSanPham']})")
+                col_qty.write(f"{item['SoLuongBan']} {item['DonVi']}")
+                col_price.write(f"Giá: {format_currency(item['GiaBan'])}")
+                item_total = item['SoLuongBan'] * item['GiaBan']
+                col_total.write(f"**{format_currency(item_total)}**")
+                if col_del.button("🗑", key=f"del_debt_cart_{idx}"):
+                    st.session_state['debt_cart'].pop(idx)
+                    rerun_fragment()
+            total_bill += item_total
+
+        st.markdown(f"<h3 style='text-align: right; color: red;'>Tổng nợ: {format_currency(total_bill)}</h3>", unsafe_allow_html=True)
+        c1, c2 = st.columns(2)
+        if c1.button("🗑 Xóa toàn bộ giỏ nợ"):
+            st.session_state['debt_cart'] = []
+            rerun_fragment()
+        if c2.button("✅ HOÀN THÀNH GIỎ NỢ", type="primary"):
+            if not customer_name:
+                st.error("Vui lòng nhập tên khách hàng trước khi lưu công nợ.")
+            else:
+                debt_id = process_debt_checkout_safe(
+                    customer_name,
+                    st.session_state['debt_cart'],
+                    debt_purchase_dt
+                )
+                if debt_id:
+                    st.session_state['debt_cart'] = []
+                    st.success(f"Đã lưu công nợ thành công! Mã phiếu nợ: {debt_id}")
+                    st.rerun()
+    else:
+        st.caption("Chưa có hàng trong giỏ nợ.")
+
+def render_debt_customers(df_debt, customer_filter):
+    df_customers = load_debt_customers_safe(df_debt)
+    if customer_filter and not df_customers.empty:
+        df_customers = df_customers[
+            df_customers['TenKH'].astype(str).str.contains(customer_filter, case=False, na=False, regex=False)
+        ]
+    if df_customers.empty:
+        st.info("Không có khách còn nợ phù hợp với bộ lọc tên.")
+        return
+    st.caption("Tổng hợp mọi phiếu còn nợ của từng khách (không áp dụng bộ lọc ngày).")
+
+    view_df = df_customers.copy()
+    view_df['NgayCuNhat'] = view_df['NgayCuNhat'].dt.strftime("%d/%m/%Y").fillna('')
+    for col in ['TongNo', 'DaTra', 'ConNo']:
+        view_df[col] = view_df[col].apply(format_currency)
+    view_df = view_df[['TenKH', 'SoPhieu', 'TongNo', 'DaTra', 'ConNo', 'NgayCuNhat']]
+    view_df.columns = ['Khách hàng', 'Số phiếu còn nợ', 'Tổng công nợ', 'Đã trả', 'Còn thiếu', 'Nợ cũ nhất từ']
+    st.dataframe(view_df, use_container_width=True, hide_index=True)
+
+    customer = st.selectbox("Xem phiếu nợ của khách", df_customers['TenKH'].tolist(), key="debt_customer_view")
+    summary = df_customers[df_customers['TenKH'] == customer].iloc[0]
+    m1, m2, m3, m4 = st.columns(4)
+    m1.metric("Tổng công nợ", format_currency(summary['TongNo']))
+    m2.metric("Đã trả", format_currency(summary['DaTra']))
+    m3.metric("Còn thiếu", format_currency(summary['ConNo']))
+    m4.metric("Số phiếu còn nợ", int(summary['SoPhieu']))
+
+    slips = (
+        df_debt[df_debt['TenKH'] == customer]
+        .groupby('MaPhieuNo', as_index=False)
+        .agg(NgayRaw=('NgayRaw', 'first'), NgayParsed=('NgayParsed', 'max'), ConNo=('TienConLai', 'sum'))
+        .sort_values(by='NgayParsed', na_position='last')
+    )
+    if slips.empty:
+        return
+    labels = {
+        row['MaPhieuNo']: f"{row['MaPhieuNo']} | {row['NgayRaw']} | còn thiếu {format_currency(row['ConNo'])}"
+        for _, row in slips.iterrows()
+    }
+    debt_id = st.selectbox("Phiếu cần thu tiền", list(labels), format_func=labels.get, key=f"debt_customer_slip_{customer}")
+    if st.button("Chọn phiếu này", key="debt_customer_pick"):
+        st.session_state['debt_selected'] = {
+            'MaPhieuNo': debt_id,
+            'TenKH': customer,
+            'NgayRaw': str(slips.loc[slips['MaPhieuNo'] == debt_id, 'NgayRaw'].iloc[0]).strip()
+        }
+
+def render_debt_payment(filtered_debt):
     selected = st.session_state.get('debt_selected')
     if selected:
         selected_debt_id = selected.get('MaPhieuNo', '')
@@ -801,11 +967,14 @@ def render_debt(df_inv):
                     st.success(f"Cập nhật thành công. Trạng thái mới: {result.get('status_text', '')}")
                     if result.get("remaining", 0) <= 0:
                         st.session_state['debt_selected'] = None
+                    # Thứ tự/số phiếu có thể đổi sau khi thu tiền: dựng bảng mới để bỏ dòng đang tô chọn.
+                    st.session_state['debt_table_gen'] += 1
                     st.rerun()
                 else:
                     st.error(result.get("message", "Không thể cập nhật công nợ."))
             if c2.button("Bỏ chọn", key="debt_unselect"):
                 st.session_state['debt_selected'] = None
+                st.session_state['debt_table_gen'] += 1
                 st.rerun()
 
 # --- 4. MAN HINH NHAP HANG ---
@@ -924,209 +1093,362 @@ def render_import(df_inv):
 def render_reports(df_inv):
     st.subheader("📊 Báo Cáo Hệ Thống")
     
-    df_sales = dm.load_sales_history()
+    tz = pytz.timezone('Asia/Ho_Chi_Minh')  # VN time
+    today_date = datetime.now(tz).date()
+    # Số tổng và biểu đồ lấy từ bảng tổng hợp theo ngày; các bảng chi tiết chỉ đọc
+    # khoảng ngày và các cột cần dùng từ kho phân tích theo tháng.
+    df_rollup = dm.load_daily_rollup()
     
-    if not df_sales.empty:
-        total_revenue = df_sales['ThanhTien'].sum()
-        total_profit = df_sales['LoiNhuan'].sum()
+    if not df_rollup.empty:
+        total_revenue = df_rollup['DoanhThu'].sum()
+        total_profit = df_rollup['LoiNhuan'].sum()
         c1, c2 = st.columns(2)
         c1.metric("Tổng doanh thu toàn thời gian", format_currency(total_revenue))
         c2.metric("Tổng lợi nhuận gộp toàn thời gian", format_currency(total_profit))
     st.divider()
     
-    t1, t2, t3 = st.tabs(["Tồn Kho & Giá Vốn", "Lợi Nhuận & Hoàn Trả", "Phân Tích Năm"])
-    
-    with t1:
-        if not df_inv.empty:
-            df_inv['GiaTriTon'] = df_inv['SoLuong'] * df_inv['GiaNhap']
-            st.metric("Tổng vốn tồn kho", format_currency(df_inv['GiaTriTon'].sum()))
-            st.dataframe(df_inv, use_container_width=True)
-            
-            st.write("### ⚠️ Sản phẩm sắp hết (dưới 10 đơn vị)")
-            low_stock = df_inv[df_inv['SoLuong'] < 10]
-            if not low_stock.empty:
-                st.dataframe(low_stock[['MaSanPham', 'TenSanPham', 'SoLuong', 'DonVi']], use_container_width=True)
-            else:
-                st.success("Tất cả sản phẩm đều đủ tồn kho!")
-        else: 
-            st.info("Chưa có dữ liệu kho.")
-
-    with t2:
-        tz = pytz.timezone('Asia/Ho_Chi_Minh')  # VN time
-        if not df_sales.empty and 'NgayBan' in df_sales.columns:
-            order_values = df_sales['MaHoaDon'] if 'MaHoaDon' in df_sales.columns else ''
-            df_sales['MaHoaDon'] = pd.Series(order_values, index=df_sales.index).fillna('').astype(str).str.strip()
-
-            df_sales['NgayBan'] = pd.to_datetime(df_sales['NgayBan'], errors='coerce')
-            today_str = datetime.now(tz).strftime('%Y-%m-%d')
-            df_today_sales = df_sales[(df_sales['NgayBan'].dt.strftime('%Y-%m-%d') == today_str) & (df_sales['SoLuong'] > 0)]
-            
-            today_revenue = df_today_sales['ThanhTien'].sum()
-            today_profit = df_today_sales['LoiNhuan'].sum()
-            today_orders = df_today_sales['MaHoaDon'].replace('', pd.NA).dropna().nunique()
-            
-            col1, col2, col3 = st.columns(3)
-            col1.metric("Doanh thu hôm nay", format_currency(today_revenue))
-            col2.metric("Lợi nhuận hôm nay", format_currency(today_profit))
-            col3.metric("Số đơn hàng hôm nay", today_orders)
-            st.divider()
-
-        st.write("### 📋 Lịch sử chi tiết đơn hàng (có thể hoàn trả từng món)")
-        selected_date = st.date_input("Chọn ngày xem đơn hàng", value=datetime.now(tz).date(), key="order_history_date_input")
-        
-        if not df_sales.empty and 'NgayBan' in df_sales.columns:
-            df_sales['date'] = df_sales['NgayBan'].dt.date
-            df_selected_day = df_sales[df_sales['date'] == selected_date].copy()
-            
-            if not df_selected_day.empty:
-                day_revenue = df_selected_day[df_selected_day['SoLuong'] > 0]['ThanhTien'].sum()
-                st.info(f"**Tổng doanh thu ngày {selected_date.strftime('%d/%m/%Y')}: {format_currency(day_revenue)}**")
-                
-                orders = df_selected_day.groupby('MaHoaDon')
-                
-                for order_id, order_df in orders:
-                    if str(order_id).strip() == '':
-                        continue
-                    order_time = order_df['NgayBan'].min().strftime('%H:%M')
-                    order_total = order_df[order_df['SoLuong'] > 0]['ThanhTien'].sum()
-                    num_items = len(order_df[order_df['SoLuong'] > 0])
-                    
-                    with st.expander(f"🧾 Đơn {order_id} | {order_time} | {num_items} sản phẩm | Tổng: {format_currency(order_total)}"):
-                        for idx, row in order_df.iterrows():
-                            if row['SoLuong'] > 0:
-                                with st.container(border=True):
-                                    c1, c2, c3, c4, c5 = st.columns([3, 1, 2, 2, 1])
-                                    c1.write(f"**{row['TenSanPham']}** ({row['MaSanPham']})")
-                                    c2.write(f"{int(row['SoLuong'])} {row['DonVi']}")
-                                    c3.write(f"Giá: {format_currency(row['GiaBan'])}")
-                                    c4.write(f"Thành tiền: {format_currency(row['ThanhTien'])}")
-                                    if c5.button("Hoàn trả", key=f"ret_detail_{order_id}_{idx}"):
-                                        if dm.process_return(row['MaHoaDon'], row['MaSanPham'], row['SoLuong']):
-                                            st.success(f"Đã hoàn trả {row['TenSanPham']} thành công!")
-                                            st.rerun()
-            else:
-                st.info(f"Ngày {selected_date.strftime('%d/%m/%Y')} chưa có đơn hàng nào.")
+    # Chỉ tab đang mở mới chạy (tải dữ liệu, dựng bảng/biểu đồ); bảng và biểu đồ được nhớ
+    # theo phiên bản dữ liệu nên mở lại tab không phải tính lại.
+    (t1, open1), (t2, open2), (t3, open3) = lazy_tabs(
+        ["Tồn Kho & Giá Vốn", "Lợi Nhuận & Hoàn Trả", "Phân Tích Năm"], key="report_tab"
+    )
+    if open1:
+        with t1:
+            render_report_inventory(df_inv)
+    if open2:
+        with t2:
+            render_report_sales(df_rollup, today_date)
+    if open3:
+        with t3:
+            render_report_year(df_rollup, today_date)
+
+def render_report_inventory(df_inv):
+    if not df_inv.empty:
+        df_inv['GiaTriTon'] = df_inv['SoLuong'] * df_inv['GiaNhap']
+        st.metric("Tổng vốn tồn kho", format_currency(df_inv['GiaTriTon'].sum()))
+        st.dataframe(df_inv, use_container_width=True)
+
+        st.write("### ⚠️ Sản phẩm sắp hết (dưới 10 đơn vị)")
+        low_stock = df_inv[df_inv['SoLuong'] < 10]
+        if not low_stock.empty:
+            st.dataframe(low_stock[['MaSanPham', 'TenSanPham', 'SoLuong', 'DonVi']], use_container_width=True)
         else:
-            st.info("Chưa có dữ liệu bán hàng.")
-        
+            st.success("Tất cả sản phẩm đều đủ tồn kho!")
+    else:
+        st.info("Chưa có dữ liệu kho.")
+
+def render_report_sales(df_rollup, today_date):
+    rollup_today = df_rollup[df_rollup['Ngay'].dt.date == today_date]
+    if not rollup_today.empty:
+        today_revenue = rollup_today['DoanhThu'].sum()
+        today_profit = rollup_today['LoiNhuan'].sum()
+        today_orders = int(rollup_today['SoDon'].sum())
+
+        col1, col2, col3 = st.columns(3)
+        col1.metric("Doanh thu hôm nay", format_currency(today_revenue))
+        col2.metric("Lợi nhuận hôm nay", format_currency(today_profit))
+        col3.metric("Số đơn hàng hôm nay", today_orders)
         st.divider()
-        
-        df_month = df_sales[df_sales['NgayBan'].dt.month == datetime.now(tz).month].copy() if not df_sales.empty and 'NgayBan' in df_sales.columns else pd.DataFrame()
-        if not df_month.empty:
-            st.write("### 🔥 Top 10 sản phẩm bán chạy tháng này")
-            top10 = df_month[df_month['SoLuong'] > 0].groupby(['MaSanPham', 'TenSanPham'])['SoLuong'].sum().reset_index()
-            top10 = top10.sort_values('SoLuong', ascending=False).head(10)
-            st.dataframe(top10, use_container_width=True)
-            
-            st.write("### 📊 Doanh thu theo sản phẩm (Top 10 tháng này)")
-            top10_revenue = df_month[df_month['SoLuong'] > 0].groupby('TenSanPham')['ThanhTien'].sum().reset_index()
-            top10_revenue = top10_revenue.sort_values('ThanhTien', ascending=False).head(10)
-            fig_prod = go.Figure(go.Bar(
-                x=top10_revenue['ThanhTien'],
-                y=top10_revenue['TenSanPham'],
-                orientation='h',
-                marker_color='#0068C9'
-            ))
-            fig_prod.update_layout(yaxis={'categoryorder':'total ascending'}, xaxis_title="Doanh thu (đ)", height=400)
-            st.plotly_chart(fig_prod, use_container_width=True)
-            
-            st.write("### 🔥 Top 10 sản phẩm bán chạy toàn thời gian")
-            top10_all = df_sales[df_sales['SoLuong'] > 0].groupby(['MaSanPham', 'TenSanPham'])['SoLuong'].sum().reset_index()
-            top10_all = top10_all.sort_values('SoLuong', ascending=False).head(10)
-            st.dataframe(top10_all, use_container_width=True)
-        
-        st.write("### 📈 Doanh thu & Lợi nhuận tháng này")
-        if not df_month.empty:
-            current_month = datetime.now(tz).month
-            current_year = datetime.now(tz).year
-            last_day = datetime.now(tz).day
-
-            daily_full = pd.DataFrame({'day': list(range(1, last_day + 1))})
-
-            daily_group = df_month.groupby(df_month['NgayBan'].dt.day)[['ThanhTien', 'LoiNhuan']].sum().reset_index()
-            daily_group.rename(columns={'NgayBan': 'day'}, inplace=True)
-
-            daily = daily_full.merge(daily_group, on='day', how='left').fillna(0)
-            daily['day'] = daily['day'].astype(int)
-            daily['ThanhTien'] = daily['ThanhTien'].clip(lower=0)
-            daily['LoiNhuan'] = daily['LoiNhuan'].clip(lower=0)
-
-            max_y_value = max(daily['ThanhTien'].max(), daily['LoiNhuan'].max())
-            if max_y_value == 0:
-                max_y_value = 100000
-            max_y = max_y_value * 1.15
-
-            fig = go.Figure()
-            fig.add_trace(go.Bar(
-                x=daily['day'],
-                y=daily['ThanhTien'],
-                name="Doanh Thu",
-                marker_color='#0068C9',
-                width=0.8
-            ))
-            fig.add_trace(go.Scatter(
-                x=daily['day'],
-                y=daily['LoiNhuan'],
-                name="Lợi Nhuận",
-                mode='lines+markers',
-                line=dict(color='red', width=3),
-                marker=dict(size=8)
-            ))
-
-            fig.update_layout(
-                title=f"Doanh thu & Lợi nhuận tháng {current_month}/{current_year}",
-                xaxis_title="Ngày",
-                yaxis_title="Số tiền (đ)",
-                xaxis=dict(
-                    type='category',
-                    tickmode='linear',
-                    range=[0.5, last_day + 0.5],
-                    constrain='domain',
-                    showgrid=False
-                ),
-                yaxis=dict(
-                    range=[0, max_y],
-                    fixedrange=True,
-                    zeroline=False,
-                    showgrid=True
-                ),
-                bargap=0.15,
-                legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1)
-            )
-            st.plotly_chart(fig, use_container_width=True)
+
+    st.write("### 📋 Lịch sử chi tiết đơn hàng (hoàn trả từng món hoặc cả đơn)")
+    selected_date = st.date_input("Chọn ngày xem đơn hàng", value=today_date, key="order_history_date_input")
+
+    df_selected_day = dm.load_sales_period(selected_date, selected_date)
+    if not df_selected_day.empty:
+        df_selected_day['MaHoaDon'] = df_selected_day['MaHoaDon'].fillna('').astype(str).str.strip()
+        day_revenue = df_selected_day[df_selected_day['SoLuong'] > 0]['ThanhTien'].sum()
+        st.info(f"**Tổng doanh thu ngày {selected_date.strftime('%d/%m/%Y')}: {format_currency(day_revenue)}**")
+
+        render_order_history(df_selected_day, selected_date)
+    else:
+        st.info(f"Ngày {selected_date.strftime('%d/%m/%Y')} chưa có đơn hàng nào.")
+
+    st.divider()
+
+    month_start = today_date.replace(day=1)
+    month = dm.report_memo(
+        "report_month_products", (month_start, today_date), ("LichSuBan",),
+        lambda: build_month_products(month_start, today_date)
+    )
+    if month is not None:
+        st.write("### 🔥 Top 10 sản phẩm bán chạy tháng này")
+        st.dataframe(month['top10'], use_container_width=True)
+
+        st.write("### 📊 Doanh thu theo sản phẩm (Top 10 tháng này)")
+        st.plotly_chart(month['fig_prod'], use_container_width=True)
+
+        st.write("### 🔥 Top 10 sản phẩm bán chạy toàn thời gian")
+        st.dataframe(month['top10_all'], use_container_width=True)
+
+    st.write("### 📈 Doanh thu & Lợi nhuận tháng này")
+    if month is not None:
+        fig = dm.report_memo(
+            "report_month_chart", (month_start, today_date), (dm.ROLLUP_SHEET, "LichSuBan"),
+            lambda: build_month_chart(df_rollup, month_start, today_date)
+        )
+        st.plotly_chart(fig, use_container_width=True)
+    else:
+        st.info("Tháng này chưa có dữ liệu bán hàng.")
+
+def build_month_products(month_start, today_date):
+    # None khi tháng này chưa có dòng bán nào.
+    df_month = dm.load_sales_period(
+        month_start, today_date,
+        columns=['NgayBan', 'MaSanPham', 'TenSanPham', 'SoLuong', 'ThanhTien', 'LoiNhuan']
+    )
+    if df_month.empty:
+        return None
+    top10 = df_month[df_month['SoLuong'] > 0].groupby(['MaSanPham', 'TenSanPham'])['SoLuong'].sum().reset_index()
+    top10 = top10.sort_values('SoLuong', ascending=False).head(10)
+
+    top10_revenue = df_month[df_month['SoLuong'] > 0].groupby('TenSanPham')['ThanhTien'].sum().reset_index()
+    top10_revenue = top10_revenue.sort_values('ThanhTien', ascending=False).head(10)
+    fig_prod = go.Figure(go.Bar(
+        x=top10_revenue['ThanhTien'],
+        y=top10_revenue['TenSanPham'],
+        orientation='h',
+        marker_color='#0068C9'
+    ))
+    fig_prod.update_layout(yaxis={'categoryorder':'total ascending'}, xaxis_title="Doanh thu (đ)", height=400)
+
+    df_all_qty = dm.load_sales_period(columns=['MaSanPham', 'TenSanPham', 'SoLuong'])
+    top10_all = df_all_qty[df_all_qty['SoLuong'] > 0].groupby(['MaSanPham', 'TenSanPham'])['SoLuong'].sum().reset_index()
+    top10_all = top10_all.sort_values('SoLuong', ascending=False).head(10)
+    return {'top10': top10, 'fig_prod': fig_prod, 'top10_all': top10_all}
+
+def build_month_chart(df_rollup, month_start, today_date):
+    current_month = today_date.month
+    current_year = today_date.year
+    last_day = today_date.day
+
+    daily_full = pd.DataFrame({'day': list(range(1, last_day + 1))})
+
+    rollup_month = df_rollup[df_rollup['Ngay'].dt.date >= month_start]
+    daily_group = rollup_month.groupby(rollup_month['Ngay'].dt.day)[['DoanhThu', 'LoiNhuan']].sum().reset_index()
+    daily_group.rename(columns={'Ngay': 'day', 'DoanhThu': 'ThanhTien'}, inplace=True)
+
+    daily = daily_full.merge(daily_group, on='day', how='left').fillna(0)
+    daily['day'] = daily['day'].astype(int)
+    daily['ThanhTien'] = daily['ThanhTien'].clip(lower=0)
+    daily['LoiNhuan'] = daily['LoiNhuan'].clip(lower=0)
+
+    max_y_value = max(daily['ThanhTien'].max(), daily['LoiNhuan'].max())
+    if max_y_value == 0:
+        max_y_value = 100000
+    max_y = max_y_value * 1.15
+
+    fig = go.Figure()
+    fig.add_trace(go.Bar(
+        x=daily['day'],
+        y=daily['ThanhTien'],
+        name="Doanh Thu",
+        marker_color='#0068C9',
+        width=0.8
+    ))
+    fig.add_trace(go.Scatter(
+        x=daily['day'],
+        y=daily['LoiNhuan'],
+        name="Lợi Nhuận",
+        mode='lines+markers',
+        line=dict(color='red', width=3),
+        marker=dict(size=8)
+    ))
+
+    fig.update_layout(
+        title=f"Doanh thu & Lợi nhuận tháng {current_month}/{current_year}",
+        xaxis_title="Ngày",
+        yaxis_title="Số tiền (đ)",
+        xaxis=dict(
+            type='category',
+            tickmode='linear',
+            range=[0.5, last_day + 0.5],
+            constrain='domain',
+            showgrid=False
+        ),
+        yaxis=dict(
+            range=[0, max_y],
+            fixedrange=True,
+            zeroline=False,
+            showgrid=True
+        ),
+        bargap=0.15,
+        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1)
+    )
+    return fig
+
+def render_report_year(df_rollup, today_date):
+    st.write("### 🗓️ Phân tích hiệu quả theo năm")
+    current_year = today_date.year
+    if not df_rollup.empty:
+        fig_year = dm.report_memo(
+            "report_year_chart", (current_year,), (dm.ROLLUP_SHEET, "LichSuBan"),
+            lambda: build_year_chart(df_rollup, current_year)
+        )
+        if fig_year is not None:
+            st.plotly_chart(fig_year, use_container_width=True)
         else:
-            st.info("Tháng này chưa có dữ liệu bán hàng.")
-
-    with t3:
-        st.write("### 🗓️ Phân tích hiệu quả theo năm")
-        if not df_sales.empty:
-            df_sales['Nam'] = df_sales['NgayBan'].dt.year
-            df_sales['Thang'] = df_sales['NgayBan'].dt.month
-            current_year = datetime.now(tz).year
-            df_year = df_sales[df_sales['Nam'] == current_year].copy()
-            
-            if not df_year.empty:
-                yearly_stats = df_year.groupby('Thang')[['ThanhTien', 'LoiNhuan']].sum().reset_index()
-                months_full = pd.DataFrame({'Thang': range(1, 13)})
-                yearly_stats = months_full.merge(yearly_stats, on='Thang', how='left').fillna(0)
-                yearly_stats['DoanhThuTrieu'] = (yearly_stats['ThanhTien'] / 1_000_000).clip(lower=0)
-                yearly_stats['LoiNhuanTrieu'] = (yearly_stats['LoiNhuan'] / 1_000_000).clip(lower=0)
-
-                fig_year = go.Figure()
-                fig_year.add_trace(go.Bar(x=yearly_stats['Thang'], y=yearly_stats['DoanhThuTrieu'], name="Doanh thu (Triệu)", marker_color='#0068C9'))
-                fig_year.add_trace(go.Scatter(x=yearly_stats['Thang'], y=yearly_stats['LoiNhuanTrieu'], name="Lợi nhuận (Triệu)", mode='lines+markers', yaxis="y2", line=dict(color='#ff7f0e', width=3)))
-                fig_year.update_layout(
-                    title=f"Doanh thu & Lợi nhuận năm {current_year}",
-                    xaxis_title="Tháng",
-                    yaxis=dict(title="Doanh thu (Triệu đ)", range=[0, None]),
-                    yaxis2=dict(title="Lợi nhuận (Triệu đ)", overlaying="y", side="right", range=[0, None]),
-                    xaxis=dict(type='category')
+            st.warning("Chưa có dữ liệu năm nay.")
+    else:
+        st.info("Chưa có dữ liệu bán hàng.")
+
+def build_year_chart(df_rollup, current_year):
+    # None khi năm nay chưa có doanh thu nào trong bảng tổng hợp.
+    df_year = df_rollup[df_rollup['Ngay'].dt.year == current_year]
+    if df_year.empty:
+        return None
+    yearly_stats = df_year.groupby(df_year['Ngay'].dt.month)[['DoanhThu', 'LoiNhuan']].sum().reset_index()
+    yearly_stats.rename(columns={'Ngay': 'Thang', 'DoanhThu': 'ThanhTien'}, inplace=True)
+    months_full = pd.DataFrame({'Thang': range(1, 13)})
+    yearly_stats = months_full.merge(yearly_stats, on='Thang', how='left').fillna(0)
+    yearly_stats['DoanhThuTrieu'] = (yearly_stats['ThanhTien'] / 1_000_000).clip(lower=0)
+    yearly_stats['LoiNhuanTrieu'] = (yearly_stats['LoiNhuan'] / 1_000_000).clip(lower=0)
+
+    fig_year = go.Figure()
+    fig_year.add_trace(go.Bar(x=yearly_stats['Thang'], y=yearly_stats['DoanhThuTrieu'], name="Doanh thu (Triệu)", marker_color='#0068C9'))
+    fig_year.add_trace(go.Scatter(x=yearly_stats['Thang'], y=yearly_stats['LoiNhuanTrieu'], name="Lợi nhuận (Triệu)", mode='lines+markers', yaxis="y2", line=dict(color='#ff7f0e', width=3)))
+    fig_year.update_layout(
+        title=f"Doanh thu & Lợi nhuận năm {current_year}",
+        xaxis_title="Tháng",
+        yaxis=dict(title="Doanh thu (Triệu đ)", range=[0, None]),
+        yaxis2=dict(title="Lợi nhuận (Triệu đ)", overlaying="y", side="right", range=[0, None]),
+        xaxis=dict(type='category')
+    )
+    return fig_year
+
+def render_order_history(df_day, selected_date):
+    # Tổng hợp mọi đơn trong ngày bằng một lần groupby; chỉ dựng chi tiết (và nút hoàn trả)
+    # cho đơn đang được chọn trong bảng.
+    df_day = df_day[df_day['MaHoaDon'] != '']
+    sold = df_day['SoLuong'] > 0
+    orders = (
+        df_day.assign(SoMon=sold.astype(int), TongTien=df_day['ThanhTien'].where(sold, 0))
+        .groupby('MaHoaDon', as_index=False)
+        .agg(GioBan=('NgayBan', 'min'), SoMon=('SoMon', 'sum'), TongTien=('TongTien', 'sum'))
+        .sort_values(by='GioBan', ascending=False)
+        .reset_index(drop=True)
+    )
+    if orders.empty:
+        return
+
+    selected_order = st.session_state.get('order_selected')
+    if selected_order not in set(orders['MaHoaDon']):
+        selected_order = st.session_state['order_selected'] = None
+
+    page_df, page = paginate_frame(orders, f"order_page_{selected_date}", ORDER_PAGE_SIZE, "đơn")
+    view_df = pd.DataFrame({
+        'Mã đơn': page_df['MaHoaDon'],
+        'Giờ': page_df['GioBan'].dt.strftime('%H:%M'),
+        'Số sản phẩm': page_df['SoMon'],
+        'Tổng tiền': page_df['TongTien'].apply(format_currency),
+    })
+    table_key = f"order_table_{selected_date}_{page}"
+
+    def select_order_row():
+        rows = st.session_state[table_key].selection.rows
+        st.session_state['order_selected'] = page_df.iloc[rows[0]]['MaHoaDon'] if rows else None
+
+    st.caption("Chọn một đơn trong bảng để xem chi tiết và hoàn trả.")
+    st.dataframe(
+        view_df,
+        hide_index=True,
+        use_container_width=True,
+        on_select=select_order_row,
+        selection_mode="single-row",
+        key=table_key
+    )
+    if selected_order:
+        order_df = df_day[df_day['MaHoaDon'] == selected_order]
+        summary = orders[orders['MaHoaDon'] == selected_order].iloc[0]
+        with st.container(border=True):
+            st.markdown(
+                f"**🧾 Đơn {selected_order} | {summary['GioBan'].strftime('%H:%M')} | "
+                f"{int(summary['SoMon'])} sản phẩm | Tổng: {format_currency(summary['TongTien'])}**"
+            )
+            render_order_detail(selected_order, order_df)
+
+def render_order_detail(order_id, order_df):
+    # Chọn số lượng trả từng món rồi hoàn trả một lần (một lượt ghi lịch sử và tồn kho).
+    return_qty = {}
+    for idx, row in order_df.iterrows():
+        if row['SoLuong'] > 0:
+            with st.container(border=True):
+                c1, c2, c3, c4, c5 = st.columns([3, 1, 2, 2, 1.5])
+                c1.write(f"**{row['TenSanPham']}** ({row['MaSanPham']})")
+                c2.write(f"{int(row['SoLuong'])} {row['DonVi']}")
+                c3.write(f"Giá: {format_currency(row['GiaBan'])}")
+                c4.write(f"Thành tiền: {format_currency(row['ThanhTien'])}")
+                qty = c5.number_input(
+                    "SL trả", min_value=0, max_value=int(row['SoLuong']), value=0, step=1,
+                    key=f"ret_qty_{order_id}_{idx}"
                 )
-                st.plotly_chart(fig_year, use_container_width=True)
-            else:
-                st.warning("Chưa có dữ liệu năm nay.")
+                if qty:
+                    return_qty[row['MaSanPham']] = return_qty.get(row['MaSanPham'], 0) + qty
+    b1, b2 = st.columns(2)
+    if b1.button("↩️ Hoàn trả các món đã chọn", key=f"ret_lines_{order_id}", disabled=not return_qty):
+        if dm.process_return_lines(order_id, return_qty):
+            st.success(f"Đã hoàn trả {sum(return_qty.values())} sản phẩm của đơn {order_id}!")
+            st.rerun()
+    if b2.button("↩️ Hoàn trả cả đơn", key=f"ret_order_{order_id}"):
+        if dm.process_return_lines(order_id):
+            st.success(f"Đã hoàn trả toàn bộ đơn {order_id}!")
+            st.rerun()
+
+OFFLINE_WRITE_LABELS = {
+    'checkout': "Bán hàng",
+    'debt_checkout': "Bán nợ",
+    'import': "Nhập hàng",
+    'settle_debt': "Thu nợ",
+}
+
+STORAGE_BACKEND_LABELS = {
+    'sqlite': "SQLite cục bộ",
+    'memory': "bộ nhớ tạm (mất khi tắt app)",
+}
+
+def render_offline_status():
+    status = dm.offline_status()
+    tz = pytz.timezone('Asia/Ho_Chi_Minh')
+    if status['offline']:
+        snapshot_at = status['snapshot_at']
+        saved = datetime.fromtimestamp(snapshot_at, tz).strftime('%H:%M %d/%m') if snapshot_at else "?"
+        st.warning(f"📴 Mất kết nối Google Sheets. Đang dùng dữ liệu lưu lúc {saved}; sửa giá và hoàn trả tạm khóa.")
+    if status['pending']:
+        st.caption(f"⏳ {status['pending']} thao tác offline chờ đồng bộ lên Google Sheets")
+    conflicts = status['conflicts']
+    if conflicts:
+        with st.expander(f"⚠️ {len(conflicts)} thao tác offline cần kiểm tra"):
+            for conflict in conflicts:
+                label = OFFLINE_WRITE_LABELS.get(conflict.get('kind'), conflict.get('kind'))
+                at = str(conflict.get('at') or '')[:19].replace('T', ' ')
+                st.markdown(f"**{label}** lúc {at}: {conflict['reason']}")
+                for detail in conflict.get('details', []):
+                    st.caption(
+                        f"{detail['MaSanPham']}: tồn lúc offline {detail['expected']}, "
+                        f"trên Google Sheets {detail['live']}"
+                    )
+            if st.button("Đã kiểm tra xong"):
+                dm.dismiss_offline_conflicts()
+                st.rerun()
+
+def render_api_diagnostics():
+    with st.expander("🛠 Chẩn đoán Google Sheets API"):
+        stats = dm.api_metrics_snapshot()
+        if not stats:
+            st.caption("Chưa có lệnh gọi API nào.")
         else:
-            st.info("Chưa có dữ liệu bán hàng.")
+            df_stats = pd.DataFrame(stats).drop(columns=['histogram'])
+            st.metric("Tổng số lệnh gọi", int(df_stats['calls'].sum()))
+            st.caption(f"Tổng thời gian gọi API: {df_stats['total_ms'].sum() / 1000:.1f} s")
+            st.dataframe(df_stats, hide_index=True, use_container_width=True)
+        st.download_button(
+            "Tải thống kê (JSON)",
+            dm.api_metrics_json(),
+            file_name="sheets_api_metrics.json",
+            mime="application/json",
+        )
+        if st.button("Đặt lại thống kê"):
+            dm.reset_api_metrics()
+            st.rerun()
 
 # --- MAIN APP ---
 def main():
@@ -1143,7 +1465,20 @@ def main():
             st.divider()
             if st.button("Đăng Xuất"):
                 st.session_state['is_logged_in'] = False
+                st.session_state['is_admin'] = False
                 st.rerun()
+            pending_orders = dm.checkout_queue_status()
+            if pending_orders:
+                st.caption(f"⏳ {pending_orders} đơn đang chờ ghi lên Google Sheets")
+            render_offline_status()
+            backend = dm.storage_backend()
+            if backend != 'sheets':
+                st.caption(f"💾 Dữ liệu lưu tại: {STORAGE_BACKEND_LABELS.get(backend, backend)}")
+            queued_calls = dm.api_queue_depth()
+            if queued_calls:
+                st.caption(f"🚦 {queued_calls} yêu cầu Google Sheets đang chờ theo giới hạn quota")
+            if st.session_state['is_admin']:
+                render_api_diagnostics()
             st.caption("Minh Châu 24h v2.6")
 
         render_header()
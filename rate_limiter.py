@@ -0,0 +1,136 @@
+"""Token-bucket limiter with priorities and retry with exponential backoff for Sheets API calls.
+
+Waiting callers are served strictly by priority (lower number first), then by arrival,
+so a checkout never queues behind a report that asked earlier.
+"""
+import functools
+import heapq
+import itertools
+import random
+import threading
+import time
+
+import gspread
+import requests
+
+PRIORITY_POS = 0
+PRIORITY_READ = 1
+PRIORITY_REPORT = 2
+PRIORITY_BACKGROUND = 3
+
+
+class RateLimiter:
+    def __init__(self, rate_per_minute, burst=None, clock=time.monotonic):
+        self.rate = max(float(rate_per_minute), 1e-6) / 60.0
+        self.capacity = float(burst if burst is not None else max(1, int(rate_per_minute) // 6))
+        self._clock = clock
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._seq = itertools.count()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, priority=PRIORITY_READ):
+        with self._cond:
+            ticket = (priority, next(self._seq))
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    now = self._clock()
+                    self._refill(now)
+                    if self._waiting[0] != ticket:
+                        self._cond.wait()
+                        continue
+                    if now < self._paused_until:
+                        self._cond.wait(self._paused_until - now)
+                    elif self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    else:
+                        self._cond.wait((1 - self._tokens) / self.rate)
+            finally:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+
+    def pause(self, seconds):
+        """Hold every caller for ``seconds`` (after a 429 the whole quota is exhausted, not one call)."""
+        with self._cond:
+            self._paused_until = max(self._paused_until, self._clock() + seconds)
+            self._tokens = min(self._tokens, 0.0)
+            self._cond.notify_all()
+
+    def queue_depth(self):
+        with self._cond:
+            return len(self._waiting)
+
+
+def backoff_delay(attempt, base_delay=1.0, max_delay=32.0, rand=random.uniform):
+    """Full-jitter exponential backoff: uniform(0, min(max_delay, base_delay * 2**attempt))."""
+    return rand(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def call_with_backoff(limiter, fn, priority=PRIORITY_READ, classify=None, max_attempts=5, sleep=time.sleep):
+    """Run ``fn()`` under ``limiter``, retrying failures that ``classify(error)`` marks as transient.
+
+    ``classify`` returns None (give up), ``('retry', None)`` for a server or network error, or
+    ``('throttle', retry_after)`` for a quota error, which pauses the whole limiter.
+    """
+    for attempt in range(max_attempts):
+        limiter.acquire(priority)
+        try:
+            return fn()
+        except Exception as e:
+            verdict = classify(e) if classify else None
+            if verdict is None or attempt == max_attempts - 1:
+                raise
+            kind, retry_after = verdict
+            delay = max(retry_after or 0.0, backoff_delay(attempt))
+            if kind == 'throttle':
+                limiter.pause(delay)
+            else:
+                sleep(delay)
+
+
+def classify_sheets_error(method, error, non_idempotent=frozenset()):
+    """``classify`` verdict for a Sheets call: 429 throttles; 5xx, dropped connections and
+    timeouts are retried unless ``method`` is in ``non_idempotent`` (the server may already
+    have applied it).
+    """
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return ('retry', None) if method not in non_idempotent else None
+    if not isinstance(error, gspread.exceptions.APIError):
+        return None
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None) or 0
+    if status == 429:
+        try:
+            retry_after = float(response.headers.get('Retry-After'))
+        except (AttributeError, TypeError, ValueError):
+            retry_after = None
+        return ('throttle', retry_after)
+    if status >= 500 and method not in non_idempotent:
+        return ('retry', None)
+    return None
+
+
+class RateLimitedWorksheet:
+    """Worksheet proxy sending every method call through ``call(method_name, fn, *args, **kwargs)``.
+
+    Plain attributes (title, row_count, col_count...) are read straight from the worksheet.
+    """
+
+    def __init__(self, worksheet, call):
+        self.worksheet = worksheet
+        self._call = call
+
+    def __getattr__(self, attr):
+        value = getattr(self.worksheet, attr)
+        if attr.startswith('_') or not callable(value):
+            return value
+        return functools.partial(self._call, attr, value)
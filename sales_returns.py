@@ -0,0 +1,61 @@
+"""Returns recorded as LichSuBan rows with negative SoLuong, netted against the sale lines they undo."""
+import pandas as pd
+
+
+
+def allocate_return(line_qtys, qty):
+    """Spread ``qty`` over sale lines in order; returns [(line position, quantity taken)]."""
+    taken = []
+    for pos, line_qty in enumerate(line_qtys):
+        if qty <= 0:
+            break
+        take = min(qty, line_qty)
+        if take > 0:
+            taken.append((pos, take))
+            qty -= take
+    return taken
+
+
+def return_amount(total, line_qty, take):
+    """Share of a sale line's ThanhTien/LoiNhuan for ``take`` of its ``line_qty`` units (whole VND)."""
+    return int(round(total * take / line_qty)) if line_qty else 0
+
+
+def net_sales_returns(df):
+    """Apply return rows (SoLuong < 0) to the sale lines with the same MaHoaDon and MaSanPham.
+
+    Fully returned lines and the applied return rows are dropped; a return row that
+    matches no sale is kept as is (reports only count rows with SoLuong > 0).
+    Returns (netted frame, {(year, month)} of the sale lines that changed).
+    """
+    is_return = df['SoLuong'] < 0
+    if not is_return.any():
+        return df, set()
+    # Chỉ xét các dòng thuộc những đơn có hoàn trả, không ghép khóa cho cả lịch sử.
+    involved = df[df['MaHoaDon'].isin(set(df.loc[is_return, 'MaHoaDon']))]
+    keys = involved['MaHoaDon'].astype(str) + '|' + involved['MaSanPham'].astype(str).str.strip()
+    lines = {}
+    for i in involved.index[involved['SoLuong'] > 0]:
+        lines.setdefault(keys[i], []).append(i)
+
+    df = df.copy()
+    original = involved[['SoLuong', 'ThanhTien', 'LoiNhuan']].copy()
+    consumed, months = [], set()
+    for r in involved.index[involved['SoLuong'] < 0]:
+        sale_lines = lines.get(keys[r])
+        if not sale_lines:
+            continue
+        for pos, take in allocate_return([df.at[i, 'SoLuong'] for i in sale_lines], -df.at[r, 'SoLuong']):
+            i = sale_lines[pos]
+            line_qty = original.at[i, 'SoLuong']
+            df.at[i, 'SoLuong'] -= take
+            df.at[i, 'ThanhTien'] -= return_amount(original.at[i, 'ThanhTien'], line_qty, take)
+            df.at[i, 'LoiNhuan'] -= return_amount(original.at[i, 'LoiNhuan'], line_qty, take)
+            sold_at = df.at[i, 'NgayBan']
+            if pd.notna(sold_at):
+                months.add((sold_at.year, sold_at.month))
+        consumed.append(r)
+    current = df.loc[original.index, 'SoLuong']
+    fully_returned = original.index[(original['SoLuong'] > 0) & (current <= 0)]
+    df = df.drop(index=list(consumed) + list(fully_returned)).reset_index(drop=True)
+    return df, months
@@ -0,0 +1,87 @@
+"""Per-day, per-payment-method sales totals kept in step with LichSuBan (sheet TongHopNgay)."""
+import pandas as pd
+
+ROLLUP_COLUMNS = ['Ngay', 'HinhThucTT', 'DoanhThu', 'LoiNhuan', 'SoDon', 'SoLuongSP']
+_METRICS = ('DoanhThu', 'LoiNhuan', 'SoDon', 'SoLuongSP')
+
+
+def _number(value):
+    try:
+        num = float(value)
+    except (TypeError, ValueError):
+        return 0
+    return int(num) if num.is_integer() else num
+
+
+def apply_delta(rollup, day, payment_method, revenue=0, profit=0, orders=0, items=0):
+    """Add a change to one (day, payment method) bucket; returns the bucket key."""
+    key = (str(day), str(payment_method))
+    bucket = rollup.setdefault(key, dict.fromkeys(_METRICS, 0))
+    bucket['DoanhThu'] += revenue
+    bucket['LoiNhuan'] += profit
+    bucket['SoDon'] += orders
+    bucket['SoLuongSP'] += items
+    return key
+
+
+def rollup_from_sales(df_sales):
+    """Aggregate a parsed sales frame (NgayBan, MaHoaDon, SoLuong, ThanhTien, LoiNhuan, HinhThucTT)."""
+    rollup = {}
+    if df_sales.empty:
+        return rollup
+    df = df_sales[df_sales['NgayBan'].notna() & (df_sales['SoLuong'] > 0)]
+    if df.empty:
+        return rollup
+    grouped = df.groupby([df['NgayBan'].dt.strftime('%Y-%m-%d'), df['HinhThucTT']]).agg(
+        DoanhThu=('ThanhTien', 'sum'),
+        LoiNhuan=('LoiNhuan', 'sum'),
+        SoDon=('MaHoaDon', 'nunique'),
+        SoLuongSP=('SoLuong', 'sum'),
+    )
+    for (day, payment_method), row in grouped.iterrows():
+        rollup[(day, payment_method)] = {m: _number(row[m]) for m in _METRICS}
+    return rollup
+
+
+def rollup_to_row(key, bucket):
+    return [key[0], key[1]] + [_number(bucket[m]) for m in _METRICS]
+
+
+def rows_to_rollup(values):
+    """Read sheet values (header first); returns (rollup, {key: sheet_row})."""
+    rollup, positions = {}, {}
+    if not values:
+        return rollup, positions
+    header = [str(h).strip() for h in values[0]]
+    idx = {name: i for i, name in enumerate(header)}
+    if any(col not in idx for col in ROLLUP_COLUMNS):
+        return rollup, positions
+    for sheet_row, row in enumerate(values[1:], start=2):
+        cells = list(row) + [''] * (len(header) - len(row))
+        day = str(cells[idx['Ngay']]).strip()
+        if not day:
+            continue
+        key = (day, str(cells[idx['HinhThucTT']]).strip())
+        rollup[key] = {m: _number(cells[idx[m]]) for m in _METRICS}
+        positions[key] = sheet_row
+    return rollup, positions
+
+
+def diff_rollups(current, target):
+    """Keys whose buckets differ; buckets missing from ``target`` are reported as zeroed."""
+    changed = {}
+    for key in set(current) | set(target):
+        bucket = target.get(key, dict.fromkeys(_METRICS, 0))
+        if current.get(key) != bucket:
+            changed[key] = bucket
+    return changed
+
+
+def rollup_frame(rollup):
+    if not rollup:
+        df = pd.DataFrame(columns=ROLLUP_COLUMNS)
+        df['Ngay'] = pd.to_datetime(df['Ngay'])
+        return df
+    df = pd.DataFrame([rollup_to_row(k, v) for k, v in sorted(rollup.items())], columns=ROLLUP_COLUMNS)
+    df['Ngay'] = pd.to_datetime(df['Ngay'], errors='coerce')
+    return df
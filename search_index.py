@@ -0,0 +1,113 @@
+"""In-memory product search over MaSanPham/TenSanPham with Vietnamese accent folding."""
+import re
+import unicodedata
+from bisect import bisect_left
+
+NGRAM = 3
+_TOKEN_RE = re.compile(r'[0-9a-z]+')
+
+
+def fold_text(text):
+    """Lowercase and strip Vietnamese diacritics ('Thuốc Đau' -> 'thuoc dau')."""
+    text = str(text).replace('đ', 'd').replace('Đ', 'D')
+    decomposed = unicodedata.normalize('NFD', text)
+    return ''.join(ch for ch in decomposed if not unicodedata.combining(ch)).lower()
+
+
+def _ngrams(word):
+    return {word[i:i + NGRAM] for i in range(len(word) - NGRAM + 1)}
+
+
+class ProductSearchIndex:
+    """Word-prefix postings for short query words, trigram postings for longer ones.
+
+    One- and two-letter query words that match inside a word (``'12'`` in ``SP0012``) are
+    looked up in postings of every one- and two-letter piece of the words.
+
+    Documents are numbered in (name, id) order, so every posting list is already in
+    display order and a search can stop as soon as it has ``limit`` results.
+    Ranking: exact code, code prefix, name prefix, every word matching a word start,
+    then matches inside words. ``search`` returns positions in the ``ids``/``names``
+    lists the index was built from.
+    """
+
+    def __init__(self, ids, names):
+        self.ids = list(ids)
+        self.names = list(names)
+        folded_ids = [fold_text(v).strip() for v in self.ids]
+        folded_names = [fold_text(v).strip() for v in self.names]
+        self._order = sorted(range(len(self.ids)), key=lambda p: (folded_names[p], folded_ids[p]))
+        self._names = [folded_names[p] for p in self._order]
+        self._sorted_ids = sorted((folded_ids[p], doc) for doc, p in enumerate(self._order))
+        self._words = [_TOKEN_RE.findall(f"{folded_names[p]} {folded_ids[p]}") for p in self._order]
+        self._texts = [' '.join(words) for words in self._words]
+        self._prefixes = {}
+        self._pieces = {}
+        self._grams = {}
+        for doc, words in enumerate(self._words):
+            prefixes = {w[:end] for w in words for end in range(1, min(len(w), NGRAM - 1) + 1)}
+            pieces = {w[i:i + NGRAM - 1] for w in words for i in range(len(w) - NGRAM + 2)}
+            pieces.update(self._texts[doc].replace(' ', ''))
+            grams = {w[i:i + NGRAM] for w in words for i in range(len(w) - NGRAM + 1)}
+            for prefix in prefixes:
+                self._prefixes.setdefault(prefix, []).append(doc)
+            for piece in pieces:
+                self._pieces.setdefault(piece, []).append(doc)
+            for gram in grams:
+                self._grams.setdefault(gram, []).append(doc)
+
+    def same_catalog(self, ids, names):
+        return self.ids == list(ids) and self.names == list(names)
+
+    def _postings(self, token, inside_words):
+        # Danh sách chắc chắn chứa mọi tài liệu có thể khớp; chọn danh sách ngắn nhất.
+        if len(token) < NGRAM:
+            return (self._pieces if inside_words else self._prefixes).get(token, [])
+        shortest = min((self._grams.get(g, []) for g in _ngrams(token)), key=len)
+        if inside_words:
+            return shortest
+        return min(shortest, self._prefixes.get(token[:NGRAM - 1], []), key=len)
+
+    def _matches(self, doc, tokens, inside_words):
+        words = self._words[doc]
+        for token in tokens:
+            if any(w.startswith(token) for w in words):
+                continue
+            if inside_words and token in self._texts[doc]:
+                continue
+            return False
+        return True
+
+    def search(self, query, limit=50):
+        """Positions of the best matches for ``query``, best first (at most ``limit``)."""
+        query = fold_text(query).strip()
+        tokens = list(dict.fromkeys(_TOKEN_RE.findall(query)))
+        if not tokens or limit <= 0:
+            return []
+
+        ranked, seen = [], set()
+
+        def take(doc):
+            if doc not in seen:
+                seen.add(doc)
+                ranked.append(doc)
+
+        # Khớp mã chính xác / đầu mã, rồi đầu tên: tra bằng bisect trên danh sách đã sắp xếp.
+        i = bisect_left(self._sorted_ids, (query,))
+        while i < len(self._sorted_ids) and len(ranked) < limit and self._sorted_ids[i][0].startswith(query):
+            take(self._sorted_ids[i][1])
+            i += 1
+        i = bisect_left(self._names, query)
+        while i < len(self._names) and len(ranked) < limit and self._names[i].startswith(query):
+            take(i)
+            i += 1
+
+        # Còn lại: khớp đầu từ trước, khớp giữa từ sau. Mỗi lượt duyệt danh sách posting
+        # ngắn nhất theo thứ tự hiển thị và dừng khi đủ kết quả.
+        for inside_words in (False, True):
+            for doc in min((self._postings(t, inside_words) for t in tokens), key=len):
+                if len(ranked) >= limit:
+                    return [self._order[doc] for doc in ranked]
+                if doc not in seen and self._matches(doc, tokens, inside_words):
+                    take(doc)
+        return [self._order[doc] for doc in ranked]
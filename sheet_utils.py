@@ -1,3 +1,6 @@
+import re
+
+
 def ensure_worksheet_capacity(worksheet, required_rows, required_cols, row_buffer=1000):
     """Expand a worksheet before writing an explicit A1 range outside its grid."""
     current_rows = int(getattr(worksheet, 'row_count', 0) or 0)
@@ -10,3 +13,121 @@ def ensure_worksheet_capacity(worksheet, required_rows, required_cols, row_buffe
         target_rows = max(required_rows, current_rows + row_buffer)
     target_cols = max(required_cols, current_cols)
     worksheet.resize(rows=target_rows, cols=target_cols)
+
+
+def column_letter(col):
+    """Convert a 1-based column number to its A1 letter (1 -> A, 27 -> AA)."""
+    letters = ''
+    while col > 0:
+        col, rem = divmod(col - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+
+def rowcol_to_a1(row, col):
+    return f"{column_letter(col)}{row}"
+
+
+def find_next_free_row(worksheet, cached_row=None, probe_col=1):
+    """Return the first empty row after the data block.
+
+    A cached cursor is trusted when a two-cell probe shows data just above it and
+    nothing on it; otherwise only ``probe_col`` is read, never the whole sheet.
+    """
+    if cached_row and cached_row >= 2:
+        if cursor_confirmed(worksheet.get(cursor_probe_range(cached_row, probe_col))):
+            return cached_row
+    return len(worksheet.col_values(probe_col)) + 1
+
+
+def cursor_probe_range(cached_row, probe_col=1):
+    """Two-cell range checked by ``cursor_confirmed``: the row above the cursor and the cursor row."""
+    col = column_letter(probe_col)
+    return f"{col}{cached_row - 1}:{col}{cached_row}"
+
+
+def cursor_confirmed(probe):
+    return len(probe) == 1 and bool(probe[0]) and str(probe[0][0]).strip() != ''
+
+
+def appended_first_row(response):
+    """First sheet row written by ``append_rows``, read from the API response (None if unknown)."""
+    try:
+        updated_range = response['updates']['updatedRange']
+    except (TypeError, KeyError):
+        return None
+    return parse_a1_range(updated_range)[0]
+
+
+def build_row_index(values, first_row=2):
+    """Map each non-empty key to the first sheet row holding it (``values[0]`` sits on ``first_row``)."""
+    index = {}
+    for offset, value in enumerate(values):
+        key = str(value).strip()
+        if key and key not in index:
+            index[key] = first_row + offset
+    return index
+
+
+def _row_signature(row):
+    values = [str(v).strip() for v in (row or [])]
+    while values and values[-1] == '':
+        values.pop()
+    return values
+
+
+def rows_fingerprint(rows, width):
+    """Order-insensitive fingerprint of ``rows`` cut or padded to ``width`` cells.
+
+    Built from hash(), so it is only comparable within one process.
+    """
+    pad = ('',) * width
+    return sum(hash((tuple(row) + pad)[:width]) for row in rows)
+
+
+def read_sheet_tail(worksheet, known_rows, anchor_row, header):
+    """Return rows appended after row ``known_rows``, or None when a full reload is needed.
+
+    The header and the last known row (the anchor) are re-read in the same request;
+    if either changed, rows were deleted or the layout moved and the cached copy is
+    no longer aligned with the sheet.
+    """
+    width = max(len(header), 1)
+    end_col = column_letter(width)
+    header_part, tail = worksheet.batch_get(
+        [f"A1:{end_col}1", f"A{known_rows}:{end_col}"],
+        value_render_option='UNFORMATTED_VALUE'
+    )
+    current_header = header_part[0] if header_part else []
+    if _row_signature(current_header) != _row_signature(header):
+        return None
+    if not tail or _row_signature(tail[0]) != _row_signature(anchor_row):
+        return None
+    return [list(row) + [''] * (width - len(row)) for row in tail[1:]]
+
+
+def column_number(letters):
+    number = 0
+    for letter in letters.upper():
+        number = number * 26 + ord(letter) - 64
+    return number
+
+
+def parse_a1_range(a1_range):
+    """Split 'A1:K', 'A:ZZ', 'B2' or 'Sheet!A1:B2' into (start_row, start_col, end_row, end_col).
+
+    Open ends are returned as None.
+    """
+    a1_range = str(a1_range).split('!')[-1]
+    parts = a1_range.split(':')
+    bounds = []
+    for part in parts:
+        m = re.match(r'^([A-Za-z]*)(\d*)$', part.strip())
+        if not m:
+            raise ValueError(f"Invalid A1 range: {a1_range}")
+        col = column_number(m.group(1)) if m.group(1) else None
+        row = int(m.group(2)) if m.group(2) else None
+        bounds.append((row, col))
+    start_row, start_col = bounds[0]
+    end_row, end_col = bounds[-1] if len(bounds) > 1 else bounds[0]
+    return start_row, start_col, end_row, end_col
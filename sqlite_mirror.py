@@ -0,0 +1,426 @@
+"""Local SQLite copy of the worksheets used by data_manager.
+
+Each sheet is stored as a grid table: the sheet row number plus one column per
+sheet column, with the header kept as row 1 so A1 ranges map one-to-one.
+"""
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+
+from sheet_utils import parse_a1_range
+
+INDEXED_HEADERS = ('MaSanPham', 'MaHoaDon', 'MaPhieuNo', 'NgayBan')
+
+
+def _table_name(sheet_name):
+    return 'sheet_' + re.sub(r'[^0-9A-Za-z_]', '_', str(sheet_name))
+
+
+def _cell(value):
+    return '' if value is None else value
+
+
+class SheetStore:
+    """Thread-safe grid storage for several sheets in one SQLite file."""
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.RLock()
+        self._widths = {}
+        self._generations = {}
+        self._dirty = set()
+        # Bản lưu từ lần chạy trước chỉ dùng được sau khi đã đồng bộ lại trong process này.
+        self._synced = set()
+        self._synced_generation = {}
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS _sheets ('
+                'name TEXT PRIMARY KEY, row_count INTEGER, col_count INTEGER, '
+                'synced_at REAL, checksum TEXT)'
+            )
+            self._conn.commit()
+
+    # --- metadata ---
+    def _meta(self, name):
+        return self._conn.execute(
+            'SELECT row_count, col_count, synced_at, checksum FROM _sheets WHERE name = ?', (name,)
+        ).fetchone()
+
+    def has_sheet(self, name):
+        with self._lock:
+            return self._meta(name) is not None
+
+    def is_synced(self, name):
+        with self._lock:
+            return name in self._synced and name not in self._dirty
+
+    def mark_dirty(self, name):
+        with self._lock:
+            self._dirty.add(name)
+
+    def is_dirty(self, name):
+        with self._lock:
+            return name in self._dirty
+
+    def synced_at(self, name):
+        """Time of the last full download of ``name`` (None if never synced)."""
+        with self._lock:
+            meta = self._meta(name)
+            return meta[2] if meta else None
+
+    def generation(self, name):
+        with self._lock:
+            return self._generations.get(name, 0)
+
+    def sheet_names(self):
+        with self._lock:
+            return [r[0] for r in self._conn.execute('SELECT name FROM _sheets ORDER BY name')]
+
+    def grid_size(self, name):
+        with self._lock:
+            meta = self._meta(name)
+            if meta is None:
+                return 0, 0
+            return int(meta[0] or 0), int(meta[1] or 0)
+
+    def create_sheet(self, name, rows=1000, cols=26):
+        with self._lock:
+            if self._meta(name) is None:
+                self._conn.execute(
+                    'INSERT INTO _sheets (name, row_count, col_count) VALUES (?, ?, ?)', (name, rows, cols)
+                )
+            self._ensure_table(name, cols)
+            self._conn.commit()
+
+    def resize(self, name, rows=None, cols=None):
+        with self._lock:
+            cur_rows, cur_cols = self.grid_size(name)
+            rows = cur_rows if rows is None else rows
+            cols = cur_cols if cols is None else cols
+            if self._meta(name) is None:
+                self._conn.execute(
+                    'INSERT INTO _sheets (name, row_count, col_count) VALUES (?, ?, ?)', (name, rows, cols)
+                )
+            else:
+                self._conn.execute(
+                    'UPDATE _sheets SET row_count = ?, col_count = ? WHERE name = ?', (rows, cols, name)
+                )
+            self._ensure_table(name, cols)
+            self._conn.commit()
+
+    # --- table layout ---
+    def _width(self, name):
+        if name not in self._widths:
+            table = _table_name(name)
+            info = self._conn.execute(f'PRAGMA table_info("{table}")').fetchall()
+            self._widths[name] = max(len(info) - 1, 0)
+        return self._widths[name]
+
+    def _ensure_table(self, name, cols):
+        table = _table_name(name)
+        self._conn.execute(f'CREATE TABLE IF NOT EXISTS "{table}" (_row INTEGER PRIMARY KEY)')
+        width = self._width(name)
+        for col in range(width + 1, cols + 1):
+            self._conn.execute(f'ALTER TABLE "{table}" ADD COLUMN c{col}')
+        self._widths[name] = max(width, cols)
+
+    def _refresh_indexes(self, name):
+        table = _table_name(name)
+        header = self._conn.execute(f'SELECT * FROM "{table}" WHERE _row = 1').fetchone()
+        if not header:
+            return
+        for col, value in enumerate(header[1:], start=1):
+            if str(_cell(value)).strip() in INDEXED_HEADERS:
+                self._conn.execute(f'CREATE INDEX IF NOT EXISTS "{table}_c{col}" ON "{table}" (c{col})')
+
+    def _bump(self, name):
+        self._generations[name] = self._generations.get(name, 0) + 1
+
+    # --- full sync ---
+    def replace(self, name, values, expected_generation=None):
+        """Replace a sheet with a full download; returns True when the content changed.
+
+        A write that happened after ``expected_generation`` was read wins: the
+        replace is skipped and the sheet stays dirty for the next reconcile.
+        """
+        checksum = hashlib.sha1(
+            json.dumps(values, default=str, ensure_ascii=False).encode('utf-8')
+        ).hexdigest()
+        with self._lock:
+            if expected_generation is not None and expected_generation != self._generations.get(name, 0):
+                self._dirty.add(name)
+                return False
+            meta = self._meta(name)
+            now = time.time()
+            untouched = self._synced_generation.get(name) == self._generations.get(name, 0)
+            if meta is not None and meta[3] == checksum and untouched:
+                self._conn.execute('UPDATE _sheets SET synced_at = ? WHERE name = ?', (now, name))
+                self._conn.commit()
+                self._dirty.discard(name)
+                self._synced.add(name)
+                return False
+
+            width = max([len(row) for row in values] + [1])
+            table = _table_name(name)
+            self._conn.execute(f'DROP TABLE IF EXISTS "{table}"')
+            self._widths.pop(name, None)
+            self._ensure_table(name, width)
+            cols = ', '.join(['_row'] + [f'c{c}' for c in range(1, width + 1)])
+            marks = ', '.join(['?'] * (width + 1))
+            self._conn.executemany(
+                f'INSERT INTO "{table}" ({cols}) VALUES ({marks})',
+                (
+                    [row_num] + list(row) + [''] * (width - len(row))
+                    for row_num, row in enumerate(values, start=1)
+                    if any(str(_cell(v)).strip() for v in row)
+                )
+            )
+            rows = max(len(values), meta[0] or 0) if meta else len(values)
+            cols_count = max(width, meta[1] or 0) if meta else width
+            self._conn.execute(
+                'INSERT OR REPLACE INTO _sheets (name, row_count, col_count, synced_at, checksum) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (name, rows, cols_count, now, checksum)
+            )
+            self._refresh_indexes(name)
+            self._conn.commit()
+            self._dirty.discard(name)
+            self._synced.add(name)
+            self._bump(name)
+            self._synced_generation[name] = self._generations[name]
+            return True
+
+    # --- reads ---
+    def last_row(self, name):
+        with self._lock:
+            if not self.has_sheet(name):
+                return 0
+            row = self._conn.execute(f'SELECT MAX(_row) FROM "{_table_name(name)}"').fetchone()
+            return int(row[0] or 0)
+
+    def get_values(self, name, start_row=None, start_col=None, end_row=None, end_col=None, pad=False):
+        with self._lock:
+            if not self.has_sheet(name):
+                return []
+            width = self._width(name)
+            start_row = start_row or 1
+            start_col = start_col or 1
+            end_row = end_row or self.last_row(name)
+            end_col = min(end_col or width, width)
+            if end_row < start_row or end_col < start_col:
+                return []
+            cols = ', '.join(['_row'] + [f'c{c}' for c in range(start_col, end_col + 1)])
+            fetched = self._conn.execute(
+                f'SELECT {cols} FROM "{_table_name(name)}" WHERE _row BETWEEN ? AND ? ORDER BY _row',
+                (start_row, end_row)
+            ).fetchall()
+
+        by_row = {r[0]: [_cell(v) for v in r[1:]] for r in fetched}
+        last = max(by_row) if by_row else start_row - 1
+        result = []
+        for row_num in range(start_row, last + 1):
+            row = by_row.get(row_num, [])
+            while row and row[-1] == '':
+                row.pop()
+            result.append(row)
+        if pad:
+            # Như Google Sheets: lưới chữ nhật rộng tới cột cuối cùng có dữ liệu, không tới hết bảng.
+            span = max([len(row) for row in result] + [0])
+            result = [row + [''] * (span - len(row)) for row in result]
+        return result
+
+    # --- writes ---
+    def set_values(self, name, start_row, start_col, rows):
+        with self._lock:
+            if not self.has_sheet(name):
+                self.create_sheet(name)
+            end_col = start_col + max([len(r) for r in rows] + [1]) - 1
+            self._ensure_table(name, end_col)
+            table = _table_name(name)
+            for offset, row in enumerate(rows):
+                if not row:
+                    continue
+                cols = [f'c{start_col + i}' for i in range(len(row))]
+                updates = ', '.join(f'{c} = excluded.{c}' for c in cols)
+                self._conn.execute(
+                    f'INSERT INTO "{table}" (_row, {", ".join(cols)}) VALUES ({", ".join(["?"] * (len(row) + 1))}) '
+                    f'ON CONFLICT(_row) DO UPDATE SET {updates}',
+                    [start_row + offset] + list(row)
+                )
+            rows_count, cols_count = self.grid_size(name)
+            end_row = start_row + len(rows) - 1
+            if end_row > rows_count or end_col > cols_count:
+                self._conn.execute(
+                    'UPDATE _sheets SET row_count = ?, col_count = ? WHERE name = ?',
+                    (max(rows_count, end_row), max(cols_count, end_col), name)
+                )
+            if start_row == 1:
+                self._refresh_indexes(name)
+            self._conn.commit()
+            self._bump(name)
+
+    def append_rows(self, name, rows):
+        with self._lock:
+            start_row = self.last_row(name) + 1
+            self.set_values(name, start_row, 1, rows)
+            return start_row
+
+    def delete_rows(self, name, start_row, end_row=None):
+        end_row = end_row or start_row
+        count = end_row - start_row + 1
+        with self._lock:
+            table = _table_name(name)
+            self._conn.execute(f'DELETE FROM "{table}" WHERE _row BETWEEN ? AND ?', (start_row, end_row))
+            # Dời hai bước qua số âm để không vướng ràng buộc khóa chính khi đánh lại số dòng.
+            self._conn.execute(f'UPDATE "{table}" SET _row = -(_row - ?) WHERE _row > ?', (count, end_row))
+            self._conn.execute(f'UPDATE "{table}" SET _row = -_row WHERE _row < 0')
+            rows_count, cols_count = self.grid_size(name)
+            self._conn.execute(
+                'UPDATE _sheets SET row_count = ? WHERE name = ?', (max(rows_count - count, 0), name)
+            )
+            self._conn.commit()
+            self._bump(name)
+
+
+class SQLiteWorksheet:
+    """Worksheet-like view over one sheet of a SheetStore (the subset data_manager uses)."""
+
+    def __init__(self, store, title):
+        self.store = store
+        self.title = title
+
+    @property
+    def row_count(self):
+        return self.store.grid_size(self.title)[0]
+
+    @property
+    def col_count(self):
+        return self.store.grid_size(self.title)[1]
+
+    def get_all_values(self, value_render_option=None, **kwargs):
+        return self.store.get_values(self.title, pad=True)
+
+    def get(self, range_name=None, value_render_option=None, **kwargs):
+        if range_name is None:
+            return self.store.get_values(self.title)
+        start_row, start_col, end_row, end_col = parse_a1_range(range_name)
+        return self.store.get_values(self.title, start_row, start_col, end_row, end_col)
+
+    def batch_get(self, ranges, value_render_option=None, **kwargs):
+        return [self.get(r) for r in ranges]
+
+    def row_values(self, row, value_render_option=None, **kwargs):
+        values = self.store.get_values(self.title, row, None, row, None)
+        return values[0] if values else []
+
+    def col_values(self, col, value_render_option=None, **kwargs):
+        values = [r[0] if r else '' for r in self.store.get_values(self.title, 1, col, None, col)]
+        while values and values[-1] == '':
+            values.pop()
+        return values
+
+    def update_cell(self, row, col, value):
+        self.store.set_values(self.title, row, col, [[value]])
+
+    def update(self, range_name, values=None, value_input_option=None, **kwargs):
+        # gspread >= 6 đổi thứ tự tham số thành update(values, range_name).
+        if isinstance(range_name, list):
+            range_name, values = values, range_name
+        start_row, start_col, _, _ = parse_a1_range(range_name)
+        self.store.set_values(self.title, start_row or 1, start_col or 1, values)
+
+    def batch_update(self, data, value_input_option=None, **kwargs):
+        for item in data:
+            self.update(item['range'], item['values'])
+
+    def append_row(self, values, **kwargs):
+        return self.append_rows([values])
+
+    def append_rows(self, values, **kwargs):
+        # Trả về dạng response của Sheets API để nơi gọi biết các dòng vừa ghi nằm ở đâu.
+        start_row = self.store.append_rows(self.title, values)
+        return {'updates': {'updatedRange': f"{self.title}!A{start_row}:A{start_row + len(values) - 1}"}}
+
+    def delete_rows(self, start_index, end_index=None):
+        self.store.delete_rows(self.title, start_index, end_index)
+
+    def resize(self, rows=None, cols=None):
+        self.store.resize(self.title, rows, cols)
+
+
+class SQLiteSpreadsheet:
+    """Spreadsheet-like view over a SheetStore; a sheet missing from the store reads as empty."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def worksheet(self, title):
+        return SQLiteWorksheet(self.store, title)
+
+    def worksheets(self):
+        return [SQLiteWorksheet(self.store, name) for name in self.store.sheet_names()]
+
+    def add_worksheet(self, title, rows=1000, cols=26, **kwargs):
+        self.store.create_sheet(title, rows, cols)
+        return self.worksheet(title)
+
+
+class MirroredWorksheet:
+    """Serve reads from SQLite; write to SQLite first, then replicate to the remote worksheet.
+
+    If the remote write fails the local copy is marked dirty and re-pulled from
+    the sheet (the system of record) before the next read.
+    """
+
+    _WRITES = ('update_cell', 'update', 'batch_update', 'append_row', 'append_rows', 'delete_rows')
+    _READS = ('get_all_values', 'get', 'batch_get', 'row_values', 'col_values')
+
+    def __init__(self, store, remote):
+        self.store = store
+        self.remote = remote
+        self.title = remote.title
+        self.local = SQLiteWorksheet(store, remote.title)
+        if not store.is_synced(self.title):
+            self.reconcile()
+
+    def reconcile(self):
+        generation = self.store.generation(self.title)
+        try:
+            values = self.remote.get_all_values(value_render_option='UNFORMATTED_VALUE')
+        except TypeError:
+            values = self.remote.get_all_values()
+        return self.store.replace(self.title, values, generation)
+
+    @property
+    def row_count(self):
+        return self.remote.row_count
+
+    @property
+    def col_count(self):
+        return self.remote.col_count
+
+    def resize(self, rows=None, cols=None):
+        self.remote.resize(rows=rows, cols=cols)
+        self.store.resize(self.title, rows, cols)
+
+    def __getattr__(self, attr):
+        if attr in self._READS:
+            def read(*args, **kwargs):
+                if self.store.is_dirty(self.title):
+                    self.reconcile()
+                return getattr(self.local, attr)(*args, **kwargs)
+            return read
+        if attr in self._WRITES:
+            def write(*args, **kwargs):
+                getattr(self.local, attr)(*args, **kwargs)
+                try:
+                    return getattr(self.remote, attr)(*args, **kwargs)
+                except Exception:
+                    self.store.mark_dirty(self.title)
+                    raise
+            return write
+        return getattr(self.remote, attr)
@@ -0,0 +1,77 @@
+"""Storage backends data_manager can run on: Google Sheets, a local SQLite file, or memory.
+
+A backend is a spreadsheet object with the gspread surface data_manager uses:
+``worksheet(title)``, ``worksheets()`` and ``add_worksheet(title, rows, cols)``. Its
+worksheets expose ``title``, ``row_count``, ``col_count`` and the methods in
+``WORKSHEET_METHODS``: range reads (``get``, ``batch_get``, ``get_all_values``,
+``row_values`` for the header, ``col_values``), range writes (``update``,
+``update_cell``, ``batch_update``), ``append_rows``, ``delete_rows`` and ``resize``.
+A gspread ``Spreadsheet`` is the Google Sheets implementation; ``SQLiteSpreadsheet``
+serves the local ones. A custom backend is a ``"module:factory"`` path whose factory
+returns such a spreadsheet.
+"""
+import importlib
+
+import gspread
+
+from sheet_utils import column_letter
+from sqlite_mirror import SheetStore, SQLiteSpreadsheet
+
+BACKENDS = ('sheets', 'sqlite', 'memory')
+
+SPREADSHEET_METHODS = ('worksheet', 'worksheets', 'add_worksheet')
+WORKSHEET_METHODS = (
+    'get', 'batch_get', 'get_all_values', 'row_values', 'col_values',
+    'update', 'update_cell', 'batch_update', 'append_rows', 'delete_rows', 'resize',
+)
+
+
+def missing_methods(obj, methods):
+    return [name for name in methods if not callable(getattr(obj, name, None))]
+
+
+def open_local_backend(kind, path=None):
+    """Spreadsheet for a non-Google backend: ``"sqlite"``, ``"memory"`` or ``"module:factory"``."""
+    if kind == 'sqlite':
+        return SQLiteSpreadsheet(SheetStore(path or 'qtmc_local.db'))
+    if kind == 'memory':
+        return SQLiteSpreadsheet(SheetStore(':memory:'))
+    if ':' not in kind:
+        raise ValueError(f"Unknown storage backend {kind!r}; expected one of {BACKENDS} or 'module:factory'")
+    module_name, _, factory_name = kind.partition(':')
+    factory = getattr(importlib.import_module(module_name), factory_name)
+    sh = factory(path) if path else factory()
+    missing = missing_methods(sh, SPREADSHEET_METHODS)
+    if missing:
+        raise TypeError(f"Storage backend {kind!r} lacks {', '.join(missing)}")
+    return sh
+
+
+def ensure_schema(sh, schema):
+    """Write the header row of every sheet in ``schema`` ({title: headers}) that has none yet."""
+    created = []
+    for title, headers in schema.items():
+        ws = sh.worksheet(title)
+        if any(str(h).strip() for h in ws.row_values(1)):
+            continue
+        ws.update(f"A1:{column_letter(len(headers))}1", [list(headers)])
+        created.append(title)
+    return created
+
+
+def copy_sheets(source, target, titles):
+    """Copy the full content of ``titles`` from one backend to another (empty sheets are skipped)."""
+    copied = []
+    for title in titles:
+        try:
+            values = source.worksheet(title).get_all_values(value_render_option="UNFORMATTED_VALUE")
+        except gspread.exceptions.WorksheetNotFound:
+            continue
+        if not values:
+            continue
+        width = max(len(row) for row in values)
+        ws = target.worksheet(title)
+        ws.update(f"A1:{column_letter(width)}{len(values)}", values)
+        copied.append(title)
+    return copied
+
@@ -1,6 +1,30 @@
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from datetime import date, datetime, timezone
+from unittest import mock
 
-from sheet_utils import ensure_worksheet_capacity
+import gspread
+import pandas as pd
+import requests
+
+import data_manager as dm
+from api_metrics import ApiMetrics, caller_scopes, payload_cells
+from debt_index import DebtIndex
+from fake_sheets import FakeSpreadsheet, QuotaTracker
+from analytics_store import list_partitions, prune_partitions, read_sales, write_sales_snapshot
+from rate_limiter import PRIORITY_POS, PRIORITY_REPORT, RateLimiter, call_with_backoff, classify_sheets_error
+from search_index import ProductSearchIndex, fold_text
+from sales_returns import allocate_return, net_sales_returns
+from sales_rollup import ROLLUP_COLUMNS, apply_delta, diff_rollups, rollup_from_sales, rollup_to_row, rows_to_rollup
+from sqlite_mirror import MirroredWorksheet, SheetStore, SQLiteSpreadsheet, SQLiteWorksheet
+from storage_backends import WORKSHEET_METHODS, copy_sheets, ensure_schema, missing_methods, open_local_backend
+from write_journal import CheckoutJournal, WriteOutbox
+from sheet_utils import appended_first_row, build_row_index, column_letter, ensure_worksheet_capacity, find_next_free_row, read_sheet_tail
 
 
 class FakeWorksheet:
@@ -15,6 +39,44 @@ class FakeWorksheet:
         self.col_count = cols
 
 
+class FakeGridWorksheet:
+    def __init__(self, values):
+        self.values = values
+        self.calls = []
+
+    def get(self, a1_range):
+        self.calls.append(('get', a1_range))
+        m = re.match(r'([A-Z]+)(\d+):([A-Z]+)(\d+)$', a1_range)
+        start, end = int(m.group(2)), int(m.group(4))
+        rows = [row[:1] for row in self.values[start - 1:end]]
+        while rows and not any(str(v).strip() for v in rows[-1]):
+            rows.pop()
+        return rows
+
+    def col_values(self, col):
+        self.calls.append(('col_values', col))
+        column = [row[col - 1] if len(row) >= col else '' for row in self.values]
+        while column and column[-1] == '':
+            column.pop()
+        return column
+
+    def batch_get(self, ranges, value_render_option=None):
+        self.calls.append(('batch_get', tuple(ranges)))
+        results = []
+        for a1_range in ranges:
+            m = re.match(r'[A-Z]+(\d+):([A-Z]+)(\d*)$', a1_range)
+            start = int(m.group(1))
+            end = int(m.group(3)) if m.group(3) else len(self.values)
+            width = 0
+            for letter in m.group(2):
+                width = width * 26 + ord(letter) - 64
+            rows = [row[:width] for row in self.values[start - 1:end]]
+            while rows and not any(str(v).strip() for v in rows[-1]):
+                rows.pop()
+            results.append(rows)
+        return results
+
+
 class EnsureWorksheetCapacityTests(unittest.TestCase):
     def test_does_not_resize_when_range_fits(self):
         worksheet = FakeWorksheet(rows=12233, cols=30)
@@ -38,5 +100,1022 @@ class EnsureWorksheetCapacityTests(unittest.TestCase):
         self.assertEqual([(100, 12)], worksheet.resize_calls)
 
 
+class FindNextFreeRowTests(unittest.TestCase):
+    def setUp(self):
+        self.worksheet = FakeGridWorksheet([
+            ['NgayBan', 'MaHoaDon'],
+            ['2026-01-01 08:00:00', '1'],
+            ['2026-01-01 09:00:00', '2'],
+        ])
+
+    def test_trusts_cached_row_when_probe_confirms_it(self):
+        self.assertEqual(4, find_next_free_row(self.worksheet, cached_row=4))
+        self.assertEqual([('get', 'A3:A4')], self.worksheet.calls)
+
+    def test_rescans_column_when_rows_were_added_elsewhere(self):
+        self.worksheet.values.append(['2026-01-01 10:00:00', '3'])
+
+        self.assertEqual(5, find_next_free_row(self.worksheet, cached_row=4))
+        self.assertEqual(('col_values', 1), self.worksheet.calls[-1])
+
+    def test_rescans_column_when_cursor_is_past_the_data(self):
+        self.assertEqual(4, find_next_free_row(self.worksheet, cached_row=6))
+
+    def test_without_cursor_reads_only_probe_column(self):
+        self.assertEqual(4, find_next_free_row(self.worksheet))
+        self.assertEqual([('col_values', 1)], self.worksheet.calls)
+
+
+class BuildRowIndexTests(unittest.TestCase):
+    def test_maps_keys_to_sheet_rows_keeping_first_duplicate(self):
+        index = build_row_index(['SP1', ' SP2 ', '', 1001, 'SP1'], first_row=2)
+
+        self.assertEqual({'SP1': 2, 'SP2': 3, '1001': 5}, index)
+
+
+class ReadSheetTailTests(unittest.TestCase):
+    def setUp(self):
+        self.header = ['NgayBan', 'MaHoaDon', 'SoLuong']
+        self.worksheet = FakeGridWorksheet([
+            list(self.header),
+            ['2026-01-01 08:00:00', 1, 2],
+            ['2026-01-01 09:00:00', 2, 1],
+        ])
+
+    def test_returns_only_rows_after_the_anchor(self):
+        self.worksheet.values.append(['2026-01-01 10:00:00', 3])
+
+        rows = read_sheet_tail(self.worksheet, 3, ['2026-01-01 09:00:00', 2, 1], self.header)
+
+        self.assertEqual([['2026-01-01 10:00:00', 3, '']], rows)
+        self.assertEqual(1, len(self.worksheet.calls))
+
+    def test_returns_empty_list_when_nothing_was_appended(self):
+        self.assertEqual([], read_sheet_tail(self.worksheet, 3, ['2026-01-01 09:00:00', '2', '1'], self.header))
+
+    def test_requests_full_reload_after_a_row_delete(self):
+        del self.worksheet.values[1]
+
+        self.assertIsNone(read_sheet_tail(self.worksheet, 3, ['2026-01-01 09:00:00', 2, 1], self.header))
+
+    def test_requests_full_reload_when_header_changed(self):
+        self.worksheet.values[0] = ['NgayBan', 'MaHoaDon', 'SL']
+
+        self.assertIsNone(read_sheet_tail(self.worksheet, 3, ['2026-01-01 09:00:00', 2, 1], self.header))
+
+
+class SQLiteWorksheetTests(unittest.TestCase):
+    def setUp(self):
+        self.store = SheetStore(':memory:')
+        self.store.replace('LichSuBan', [
+            ['NgayBan', 'MaHoaDon', 'MaSanPham'],
+            ['2026-01-01', 1, 'SP1'],
+            ['2026-01-02', 2, 'SP2'],
+        ])
+        self.worksheet = SQLiteWorksheet(self.store, 'LichSuBan')
+
+    def test_reads_ranges_like_the_sheets_api(self):
+        self.assertEqual([['2026-01-02', 2]], self.worksheet.get('A3:B'))
+        self.assertEqual(['NgayBan', '2026-01-01', '2026-01-02'], self.worksheet.col_values(1))
+
+    def test_new_header_cell_widens_the_grid(self):
+        self.worksheet.update_cell(1, 4, 'HinhThucTT')
+
+        self.assertEqual(['2026-01-01', 1, 'SP1', ''], self.worksheet.get_all_values()[1])
+
+    def test_delete_rows_shifts_later_rows_up(self):
+        self.worksheet.append_rows([['2026-01-03', 3, 'SP3']])
+        self.worksheet.delete_rows(2)
+
+        self.assertEqual([[2], [3]], self.worksheet.get('B2:B3'))
+
+    def test_indexes_key_columns(self):
+        names = {r[0] for r in self.store._conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+
+        self.assertIn('sheet_LichSuBan_c2', names)
+        self.assertIn('sheet_LichSuBan_c3', names)
+
+
+class FakeRemoteWorksheet:
+    def __init__(self, title, values):
+        self.title = title
+        self.values = values
+        self.fail_writes = False
+        self.reads = 0
+
+    def get_all_values(self, value_render_option=None):
+        self.reads += 1
+        return [list(r) for r in self.values]
+
+    def update_cell(self, row, col, value):
+        if self.fail_writes:
+            raise OSError('network down')
+        self.values[row - 1][col - 1] = value
+
+
+class MirroredWorksheetTests(unittest.TestCase):
+    def setUp(self):
+        self.remote = FakeRemoteWorksheet('TonKho', [['MaSanPham', 'SoLuong'], ['SP1', 5]])
+        self.worksheet = MirroredWorksheet(SheetStore(':memory:'), self.remote)
+
+    def test_serves_reads_locally_after_first_sync(self):
+        self.worksheet.get_all_values()
+        self.worksheet.row_values(2)
+
+        self.assertEqual(1, self.remote.reads)
+
+    def test_writes_go_to_both_copies(self):
+        self.worksheet.update_cell(2, 2, 4)
+
+        self.assertEqual(4, self.remote.values[1][1])
+        self.assertEqual(['SP1', 4], self.worksheet.row_values(2))
+
+    def test_failed_remote_write_resyncs_from_the_sheet(self):
+        self.remote.fail_writes = True
+        with self.assertRaises(OSError):
+            self.worksheet.update_cell(2, 2, 4)
+
+        self.assertEqual(['SP1', 5], self.worksheet.row_values(2))
+        self.assertEqual(2, self.remote.reads)
+
+
+class PrunePartitionsTests(unittest.TestCase):
+    def test_keeps_only_months_overlapping_the_range(self):
+        partitions = [(0, 0), (2025, 12), (2026, 1), (2026, 2), (2026, 3)]
+
+        self.assertEqual([(2026, 1), (2026, 2)], prune_partitions(partitions, date(2026, 1, 15), date(2026, 2, 3)))
+
+    def test_all_time_query_includes_undated_rows(self):
+        self.assertEqual([(0, 0), (2026, 1)], prune_partitions([(0, 0), (2026, 1)]))
+
+
+class SalesSnapshotTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.df = pd.DataFrame({
+            'NgayBan': pd.to_datetime(['2026-01-05 08:00', '2026-02-01 09:00', '2026-02-20 10:00']),
+            'MaSanPham': ['SP1', 'SP2', 1001],
+            'SoLuong': [1, 2, 3],
+            'ThanhTien': [10, 20, 30],
+        })
+
+    def test_writes_one_partition_per_month_and_reads_a_single_month(self):
+        write_sales_snapshot(self.df, self.root)
+
+        self.assertEqual([(2026, 1), (2026, 2)], list_partitions(self.root))
+        feb = read_sales(self.root, date(2026, 2, 1), date(2026, 2, 28), columns=['ThanhTien'])
+        self.assertEqual([20, 30], feb['ThanhTien'].tolist())
+
+    def test_rewrites_only_changed_months(self):
+        write_sales_snapshot(self.df, self.root)
+        jan_file = os.path.join(self.root, 'year=2026', 'month=01', 'part.parquet')
+        os.utime(jan_file, (0, 0))
+        df_more = pd.concat([self.df, pd.DataFrame({
+            'NgayBan': pd.to_datetime(['2026-02-21 08:00']), 'MaSanPham': ['SP1'], 'SoLuong': [1], 'ThanhTien': [5],
+        })], ignore_index=True)
+
+        written = write_sales_snapshot(df_more, self.root)
+
+        self.assertEqual([(2026, 2)], written)
+        self.assertEqual(0, os.path.getmtime(jan_file))
+
+    def test_rewrites_a_month_when_a_column_that_is_not_summed_changes(self):
+        self.df['HinhThucTT'] = ['Tiền mặt', 'Tiền mặt', 'Chuyển khoản']
+        write_sales_snapshot(self.df, self.root)
+        df_edited = self.df.copy()
+        df_edited.loc[2, 'HinhThucTT'] = 'Tiền mặt'
+
+        self.assertEqual([(2026, 2)], write_sales_snapshot(df_edited, self.root))
+        self.assertEqual([], write_sales_snapshot(df_edited, self.root))
+        feb = read_sales(self.root, date(2026, 2, 1), date(2026, 2, 28), columns=['HinhThucTT'])
+        self.assertEqual(['Tiền mặt', 'Tiền mặt'], feb['HinhThucTT'].tolist())
+
+
+class SalesRollupTests(unittest.TestCase):
+    def test_rollup_from_sales_groups_by_day_and_payment_method(self):
+        df = pd.DataFrame({
+            'NgayBan': pd.to_datetime(['2026-03-01 08:00', '2026-03-01 09:00', '2026-03-01 10:00', None]),
+            'MaHoaDon': ['HD1', 'HD1', 'HD2', 'HD3'],
+            'SoLuong': [1, 2, 1, 5],
+            'ThanhTien': [10, 20, 5, 50],
+            'LoiNhuan': [2, 4, 1, 10],
+            'HinhThucTT': ['Tiền mặt', 'Tiền mặt', 'Chuyển khoản', 'Tiền mặt'],
+        })
+
+        rollup = rollup_from_sales(df)
+
+        self.assertEqual(
+            {'DoanhThu': 30, 'LoiNhuan': 6, 'SoDon': 1, 'SoLuongSP': 3},
+            rollup[('2026-03-01', 'Tiền mặt')],
+        )
+        self.assertEqual(1, rollup[('2026-03-01', 'Chuyển khoản')]['SoDon'])
+        self.assertEqual(2, len(rollup))
+
+    def test_sheet_round_trip_and_diff_after_delta(self):
+        rollup = {('2026-03-01', 'Tiền mặt'): {'DoanhThu': 30, 'LoiNhuan': 6, 'SoDon': 1, 'SoLuongSP': 3}}
+        values = [ROLLUP_COLUMNS] + [rollup_to_row(k, v) for k, v in rollup.items()]
+
+        loaded, positions = rows_to_rollup(values)
+        self.assertEqual(rollup, loaded)
+        self.assertEqual({('2026-03-01', 'Tiền mặt'): 2}, positions)
+
+        apply_delta(loaded, '2026-03-01', 'Tiền mặt', -10, -2, 0, -1)
+        apply_delta(loaded, '2026-03-02', 'Chuyển khoản', 5, 1, 1, 1)
+        changed = diff_rollups(rollup, loaded)
+
+        self.assertEqual({('2026-03-01', 'Tiền mặt'), ('2026-03-02', 'Chuyển khoản')}, set(changed))
+        self.assertEqual(20, changed[('2026-03-01', 'Tiền mặt')]['DoanhThu'])
+
+
+class SalesReturnsTests(unittest.TestCase):
+    def test_allocates_across_lines_in_order(self):
+        self.assertEqual([(0, 2), (1, 1)], allocate_return([2, 3], 3))
+        self.assertEqual([(1, 3)], allocate_return([0, 3], 5))
+
+    def test_nets_return_rows_into_sale_lines(self):
+        df = pd.DataFrame({
+            'NgayBan': pd.to_datetime(['2024-01-31 10:00', '2024-01-31 10:00', '2024-02-01 09:00', '2024-02-01 09:05', '2024-02-02 08:00']),
+            'MaHoaDon': ['1', '1', '1', '1', '9'],
+            'MaSanPham': ['SP1', 'SP2', 'SP1', 'SP2', 'SP3'],
+            'SoLuong': [3, 1, -1, -1, -2],
+            'ThanhTien': [4500, 2500, -1500, -2500, -100],
+            'LoiNhuan': [1500, 500, -500, -500, -10],
+        })
+
+        netted, months = net_sales_returns(df)
+
+        self.assertEqual([['SP1', 2, 3000, 1000], ['SP3', -2, -100, -10]],
+                         netted[['MaSanPham', 'SoLuong', 'ThanhTien', 'LoiNhuan']].values.tolist())
+        self.assertEqual({(2024, 1)}, months)
+
+
+class ProductSearchIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.ids = ['SP000001', 'SP000002', 'SP000010', 'TH01']
+        self.names = ['Thuốc ho Bảo Thanh', 'Paracetamol 500mg', 'Siro ho trẻ em', 'Đường glucose']
+        self.index = ProductSearchIndex(self.ids, self.names)
+
+    def test_fold_text_strips_vietnamese_diacritics(self):
+        self.assertEqual('thuoc ho duong', fold_text('Thuốc Hộ Đường'))
+
+    def test_matches_without_diacritics_and_ranks_word_starts_first(self):
+        self.assertEqual([0], self.index.search('thuoc'))
+        self.assertEqual([3], self.index.search('duong'))
+        self.assertEqual([1], self.index.search('cetamol'))
+        self.assertEqual([2, 0], self.index.search('ho'))
+
+    def test_exact_code_ranks_before_code_prefix_and_limit_applies(self):
+        self.assertEqual([0], self.index.search('sp000001'))
+        self.assertEqual([0, 1], self.index.search('sp00000'))
+        self.assertEqual(2, len(self.index.search('sp', limit=2)))
+        self.assertEqual([], self.index.search('xyz'))
+
+    def test_short_query_matches_inside_codes_and_names(self):
+        index = ProductSearchIndex(
+            ['SP0012', 'SP0120', 'SP0200', 'SP0300', 'SP0400'],
+            ['Siro ho B12', 'Panadol', 'Efferalgan', 'Vitamin C', 'Berberin'],
+        )
+        self.assertEqual([1, 0], index.search('12'))
+        self.assertEqual([4, 2], index.search('er'))
+        self.assertEqual([2], index.search('al'))
+
+
+class CheckoutJournalTests(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'journal.jsonl')
+
+    def test_replays_pending_orders_and_open_batches_after_restart(self):
+        journal = CheckoutJournal(self.path)
+        journal.add_checkout('1', {'lines': []})
+        journal.add_checkout('2', {'lines': []})
+        batch = journal.start_batch(['1'])
+        journal.mark_step(batch, 'sales')
+        journal.record_intent(batch, {3: [10, 8]})
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write('{"op": "checkout", "id": "3"')
+
+        reopened = CheckoutJournal(self.path)
+
+        self.assertEqual(2, reopened.pending_count())
+        [(open_batch, entries, steps, intent)] = reopened.open_batches()
+        self.assertEqual((batch, ['1'], {'sales'}, {'3': [10, 8]}), (open_batch, [e['id'] for e in entries], steps, intent))
+        self.assertEqual(['2'], [e['id'] for e in reopened.unbatched()])
+        self.assertGreater(reopened.start_batch(['2']), batch)
+
+    def test_finishing_the_last_batch_empties_the_file(self):
+        journal = CheckoutJournal(self.path)
+        journal.add_checkout('1', {'lines': []})
+        journal.finish_batch(journal.start_batch(['1']))
+
+        self.assertEqual(0, journal.pending_count())
+        self.assertEqual(0, os.path.getsize(self.path))
+        self.assertEqual(0, CheckoutJournal(self.path).pending_count())
+
+
+class WriteOutboxTests(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'outbox.jsonl')
+
+    def test_keeps_writes_in_order_and_flags_interrupted_replays_after_restart(self):
+        outbox = WriteOutbox(self.path)
+        first = outbox.add('checkout', {'cart_items': []}, '2026-01-01T08:00:00+07:00', {'SP1': 10.0})
+        second = outbox.add('settle_debt', {'debt_id': 'CN1'}, '2026-01-01T08:05:00+07:00', {})
+        outbox.mark_started(first)
+
+        reopened = WriteOutbox(self.path)
+
+        self.assertEqual([(first, True), (second, False)], [(w['id'], w['started']) for w in reopened.pending()])
+        self.assertEqual({'SP1': 10.0}, reopened.pending()[0]['expected'])
+        self.assertGreater(reopened.add('import', {}, '2026-01-01T09:00:00+07:00', {}), second)
+
+    def test_conflicts_survive_until_dismissed(self):
+        outbox = WriteOutbox(self.path)
+        applied = outbox.add('checkout', {}, '2026-01-01T08:00:00+07:00', {'SP1': 10.0})
+        rejected = outbox.add('debt_checkout', {}, '2026-01-01T08:01:00+07:00', {'SP1': 10.0})
+        outbox.add_conflict(applied, 'stock moved', [{'MaSanPham': 'SP1', 'expected': 10.0, 'live': 9.0}], applied=True)
+        outbox.mark_done(applied)
+        outbox.add_conflict(rejected, 'rejected', applied=False)
+
+        reopened = WriteOutbox(self.path)
+        self.assertEqual(0, reopened.pending_count())
+        self.assertEqual(['checkout', 'debt_checkout'], [c['kind'] for c in reopened.conflicts()])
+
+        reopened.dismiss_conflicts()
+        self.assertEqual(0, os.path.getsize(self.path))
+        self.assertEqual([], WriteOutbox(self.path).conflicts())
+
+
+class SQLiteSpreadsheetTests(unittest.TestCase):
+    def test_missing_sheets_read_empty_and_writes_create_them(self):
+        sh = SQLiteSpreadsheet(SheetStore(':memory:'))
+        ws = sh.worksheet('TongHopNgay')
+        self.assertEqual([], ws.get_all_values())
+
+        ws.update('A1:B1', [['Ngay', 'HinhThucTT']])
+
+        self.assertEqual(['TongHopNgay'], [w.title for w in sh.worksheets()])
+
+
+class RateLimiterTests(unittest.TestCase):
+    def test_waiting_pos_calls_go_before_earlier_report_calls(self):
+        limiter = RateLimiter(1200, burst=1)
+        limiter.acquire()
+        order = []
+
+        def worker(priority, name):
+            limiter.acquire(priority)
+            order.append(name)
+
+        report = threading.Thread(target=worker, args=(PRIORITY_REPORT, 'report'))
+        report.start()
+        while limiter.queue_depth() < 1:
+            time.sleep(0.001)
+        pos = threading.Thread(target=worker, args=(PRIORITY_POS, 'pos'))
+        pos.start()
+        report.join(2)
+        pos.join(2)
+
+        self.assertEqual(['pos', 'report'], order)
+        self.assertEqual(0, limiter.queue_depth())
+
+    def test_retries_transient_errors_then_gives_up(self):
+        limiter = RateLimiter(6000, burst=10)
+        calls, sleeps = [], []
+
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise RuntimeError('503')
+            return 'ok'
+
+        result = call_with_backoff(limiter, flaky, classify=lambda e: ('retry', None), sleep=sleeps.append)
+        self.assertEqual(('ok', 3, 2), (result, len(calls), len(sleeps)))
+
+        def broken():
+            calls.append(1)
+            raise RuntimeError('400')
+
+        with self.assertRaises(RuntimeError):
+            call_with_backoff(limiter, broken, classify=lambda e: None)
+        self.assertEqual(4, len(calls))
+
+    def test_open_recovers_after_a_dropped_connection_but_appends_are_not_retried(self):
+        limiter = RateLimiter(6000, burst=10)
+        calls, sleeps = [], []
+
+        def open_spreadsheet():
+            calls.append(1)
+            if len(calls) == 1:
+                raise requests.exceptions.ConnectionError('connection reset')
+            return 'spreadsheet'
+
+        result = call_with_backoff(
+            limiter, open_spreadsheet, classify=lambda e: classify_sheets_error('open', e), sleep=sleeps.append
+        )
+        self.assertEqual(('spreadsheet', 2, 1), (result, len(calls), len(sleeps)))
+        self.assertEqual(('retry', None), classify_sheets_error('get', requests.exceptions.ReadTimeout()))
+        self.assertIsNone(classify_sheets_error(
+            'append_rows', requests.exceptions.ConnectionError(), non_idempotent={'append_rows'}
+        ))
+
+
+class ApiMetricsTests(unittest.TestCase):
+    def test_aggregates_calls_per_caller_and_method(self):
+        metrics = ApiMetrics()
+        for ms in (10, 20, 30, 400):
+            metrics.record('render_sales', 'process_checkout', 'batch_get', ms / 1000, cells=2)
+        metrics.record('render_sales', 'process_checkout', 'update', 0.05, wait_seconds=0.04, cells=11, error=True)
+
+        [reads, writes] = metrics.snapshot()
+        self.assertEqual(('batch_get', 4, 8, 25, 400.0), (reads['method'], reads['calls'], reads['cells'], reads['p50_ms'], reads['p95_ms']))
+        self.assertEqual((1, 1, 40.0), (writes['calls'], writes['errors'], writes['wait_ms']))
+
+        metrics.reset()
+        self.assertEqual([], metrics.snapshot())
+
+    def test_payload_cells_counts_values_only(self):
+        self.assertEqual(5, payload_cells([[1, 2, 3], [4, 5]]))
+        self.assertEqual(3, payload_cells([{'range': 'D5:F5', 'values': [[1, 2, 3]]}]))
+
+    def test_caller_scopes_finds_outermost_functions(self):
+        def process_checkout():
+            def wrapper():
+                return caller_scopes(sys._getframe(), __file__, ui_file='missing.py')
+            return wrapper()
+
+        self.assertEqual(('-', 'test_caller_scopes_finds_outermost_functions'), process_checkout())
+
+    def test_caller_scopes_attributes_calls_to_render_function_and_data_function(self):
+        data_file = os.path.join('app', 'data_manager.py')
+        dm = {'sys': sys, 'caller_scopes': caller_scopes, 'DATA_FILE': data_file}
+        exec(compile(
+            "def _sheets_call():\n"
+            "    return caller_scopes(sys._getframe(1), DATA_FILE)\n"
+            "def _debt_index():\n"
+            "    return _sheets_call()\n"
+            "def _cached(func):\n"
+            "    def wrapper():\n"
+            "        return func()\n"
+            "    return wrapper\n"
+            "@_cached\n"
+            "def load_debt_records():\n"
+            "    return _debt_index()\n",
+            data_file, 'exec'), dm)
+        ui = {'load_debt_records': dm['load_debt_records']}
+        exec(compile(
+            "def render_debt_payment():\n"
+            "    return load_debt_records()\n"
+            "def render_debt():\n"
+            "    return render_debt_payment()\n"
+            "def main():\n"
+            "    return render_debt(), load_debt_records()\n",
+            os.path.join('app', 'main.py'), 'exec'), ui)
+
+        self.assertEqual(
+            (('render_debt', 'load_debt_records'), ('main', 'load_debt_records')),
+            ui['main'](),
+        )
+
+
+class FakeSpreadsheetTests(unittest.TestCase):
+    def test_counts_requests_and_cells_like_the_api(self):
+        sh = FakeSpreadsheet()
+        sh.add_sheet('TonKho', [['MaSanPham', 'SoLuong'], ['SP1', 5], ['SP2', 7]])
+        ws = sh.worksheet('TonKho')
+
+        self.assertEqual([['SP2', 7]], ws.get('A3:B3'))
+        ws.update('B2', [[4]])
+        ws.append_rows([['SP3', 1]])
+        self.assertEqual([['MaSanPham', 'SoLuong'], ['SP1', 4], ['SP2', 7], ['SP3', 1]], ws.get_all_values())
+
+        summary = sh.quota.summary()
+        self.assertEqual((3, 2, 13), (summary['reads'], summary['writes'], summary['cells']))
+
+    def test_enforced_quota_raises_429(self):
+        now = [0.0]
+        quota = QuotaTracker(read_per_minute=2, enforce=True, clock=lambda: now[0])
+        quota.record('get')
+        quota.record('get')
+        with self.assertRaises(gspread.exceptions.APIError):
+            quota.record('get')
+        now[0] = 61
+        quota.record('get')
+        self.assertEqual((3, 1), (quota.summary()['reads'], quota.summary()['quota_exceeded']))
+
+
+class StorageBackendTests(unittest.TestCase):
+    def test_memory_backend_gets_schema_and_copied_data(self):
+        source = FakeSpreadsheet()
+        source.add_sheet('TonKho', [['MaSanPham', 'SoLuong'], ['SP1', 5]])
+        sh = open_local_backend('memory')
+
+        self.assertEqual(['TonKho'], copy_sheets(source, sh, ['TonKho', 'CongNo']))
+        self.assertEqual(['CongNo'], ensure_schema(sh, {'TonKho': ['MaSanPham'], 'CongNo': ['TenKH', 'Ngay']}))
+        self.assertEqual([['MaSanPham', 'SoLuong'], ['SP1', 5]], sh.worksheet('TonKho').get_all_values())
+        self.assertEqual(['TenKH', 'Ngay'], sh.worksheet('CongNo').row_values(1))
+        self.assertEqual([], missing_methods(sh.worksheet('TonKho'), WORKSHEET_METHODS))
+
+    def test_rejects_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            open_local_backend('excel')
+        with self.assertRaises(TypeError):
+            open_local_backend('collections:OrderedDict')
+
+
+class DebtIndexTests(unittest.TestCase):
+    header = ['TenKH', 'Ngay', 'TenSanPham', 'SoLuong', 'ThanhTien', 'MaPhieuNo', 'TrangThai', 'TienDaTra', 'TienConLai']
+
+    def test_keeps_only_open_slips_and_legacy_keys(self):
+        index = DebtIndex.from_values([
+            self.header,
+            ['An', '2026-01-01 08:00:00', 'A', 1, 3000, 'CN1', 'DaTra', 3000, 0],
+            ['Binh', '2026-01-02 08:00:00', 'A', 1, 2000, 'CN2', 'DaTra1Phan', 500, 1500],
+            ['Binh', '2026-01-02 08:00:00', 'B', 1, 1000, 'CN2', 'DaTra', 1000, 0],
+            ['Cu', '2025-12-01 08:00:00', 'A', 1, 4000],
+            ['Cu2', '2025-12-02 08:00:00', 'A', 1, 4000, '', 'DaTra'],
+        ])
+
+        self.assertEqual(['CN2', 'LEGACY|Cu|2025-12-01 08:00:00'], sorted(index.slips))
+        self.assertEqual([3, 4], [row for row, _ in index.slip_rows('CN2')])
+        self.assertEqual([5], [row for row, _ in index.find_legacy('Cu', '2025-12-01 08:00:00')])
+        self.assertEqual(6, index.row_count)
+
+    def test_new_rows_and_payments_update_the_index(self):
+        index = DebtIndex.from_values([self.header, ['An', 'd', 'A', 1, 3000, 'CN1', 'ChuaTra', 0, 3000]])
+        index.add_rows([['Binh', 'd', 'A', 1, 500, 'CN2', 'ChuaTra', 0, 500]], 3)
+        self.assertEqual((2, ['CN1', 'CN2']), (index.open_count(), sorted(index.slips)))
+
+        index.update_row(3, 'CN2', {'TienDaTra': 500, 'TienConLai': 0, 'TrangThai': 'DaTra'})
+        self.assertEqual(['CN1'], list(index.slips))
+        self.assertEqual((3, 'DaTra'), (index.row_count, index.anchor[6]))
+        self.assertEqual(5, appended_first_row({'updates': {'updatedRange': "'CongNo'!A5:I6"}}))
+        self.assertIsNone(appended_first_row(None))
+
+    def test_customer_totals_follow_slips(self):
+        index = DebtIndex.from_values([
+            self.header,
+            ['An', '2026-01-05 08:00:00', 'A', 1, 3000, 'CN1', 'ChuaTra', 0, 3000],
+            ['An', '2026-01-03 08:00:00', 'A', 1, 2000, 'CN2', 'DaTra1Phan', 500, 1500],
+            ['Binh', '2026-01-04 08:00:00', 'A', 1, 1000, 'CN3', 'ChuaTra', 0, 1000],
+        ])
+        summary = index.customer_summary('An')
+        self.assertEqual((5000, 500, 4500, 2), (summary['TongNo'], summary['DaTra'], summary['ConNo'], summary['SoPhieu']))
+        self.assertEqual(datetime(2026, 1, 3, 8), summary['NgayCuNhat'])
+
+        index.update_row(3, 'CN2', {'TienDaTra': 2000, 'TienConLai': 0, 'TrangThai': 'DaTra'})
+        index.add_rows([['Binh', '2026-01-06 08:00:00', 'A', 1, 700, 'CN4', 'ChuaTra', 0, 700]], 5)
+        self.assertEqual((3000, 1, datetime(2026, 1, 5, 8)), (
+            index.customer_summary('An')['ConNo'], index.customer_summary('An')['SoPhieu'],
+            index.customer_summary('An')['NgayCuNhat']))
+        self.assertEqual([('An', 3000), ('Binh', 1700)], [(c['TenKH'], c['ConNo']) for c in index.customer_summaries()])
+        index.update_row(2, 'CN1', {'TienDaTra': 3000, 'TienConLai': 0, 'TrangThai': 'DaTra'})
+        self.assertIsNone(index.customer_summary('An'))
+
+
+class ColumnLetterTests(unittest.TestCase):
+    def test_converts_single_and_double_letters(self):
+        self.assertEqual(['A', 'K', 'Z', 'AA', 'AZ'], [column_letter(c) for c in (1, 11, 26, 27, 52)])
+
+
+
+INVENTORY_HEADERS = ['MaSanPham', 'TenSanPham', 'DonVi', 'SoLuong', 'GiaNhap', 'GiaBan', 'NhaCungCap']
+
+
+class DataManagerTestCase(unittest.TestCase):
+    """data_manager on a FakeSpreadsheet, attached like the benchmark does; background workers are not started."""
+    secrets = {}
+    inventory = [['SP1', 'Thuốc ho', 'Chai', 62, 20000, 30000, 'NCC A'], ['SP2', 'Siro B12', 'Hộp', 10, 5000, 8000, 'NCC B']]
+
+    def setUp(self):
+        workdir = tempfile.mkdtemp()
+        secrets = {
+            'sheet_url': 'test://fake',
+            'checkout_mode': 'sync',
+            'analytics_dir': os.path.join(workdir, 'analytics'),
+            'checkout_journal_path': os.path.join(workdir, 'journal.jsonl'),
+            'offline_outbox_path': os.path.join(workdir, 'outbox.jsonl'),
+            'offline_snapshot_path': os.path.join(workdir, 'offline.db'),
+            'sheets_read_per_minute': 10 ** 9,
+            'sheets_write_per_minute': 10 ** 9,
+        }
+        secrets.update(self.secrets)
+        for patcher in (
+            mock.patch.object(dm.st, 'secrets', secrets),
+            mock.patch.object(dm, '_start_checkout_worker', lambda: None),
+            mock.patch.object(dm, '_start_offline_worker', lambda: None),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.sh = FakeSpreadsheet()
+        self.sh.add_sheet('TonKho', [INVENTORY_HEADERS] + [list(row) for row in self.inventory])
+        self.sh.add_sheet('LichSuBan', [dm.SALES_COLUMNS])
+        self.sh.add_sheet('LichSuNhap', [dm._IMPORT_COLUMNS])
+        self.sh.add_sheet('CongNo', [dm._DEBT_COLUMNS])
+        self.attach(self.sh)
+        dm._API_LIMITERS.clear()
+        dm._REPORT_MEMO.clear()
+        dm._SALES_CACHE.update(header=None, row_count=0, anchor=None, fingerprint=0, dirty_months=None, rollup_unverified=False)
+        dm._ROLLUP_STATE.update(data=None, positions={}, loaded_at=0.0)
+        dm._JOURNAL_STATE.update(journal=None, last_order_id=0)
+        dm._OFFLINE_STATE.update(since=None, error='', store=None, outbox=None, snapshot_at=0.0)
+        self.addCleanup(self.wait_for_background)
+
+    def attach(self, sh):
+        dm.reset_connection()
+        with dm._CONN_LOCK:
+            dm._CONN_STATE['sheet'] = sh
+            dm._CONN_STATE['sheet_url'] = dm.st.secrets.get('sheet_url')
+        dm._reset_sheet_state()
+
+    def wait_for_background(self):
+        deadline = time.monotonic() + 10
+        while any(state['revalidating'] for state in dm._SHEET_CACHE.values()) and time.monotonic() < deadline:
+            time.sleep(0.005)
+
+    def cart(self, pid, qty):
+        row = next(r for r in self.inventory if r[0] == pid)
+        return {'MaSanPham': pid, 'TenSanPham': row[1], 'DonVi': row[2], 'SoLuongBan': qty, 'GiaBan': row[5]}
+
+    def sheet_stock(self, pid):
+        return {row[0]: row[3] for row in self.sh.worksheet('TonKho').get_all_values()[1:]}[pid]
+
+    def shown_stock(self, pid):
+        df = dm.load_inventory()
+        return df.loc[df['MaSanPham'] == pid, 'SoLuong'].iloc[0]
+
+    def sales_rows(self):
+        return self.sh.worksheet('LichSuBan').get_all_values()[1:]
+
+
+class ProductOptionsTests(DataManagerTestCase):
+    def test_labels_follow_the_stock_and_duplicate_codes_keep_the_first_row(self):
+        self.sh.worksheet('TonKho').append_rows([['SP2', 'Siro trùng mã', 'Hộp', 99, 1, 2, '']])
+        dm._bump_sheet_versions('TonKho')
+        options = dm.get_product_options(dm.load_inventory())
+        self.assertEqual({'SP1': 0, 'SP2': 1}, options['positions'])
+        self.assertEqual('Siro B12 | Mã: SP2 | Tồn: 10 Hộp', options['labels']['SP2'])
+
+        dm.process_checkout([self.cart('SP1', 2)])
+        self.assertEqual('Thuốc ho | Mã: SP1 | Tồn: 60 Chai', dm.get_product_options(dm.load_inventory())['labels']['SP1'])
+
+    def test_same_inventory_revision_reuses_the_options(self):
+        df = dm.load_inventory()
+        options = dm.get_product_options(df)
+
+        self.assertIs(options, dm.get_product_options(dm.load_inventory()))
+        self.assertIs(options, dm.get_product_options(df.copy()))
+
+
+class SheetVersionTests(DataManagerTestCase):
+    def test_a_sale_does_not_reload_the_debt_list(self):
+        dm.process_debt_checkout('An', [self.cart('SP1', 1)])
+        dm.process_checkout([self.cart('SP2', 1)])
+        dm.load_inventory()
+        self.assertEqual(['An'], dm.load_debt_records()['TenKH'].tolist())
+
+        loaded_at = dm._SHEET_CACHE['CongNo']['loaded_at']
+
+        dm.process_checkout([self.cart('SP2', 1)])
+        self.assertEqual(['An'], dm.load_debt_records()['TenKH'].tolist())
+        self.assertEqual(8, self.shown_stock('SP2'))
+        self.assertEqual(loaded_at, dm._SHEET_CACHE['CongNo']['loaded_at'])
+
+    def test_cached_frame_reloads_after_the_ttl_for_edits_made_on_the_sheet(self):
+        dm.load_inventory()
+        self.sh.worksheet('TonKho').update('D2', [[40]])
+        self.assertEqual(62, self.shown_stock('SP1'))
+
+        dm._SHEET_CACHE['TonKho']['loaded_at'] -= 60
+        self.assertEqual(40, self.shown_stock('SP1'))
+
+    def test_callers_cannot_change_the_cached_frame(self):
+        df = dm.load_inventory()
+        df.loc[0, 'SoLuong'] = 0
+        self.assertEqual(62, self.shown_stock('SP1'))
+
+
+class CheckoutWriteTests(DataManagerTestCase):
+    def test_appends_after_the_cursor_without_downloading_the_sales_sheet(self):
+        self.assertTrue(dm.process_checkout([self.cart('SP1', 2), self.cart('SP2', 1)]))
+        self.sh.quota.reset()
+
+        self.assertTrue(dm.process_checkout([self.cart('SP1', 3)]))
+        self.assertNotIn('get_all_values', self.sh.quota.summary()['by_method'])
+        self.assertEqual([['SP1', 2], ['SP2', 1], ['SP1', 3]], [[r[2], r[5]] for r in self.sales_rows()])
+        self.assertEqual((57, 9), (self.sheet_stock('SP1'), self.sheet_stock('SP2')))
+
+    def test_rows_appended_by_another_process_are_not_overwritten(self):
+        dm.process_checkout([self.cart('SP1', 1)])
+        other = list(self.sales_rows()[0])
+        other[1] = 'OTHER'
+        self.sh.worksheet('LichSuBan').append_rows([other])
+
+        dm.process_checkout([self.cart('SP2', 2)])
+        self.assertEqual(['OTHER', 'SP2'], [self.sales_rows()[1][1], self.sales_rows()[2][2]])
+
+
+class InventoryCachePatchTests(DataManagerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.revalidations = []
+        patcher = mock.patch.object(dm, '_schedule_sheet_revalidation', self.revalidations.append)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_checkout_patches_the_cached_stock_without_reloading_tonkho(self):
+        dm.process_checkout([self.cart('SP2', 1)])
+        self.assertEqual(62, self.shown_stock('SP1'))
+        self.sh.quota.reset()
+
+        dm.process_checkout([self.cart('SP1', 2)])
+        self.assertEqual(60, self.shown_stock('SP1'))
+        self.assertNotIn('get_all_values', self.sh.quota.summary()['by_method'])
+        self.assertEqual(['TonKho'], self.revalidations[-1:])
+
+    def test_revalidation_replaces_the_patch_with_sheet_values(self):
+        dm.load_inventory()
+        dm.process_checkout([self.cart('SP1', 2)])
+        # Process khác trừ thêm kho sau khi patch: chỉ lần kiểm tra lại ở nền mới thấy.
+        self.sh.worksheet('TonKho').update('D2', [[55]])
+        self.assertEqual(60, self.shown_stock('SP1'))
+
+        dm._revalidate_sheet_cache('TonKho')
+        self.assertEqual(55, self.shown_stock('SP1'))
+
+    def test_revalidation_keeps_a_patch_made_while_it_was_loading(self):
+        dm.load_inventory()
+        state = dm._SHEET_CACHE['TonKho']
+        loader = state['loader']
+
+        def load_then_checkout():
+            value = loader()
+            if len(self.sales_rows()) < 2:
+                dm.process_checkout([self.cart('SP2', 3)])
+            return value
+
+        dm.process_checkout([self.cart('SP1', 2)])
+        state['loader'] = load_then_checkout
+        self.addCleanup(state.__setitem__, 'loader', loader)
+        dm._revalidate_sheet_cache('TonKho')
+        self.assertEqual((60, 7), (self.shown_stock('SP1'), self.shown_stock('SP2')))
+        self.assertEqual((60, 7), (self.sheet_stock('SP1'), self.sheet_stock('SP2')))
+
+
+class CheckoutJournalModeTests(DataManagerTestCase):
+    secrets = {'checkout_mode': 'journal'}
+
+    def test_queued_orders_stay_deducted_until_the_worker_writes_them(self):
+        self.assertEqual(62, self.shown_stock('SP1'))
+        self.assertTrue(dm.process_checkout([self.cart('SP1', 5)]))
+
+        self.assertEqual((1, 62, 57), (dm.checkout_queue_status(), self.sheet_stock('SP1'), self.shown_stock('SP1')))
+        # Tải lại TonKho từ sheet (kiểm tra lại ở nền, hết ttl) vẫn phải trừ đơn đang chờ.
+        dm._revalidate_sheet_cache('TonKho')
+        dm._bump_sheet_versions('TonKho')
+        self.assertEqual(57, self.shown_stock('SP1'))
+
+        dm._drain_checkout_journal(dm._get_checkout_journal())
+        self.wait_for_background()
+        self.assertEqual((0, 57, 57), (dm.checkout_queue_status(), self.sheet_stock('SP1'), self.shown_stock('SP1')))
+        self.assertEqual([['SP1', 5]], [[r[2], r[5]] for r in self.sales_rows()])
+
+    def test_replay_after_a_crash_between_steps_writes_each_order_once(self):
+        dm.process_checkout([self.cart('SP1', 5), self.cart('SP2', 1)])
+        journal = dm._get_checkout_journal()
+        with mock.patch.object(dm, '_product_rows', side_effect=ConnectionError('down')):
+            with self.assertRaises(ConnectionError):
+                dm._drain_checkout_journal(journal)
+        self.assertEqual((2, 62), (len(self.sales_rows()), self.sheet_stock('SP1')))
+
+        # Khởi động lại: nhật ký đọc lại từ file, lô dở dang chạy tiếp từ bước kho.
+        dm._JOURNAL_STATE['journal'] = None
+        self.attach(self.sh)
+        self.assertEqual(57, self.shown_stock('SP1'))
+        dm._drain_checkout_journal(dm._get_checkout_journal())
+
+        self.assertEqual((2, 57, 9), (len(self.sales_rows()), self.sheet_stock('SP1'), self.sheet_stock('SP2')))
+        self.assertEqual(0, dm.checkout_queue_status())
+
+    def test_replay_does_not_deduct_stock_twice_after_the_inventory_write(self):
+        dm.process_checkout([self.cart('SP1', 5)])
+        journal = dm._get_checkout_journal()
+        mark_step = journal.mark_step
+
+        def crash_before_marking_inventory(batch, step):
+            if step == 'inventory':
+                raise ConnectionError('crash')
+            mark_step(batch, step)
+
+        with mock.patch.object(journal, 'mark_step', crash_before_marking_inventory):
+            with self.assertRaises(ConnectionError):
+                dm._drain_checkout_journal(journal)
+        self.assertEqual(57, self.sheet_stock('SP1'))
+
+        dm._JOURNAL_STATE['journal'] = None
+        self.attach(self.sh)
+        dm._drain_checkout_journal(dm._get_checkout_journal())
+        self.assertEqual((1, 57, 0), (len(self.sales_rows()), self.sheet_stock('SP1'), dm.checkout_queue_status()))
+
+
+
+class ReturnTests(DataManagerTestCase):
+    def rollup_totals(self):
+        return tuple(dm.load_daily_rollup()[['DoanhThu', 'LoiNhuan', 'SoDon', 'SoLuongSP']].sum().tolist())
+
+    def checkout(self, *items):
+        # Mã đơn lấy theo giây: mỗi đơn trong test một giây riêng.
+        at = datetime(2026, 10, 18, 9, 0, len(self.sales_rows()), tzinfo=timezone.utc)
+        with mock.patch.object(dm, '_now', lambda tz: at.astimezone(tz)):
+            dm.process_checkout([self.cart(pid, qty) for pid, qty in items])
+        return self.sales_rows()[-1][1]
+
+    def test_partial_return_appends_a_negative_row_and_restores_stock(self):
+        order_id = self.checkout(('SP1', 4), ('SP2', 2))
+        self.checkout(('SP2', 1))
+        self.assertEqual((144000, 49000, 2, 7), self.rollup_totals())
+
+        self.assertTrue(dm.process_return(order_id, 'SP1', 1))
+        rows = self.sales_rows()
+        self.assertEqual([4, 2, 1, -1], [r[5] for r in rows])
+        self.assertEqual([order_id, 'SP1', -30000, -10000], [rows[3][1], rows[3][2], rows[3][7], rows[3][9]])
+        self.assertEqual(59, self.sheet_stock('SP1'))
+        self.assertEqual((114000, 39000, 2, 6), self.rollup_totals())
+
+        sold = dm.load_sales_history()
+        self.assertEqual([3, 2, 1], sold['SoLuong'].tolist())
+
+    def test_repeated_returns_stop_at_what_is_left_of_the_line(self):
+        order_id = self.checkout(('SP1', 4))
+
+        self.assertTrue(dm.process_return(order_id, 'SP1', 3))
+        self.assertTrue(dm.process_return(order_id, 'SP1', 5))
+        self.assertFalse(dm.process_return(order_id, 'SP1', 1))
+        self.assertEqual([4, -3, -1], [r[5] for r in self.sales_rows()])
+        self.assertEqual(62, self.sheet_stock('SP1'))
+        self.assertEqual((0, 0, 0, 0), self.rollup_totals())
+
+    def test_whole_order_return_writes_every_remaining_line_in_one_batch(self):
+        order_id = self.checkout(('SP1', 4), ('SP2', 2))
+        self.checkout(('SP2', 1))
+        dm.process_return(order_id, 'SP1', 1)
+        self.sh.quota.reset()
+
+        self.assertTrue(dm.process_return_lines(order_id))
+        by_method = self.sh.quota.summary()['by_method']
+        self.assertEqual((1, 1), (by_method.get('update'), by_method.get('batch_update')))
+        self.assertEqual([-1, -3, -2], [r[5] for r in self.sales_rows()[3:]])
+        self.assertEqual((62, 9), (self.sheet_stock('SP1'), self.sheet_stock('SP2')))
+        # Đơn trả hết thì bớt một đơn; đơn còn lại vẫn nguyên.
+        self.assertEqual((8000, 3000, 1, 1), self.rollup_totals())
+        self.assertFalse(dm.process_return_lines(order_id))
+
+    def test_multi_line_return_keeps_the_rest_of_each_line(self):
+        order_id = self.checkout(('SP1', 4), ('SP2', 2))
+
+        self.assertTrue(dm.process_return_lines(order_id, {'SP1': 2, 'SP2': 2}))
+        self.assertEqual([4, 2, -2, -2], [r[5] for r in self.sales_rows()])
+        self.assertEqual((60, 10), (self.sheet_stock('SP1'), self.sheet_stock('SP2')))
+        self.assertEqual((60000, 20000, 1, 2), self.rollup_totals())
+
+
+class SettleDebtTests(DataManagerTestCase):
+    def open_debt(self):
+        dm.process_debt_checkout('An', [self.cart('SP1', 2), self.cart('SP2', 1)])
+        debts = dm.load_debt_records()
+        self.assertEqual([68000], debts.groupby('MaPhieuNo')['TienConLai'].sum().tolist())
+        return debts['MaPhieuNo'].iloc[0]
+
+    def test_partial_then_full_payment_closes_the_slip(self):
+        debt_id = self.open_debt()
+        dm.process_debt_checkout('Binh', [self.cart('SP2', 2)])
+
+        self.assertTrue(dm.settle_debt(debt_id, 30000)['ok'])
+        debts = dm.load_debt_records()
+        self.assertEqual(38000, debts.loc[debts['MaPhieuNo'] == debt_id, 'TienConLai'].sum())
+        self.assertEqual(30000, debts.loc[debts['MaPhieuNo'] == debt_id, 'TienDaTra'].sum())
+
+        self.sh.quota.reset()
+        self.assertTrue(dm.settle_debt(debt_id, 38000)['ok'])
+        self.assertNotIn('get_all_values', self.sh.quota.summary()['by_method'])
+        self.assertEqual(['Binh'], dm.load_debt_records()['TenKH'].tolist())
+        self.assertFalse(dm.settle_debt(debt_id, 1000)['ok'])
+
+    def test_slip_rows_are_reread_when_the_sheet_shifted_under_the_index(self):
+        debt_id = self.open_debt()
+        ws = self.sh.worksheet('CongNo')
+        # Sửa tay trên sheet: chèn một phiếu lên trên làm các dòng đã đánh chỉ mục bị lệch.
+        rows = ws.get_all_values()
+        ws.load([rows[0], ['X'] * len(rows[0])] + rows[1:])
+
+        index, slip_rows = dm._open_slip_rows(ws, debt_id)
+        self.assertEqual([3, 4], [row for row, _ in slip_rows])
+        self.assertTrue(dm.settle_debt(debt_id, 68000)['ok'])
+        self.assertEqual(['X'] * len(rows[0]), ws.get_all_values()[1])
+
+
+class OfflineOutboxTests(DataManagerTestCase):
+    secrets = {'offline_mode': 'true'}
+
+    def go_offline(self):
+        dm._refresh_offline_snapshot(self.sh)
+        self.assertTrue(dm._mark_offline(ConnectionError('down')))
+        self.assertIsInstance(dm.get_connection(), dm.SQLiteSpreadsheet)
+
+    def replay(self):
+        dm._mark_online()
+        return dm._replay_offline_outbox(self.sh, dm._get_offline_outbox())
+
+    def test_offline_checkout_is_served_locally_and_replayed_once(self):
+        self.go_offline()
+        self.assertTrue(dm.process_checkout([self.cart('SP1', 5)]))
+        self.assertEqual((57, 62, 0), (self.shown_stock('SP1'), self.sheet_stock('SP1'), len(self.sales_rows())))
+        self.assertEqual(1, dm._get_offline_outbox().pending_count())
+        order_id = dm.get_connection().worksheet('LichSuBan').get_all_values()[1][1]
+
+        self.assertTrue(self.replay())
+        self.assertTrue(self.replay())
+        self.assertEqual([[order_id, 'SP1', 5]], [[r[1], r[2], r[5]] for r in self.sales_rows()])
+        self.assertEqual((57, 0, []), (self.sheet_stock('SP1'), dm._get_offline_outbox().pending_count(), dm._get_offline_outbox().conflicts()))
+
+    def test_replay_records_a_conflict_when_the_sheet_stock_moved(self):
+        self.go_offline()
+        dm.process_checkout([self.cart('SP1', 5), self.cart('SP2', 1)])
+        # Trong lúc offline, sheet bị sửa từ nơi khác.
+        self.sh.worksheet('TonKho').update('D2', [[60]])
+
+        self.assertTrue(self.replay())
+        conflicts = dm._get_offline_outbox().conflicts()
+        self.assertEqual([('checkout', True)], [(c['kind'], c['applied']) for c in conflicts])
+        self.assertEqual([{'MaSanPham': 'SP1', 'expected': 62.0, 'live': 60.0}], conflicts[0]['details'])
+        self.assertEqual((55, 9, 0), (self.sheet_stock('SP1'), self.sheet_stock('SP2'), dm._get_offline_outbox().pending_count()))
+
+    def test_interrupted_replay_is_flagged_instead_of_written_again(self):
+        self.go_offline()
+        dm.process_checkout([self.cart('SP1', 5)])
+        outbox = dm._get_offline_outbox()
+        outbox.mark_started(outbox.pending()[0]['id'])
+
+        self.assertTrue(self.replay())
+        self.assertEqual(([], 62), (self.sales_rows(), self.sheet_stock('SP1')))
+        self.assertEqual([None], [c['applied'] for c in outbox.conflicts()])
+
+
+class DailyRollupTests(DataManagerTestCase):
+    def full_reload(self):
+        dm._SALES_CACHE.update(loaded_at=0.0, stale=True)
+        return dm.load_sales_history()
+
+    def test_hand_edit_of_an_earlier_sale_is_reconciled_on_full_reload(self):
+        dm.process_checkout([self.cart('SP1', 1)])
+        dm.process_checkout([self.cart('SP2', 2)])
+        self.assertEqual(46000, dm.load_daily_rollup()['DoanhThu'].sum())
+
+        ws = self.sh.worksheet('LichSuBan')
+        ws.update('H2:J2', [[25000, 20000, 5000]])
+        self.full_reload()
+
+        rollup = dm.load_daily_rollup()
+        self.assertEqual((41000, 11000), (rollup['DoanhThu'].sum(), rollup['LoiNhuan'].sum()))
+        self.assertFalse(dm._SALES_CACHE['rollup_unverified'])
+
+    def test_unchanged_or_appended_sheet_is_not_reconciled(self):
+        dm.process_checkout([self.cart('SP1', 1)])
+        dm.load_daily_rollup()
+        dm.load_sales_history()
+        # Dòng do process khác ghi thêm ở cuối: không phải sửa tay.
+        self.sh.worksheet('LichSuBan').append_rows([self.sales_rows()[-1]])
+
+        with mock.patch.object(dm, '_reconcile_daily_rollup', wraps=dm._reconcile_daily_rollup) as reconcile:
+            self.full_reload()
+            self.full_reload()
+            dm.load_daily_rollup()
+        reconcile.assert_not_called()
+
+    def test_reconcile_refreshes_report_charts_memoized_on_the_rollup(self):
+        dm.process_checkout([self.cart('SP1', 1)])
+
+        def month_total():
+            return dm.report_memo('test_chart', ('2026-10',), (dm.ROLLUP_SHEET,), lambda: dm.load_daily_rollup()['DoanhThu'].sum())
+
+        self.assertEqual(30000, month_total())
+        self.sh.worksheet('LichSuBan').update('H2', [[25000]])
+        self.full_reload()
+        dm.load_daily_rollup()
+        self.assertEqual(25000, month_total())
+
+
+
+class SalesPeriodTests(DataManagerTestCase):
+    def test_report_reads_hand_edited_profit_after_full_reload(self):
+        dm.process_checkout([self.cart('SP1', 1)])
+        self.assertEqual([10000], dm.load_sales_period(columns=['LoiNhuan'])['LoiNhuan'].tolist())
+
+        self.sh.worksheet('LichSuBan').update('J2', [[8000]])
+        dm._SALES_CACHE.update(loaded_at=0.0, stale=True)
+
+        self.assertEqual([8000], dm.load_sales_period(columns=['LoiNhuan'])['LoiNhuan'].tolist())
+
+
 if __name__ == '__main__':
     unittest.main()
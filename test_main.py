@@ -0,0 +1,150 @@
+import os
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+import pytz
+from streamlit.testing.v1 import AppTest
+
+from test_data_manager import DataManagerTestCase, dm
+
+MAIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+
+
+class MainScreenTestCase(DataManagerTestCase):
+    """main.py run through AppTest on the same FakeSpreadsheet; AppTest reruns the whole page on every interaction."""
+
+    def app(self, menu, **state):
+        at = AppTest.from_file(MAIN_PATH, default_timeout=30)
+        at.session_state['is_logged_in'] = True
+        for key, value in state.items():
+            at.session_state[key] = value
+        at.run()
+        if menu != at.sidebar.radio[0].value:
+            at.sidebar.radio[0].set_value(menu).run()
+        self.assertEqual([], [e.value for e in at.exception])
+        return at
+
+    def table(self, at, column):
+        return next(df.value for df in at.dataframe if column in df.value.columns)
+
+    def today_at(self, seconds):
+        tz = pytz.timezone('Asia/Ho_Chi_Minh')
+        return tz.localize(datetime.combine(datetime.now(tz).date(), datetime.min.time()) + timedelta(hours=8, seconds=seconds))
+
+
+class DebtListTests(MainScreenTestCase):
+    def setUp(self):
+        super().setUp()
+        rows = []
+        for i in range(60):
+            row = dict.fromkeys(dm._DEBT_COLUMNS, '')
+            row.update(
+                TenKH=f'Khách {i:02d}', Ngay=f'2026-09-{i % 28 + 1:02d} 08:00:00', TenSanPham='Thuốc ho',
+                SoLuong=1, ThanhTien=30000, MaPhieuNo=f'CN{i:03d}', TrangThai='ChuaTra', TienDaTra=0, TienConLai=30000,
+            )
+            rows.append([row[col] for col in dm._DEBT_COLUMNS])
+        self.sh.worksheet('CongNo').load([dm._DEBT_COLUMNS] + rows)
+
+    def test_shows_one_page_of_slips_in_a_single_table(self):
+        at = self.app('Công Nợ')
+        self.assertEqual(50, len(self.table(at, 'Mã phiếu nợ')))
+        self.assertEqual(1, sum('Mã phiếu nợ' in df.value.columns for df in at.dataframe))
+
+        at.number_input(key='debt_page').set_value(2).run()
+        self.assertEqual(10, len(self.table(at, 'Mã phiếu nợ')))
+
+    def test_page_is_clamped_when_the_filter_shortens_the_list(self):
+        at = self.app('Công Nợ')
+        at.number_input(key='debt_page').set_value(2).run()
+
+        at.text_input(key='debt_filter_name').set_value('Khách 0').run()
+        self.assertEqual([], [e.value for e in at.exception])
+        self.assertEqual(10, len(self.table(at, 'Mã phiếu nợ')))
+
+
+class OrderHistoryTests(MainScreenTestCase):
+    def setUp(self):
+        super().setUp()
+        for i in range(30):
+            with mock.patch.object(dm, '_now', lambda tz, at=self.today_at(i): at.astimezone(tz)):
+                dm.process_checkout([self.cart('SP1', 1), self.cart('SP2', 1)])
+        self.order_ids = sorted({row[1] for row in self.sales_rows()})
+
+    def report(self, **state):
+        return self.app('Báo Cáo', report_tab='Lợi Nhuận & Hoàn Trả', **state)
+
+    def test_pages_the_orders_without_building_line_details(self):
+        at = self.report()
+        self.assertEqual(25, len(self.table(at, 'Mã đơn')))
+        self.assertEqual(self.order_ids[:-26:-1], self.table(at, 'Mã đơn')['Mã đơn'].tolist())
+        self.assertFalse([w for w in at.number_input if str(w.key).startswith('ret_qty_')])
+
+        page_key = f"order_page_{self.today_at(0).date()}"
+        at.number_input(key=page_key).set_value(2).run()
+        self.assertEqual(5, len(self.table(at, 'Mã đơn')))
+
+    def test_selected_order_shows_its_lines_and_returns_them(self):
+        order_id = self.order_ids[0]
+        at = self.report(order_selected=order_id)
+        self.assertEqual(2, len([w for w in at.number_input if str(w.key).startswith(f'ret_qty_{order_id}_')]))
+
+        at.button(key=f'ret_order_{order_id}').click().run()
+        self.assertEqual([-1, -1], [row[5] for row in self.sales_rows()[60:]])
+        self.assertEqual({order_id}, {row[1] for row in self.sales_rows()[60:]})
+
+
+class SalesCartTests(MainScreenTestCase):
+    def add_to_cart(self, at, pid):
+        at.selectbox(key='sales_select').set_value(pid).run()
+        at.button(key=f'add_normal_{pid}').click().run()
+
+    def test_cart_buttons_inside_fragments_work_on_a_full_page_run(self):
+        at = self.app('Bán Hàng')
+        self.add_to_cart(at, 'SP1')
+        self.add_to_cart(at, 'SP2')
+        self.assertEqual(['SP1', 'SP2'], [item['MaSanPham'] for item in at.session_state['sales_cart']])
+
+        # Nút xóa gọi rerun_fragment(); lượt chạy cả trang thì phải lùi về st.rerun().
+        at.button(key='del_cart_1').click().run()
+        self.assertEqual([], [e.value for e in at.exception])
+        self.assertEqual(['SP1'], [item['MaSanPham'] for item in at.session_state['sales_cart']])
+
+    def test_checkout_from_the_cart_fragment_updates_the_shown_stock(self):
+        at = self.app('Bán Hàng')
+        self.add_to_cart(at, 'SP1')
+        next(b for b in at.button if b.label == '✅ THANH TOÁN').click().run()
+
+        self.assertEqual([], at.session_state['sales_cart'])
+        self.assertEqual((61, 61), (self.sheet_stock('SP1'), self.shown_stock('SP1')))
+
+
+class ReportTabTests(MainScreenTestCase):
+    def setUp(self):
+        super().setUp()
+        dm.process_checkout([self.cart('SP1', 2)])
+
+    def test_only_the_open_tab_loads_its_data(self):
+        at = self.app('Bán Hàng')
+        with mock.patch.object(dm, 'load_sales_period', wraps=dm.load_sales_period) as period, \
+                mock.patch.object(dm, 'report_memo', wraps=dm.report_memo) as memo:
+            at.sidebar.radio[0].set_value('Báo Cáo').run()
+        self.assertEqual([], [e.value for e in at.exception])
+        period.assert_not_called()
+        memo.assert_not_called()
+
+    def test_open_tab_reuses_memoized_tables_until_sales_change(self):
+        at = self.app('Báo Cáo', report_tab='Lợi Nhuận & Hoàn Trả')
+        with mock.patch.object(dm, 'load_sales_period', wraps=dm.load_sales_period) as period:
+            at.run()
+            # Chỉ còn bảng đơn trong ngày đọc lại; top sản phẩm tháng lấy từ report_memo.
+            self.assertEqual(1, period.call_count)
+
+            # Bán thêm: bảng tháng và toàn thời gian tính lại (2 lần đọc) cùng bảng đơn trong ngày.
+            dm.process_checkout([self.cart('SP2', 1)])
+            at.run()
+            self.assertEqual(4, period.call_count)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,227 @@
+"""Append-only, fsync'd JSONL logs of writes waiting to reach Google Sheets.
+
+CheckoutJournal records (one JSON object per line):
+    {"op": "checkout", "id": ..., ...}            an order accepted at the till
+    {"op": "batch", "batch": B, "ids": [...]}     orders the worker is writing together
+    {"op": "step", "batch": B, "step": "sales"}   LichSuBan rows written
+    {"op": "intent", "batch": B, "rows": {...}}   TonKho values about to be written
+    {"op": "step", "batch": B, "step": "inventory"}
+    {"op": "done", "batch": B}
+Replaying the file after a restart gives back every order whose batch is not done,
+together with how far its batch got.
+
+WriteOutbox records:
+    {"op": "write", "id": N, "kind": ..., "kwargs": {...}, "at": ..., "expected": {...}}
+    {"op": "start", "id": N}                      replay against the sheets began
+    {"op": "done", "id": N}
+    {"op": "conflict", "id": N, "reason": ..., "applied": ..., "details": [...]}
+    {"op": "dismiss"}                             conflicts reviewed by a user
+"""
+import json
+import os
+import threading
+
+
+class _JsonlLog:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Dòng cuối ghi dở khi mất điện: bỏ qua, bản ghi chưa được xác nhận.
+                    continue
+                self._apply(record)
+
+    def _write(self, record):
+        line = json.dumps(record, ensure_ascii=False, default=_json_default) + '\n'
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        self._apply(record)
+
+    def _truncate(self):
+        # Không còn gì chờ xử lý: làm rỗng file để lần khởi động sau không phải đọc lại.
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.flush()
+            os.fsync(f.fileno())
+
+    def append(self, record):
+        with self._lock:
+            self._write(record)
+
+
+def _json_default(value):
+    # Số numpy (int64, float64...) từ DataFrame của giỏ hàng.
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+class CheckoutJournal(_JsonlLog):
+    def __init__(self, path):
+        self._entries = {}
+        self._batches = {}
+        self._batch_of = {}
+        self._next_batch = 1
+        super().__init__(path)
+        self._load()
+
+    def _apply(self, record):
+        op = record.get('op')
+        if op == 'checkout':
+            self._entries[record['id']] = record
+        elif op == 'batch':
+            batch = record['batch']
+            self._batches[batch] = {'ids': list(record['ids']), 'steps': set(), 'intent': None}
+            for order_id in record['ids']:
+                self._batch_of[order_id] = batch
+            self._next_batch = max(self._next_batch, batch + 1)
+        elif op == 'step' and record['batch'] in self._batches:
+            self._batches[record['batch']]['steps'].add(record['step'])
+        elif op == 'intent' and record['batch'] in self._batches:
+            self._batches[record['batch']]['intent'] = record['rows']
+        elif op == 'done':
+            info = self._batches.pop(record['batch'], None)
+            for order_id in (info or {}).get('ids', []):
+                self._entries.pop(order_id, None)
+                self._batch_of.pop(order_id, None)
+
+    def add_checkout(self, order_id, payload):
+        self.append(dict(payload, op='checkout', id=order_id))
+
+    def start_batch(self, ids):
+        with self._lock:
+            batch = self._next_batch
+            self._write({'op': 'batch', 'batch': batch, 'ids': list(ids)})
+            return batch
+
+    def mark_step(self, batch, step):
+        self.append({'op': 'step', 'batch': batch, 'step': step})
+
+    def record_intent(self, batch, rows):
+        self.append({'op': 'intent', 'batch': batch, 'rows': {str(k): v for k, v in rows.items()}})
+
+    def finish_batch(self, batch):
+        with self._lock:
+            self._write({'op': 'done', 'batch': batch})
+            if not self._entries:
+                self._truncate()
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._entries)
+
+    def pending_quantities(self):
+        """{MaSanPham: quantity} sold by accepted orders whose stock is not deducted on the sheet yet."""
+        with self._lock:
+            totals = {}
+            for order_id, entry in self._entries.items():
+                batch = self._batches.get(self._batch_of.get(order_id))
+                if batch is not None and 'inventory' in batch['steps']:
+                    continue
+                for line in entry.get('lines', []):
+                    totals[line['MaSanPham']] = totals.get(line['MaSanPham'], 0) + line['SoLuong']
+            return totals
+
+    def open_batches(self):
+        """[(batch, entries, steps, intent)] for batches started but not finished, oldest first."""
+        with self._lock:
+            return [
+                (batch, [self._entries[i] for i in info['ids'] if i in self._entries], set(info['steps']), info['intent'])
+                for batch, info in sorted(self._batches.items())
+            ]
+
+    def unbatched(self, limit=None):
+        with self._lock:
+            entries = [e for order_id, e in self._entries.items() if order_id not in self._batch_of]
+        return entries if limit is None else entries[:limit]
+
+
+class WriteOutbox(_JsonlLog):
+    """Writes accepted while Google Sheets was unreachable, in the order they happened."""
+
+    def __init__(self, path):
+        self._pending = {}
+        self._started = set()
+        self._conflicts = []
+        self._next_id = 1
+        super().__init__(path)
+        self._load()
+
+    def _apply(self, record):
+        op = record.get('op')
+        if op == 'write':
+            self._pending[record['id']] = record
+            self._next_id = max(self._next_id, record['id'] + 1)
+        elif op == 'start':
+            self._started.add(record['id'])
+        elif op == 'done':
+            self._pending.pop(record['id'], None)
+            self._started.discard(record['id'])
+        elif op == 'conflict':
+            write = self._pending.get(record['id'], {})
+            self._conflicts.append(dict(record, kind=write.get('kind'), at=write.get('at')))
+            if not record.get('applied'):
+                # Thao tác không ghi được (hoặc không chắc đã ghi): không phát lại tự động.
+                self._pending.pop(record['id'], None)
+                self._started.discard(record['id'])
+        elif op == 'dismiss':
+            self._conflicts = []
+
+    def _compact(self):
+        if not self._pending and not self._conflicts:
+            self._truncate()
+
+    def add(self, kind, kwargs, at, expected):
+        with self._lock:
+            write_id = self._next_id
+            self._write({
+                'op': 'write', 'id': write_id, 'kind': kind,
+                'kwargs': dict(kwargs), 'at': at, 'expected': dict(expected),
+            })
+            return write_id
+
+    def mark_started(self, write_id):
+        self.append({'op': 'start', 'id': write_id})
+
+    def mark_done(self, write_id):
+        with self._lock:
+            self._write({'op': 'done', 'id': write_id})
+            self._compact()
+
+    def add_conflict(self, write_id, reason, details=(), applied=False):
+        with self._lock:
+            self._write({
+                'op': 'conflict', 'id': write_id, 'reason': reason,
+                'applied': applied, 'details': list(details),
+            })
+            self._compact()
+
+    def dismiss_conflicts(self):
+        with self._lock:
+            self._write({'op': 'dismiss'})
+            self._compact()
+
+    def pending(self):
+        """Writes not yet replayed, oldest first; ``started`` marks an interrupted replay."""
+        with self._lock:
+            return [dict(w, started=w['id'] in self._started) for w in sorted(self._pending.values(), key=lambda w: w['id'])]
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending)
+
+    def conflicts(self):
+        with self._lock:
+            return [dict(c) for c in self._conflicts]